@@ -0,0 +1,98 @@
+""" Compare the time taken to create the resized versions of uploaded photos with the original file-based steps and with `imageutils.process_image`.
+
+Usage, from the root of the repository: PYTHONPATH=. python benchmarks/photo_pipeline.py [--count N] [--width W] [--height H]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from fitnessapp import imageutils
+
+def make_photo(width, height, seed):
+    """ Create a JPEG resembling a camera photo, with smooth gradients, noise and EXIF data.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, width)[None,:,None]
+    y = np.linspace(0, 1, height)[:,None,None]
+    colour = rng.uniform(0, 255, size=(1,1,3))
+    pixels = colour*x + (255-colour)*y + rng.normal(0, 8, size=(height,width,3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    exif = Image.Exif()
+    exif[0x0132] = '2019:01:01 12:00:00'
+    buffered = BytesIO()
+    img.save(buffered, format='jpeg', quality=90, exif=exif)
+    return buffered.getvalue()
+
+def file_pipeline(file_name):
+    """ Steps taken by `dbutils.save_photo_data` and `dbutils.get_photo_exif` before the in-memory pipeline.
+    """
+    img = Image.open(file_name)
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        alpha = img.split()[3]
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=alpha)
+        img = background
+    img.thumbnail((700,700))
+    img.save(file_name+'-700', 'jpeg')
+    # Re-read for the upload
+    with open(file_name+'-700', 'rb') as f:
+        f.read()
+    img.thumbnail((32,32))
+    img.save(file_name+'-32', 'jpeg')
+    # Re-open for the EXIF data
+    return Image.open(file_name)._getexif()
+
+def memory_pipeline(file_name):
+    """ Steps taken by `dbutils.save_photo_data` with the in-memory pipeline.
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    derivatives,exif,_ = imageutils.process_image(data, sizes=[700,32])
+    with open(file_name+'-32', 'wb') as f:
+        f.write(derivatives[32])
+    return exif
+
+def benchmark(pipeline, file_names):
+    times = []
+    for file_name in file_names:
+        start = time.perf_counter()
+        pipeline(file_name)
+        times.append(time.perf_counter()-start)
+    return times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10, help='Number of photos')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('Creating %d photos of %dx%d pixels' % (args.count, args.width, args.height))
+        file_names = []
+        for i in range(args.count):
+            file_name = os.path.join(directory, str(i))
+            with open(file_name, 'wb') as f:
+                f.write(make_photo(args.width, args.height, seed=i))
+            file_names.append(file_name)
+
+        # Warm up
+        file_pipeline(file_names[0])
+        memory_pipeline(file_names[0])
+
+        results = {}
+        for name,pipeline in [('file-based', file_pipeline), ('in-memory', memory_pipeline)]:
+            times = benchmark(pipeline, file_names)
+            results[name] = np.mean(times)
+            print('%-10s mean %7.1f ms   p50 %7.1f ms   max %7.1f ms' % (
+                name, np.mean(times)*1000, np.median(times)*1000, np.max(times)*1000))
+        print('Speedup: %.1fx' % (results['file-based']/results['in-memory']))
+    finally:
+        shutil.rmtree(directory)
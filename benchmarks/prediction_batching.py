@@ -0,0 +1,81 @@
+""" Compare the throughput of photo food predictions made by concurrent clients, with each prediction run separately and with `BatchScheduler` running them in batches.
+Uses an untrained Food-101 model, since only the speed matters.
+
+Usage, from the root of the repository: PYTHONPATH=. python benchmarks/prediction_batching.py [--clients N] [--requests N] [--max-batch-size N] [--max-wait S] [--threads N]
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+import torch
+
+from fitnessapp.ml import food101
+from fitnessapp.ml.batching import BatchScheduler
+
+def make_photo(seed):
+    rng = np.random.RandomState(seed)
+    return Image.fromarray(rng.randint(0, 255, size=(700,525,3)).astype(np.uint8))
+
+def run_clients(predict, photos, clients, requests):
+    """ Have `clients` threads each make `requests` predictions one after another.
+    Returns:
+        A tuple containing the total time taken, and the latency of every prediction.
+    """
+    latencies = []
+    lock = threading.Lock()
+    def client(i):
+        for j in range(requests):
+            start = time.perf_counter()
+            predict(photos[(i*requests+j) % len(photos)])
+            elapsed = time.perf_counter()-start
+            with lock:
+                latencies.append(elapsed)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter()-start, latencies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=8, help='Predictions made by each client')
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait', type=float, default=0.005, help='Seconds to wait for a batch to fill')
+    parser.add_argument('--threads', type=int, default=None, help='Threads used by torch')
+    parser.add_argument('--arch', type=str, default='resnet18')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = food101.Food101Model(None, arch=args.arch)
+    photos = [make_photo(i) for i in range(16)]
+    scheduler = BatchScheduler(model.forward, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+
+    def predict_separately(img):
+        return model.predict([img])[0]
+    def predict_batched(img):
+        y = scheduler.submit(model.preprocess(img)).result()
+        return model.postprocess(y[np.newaxis])[0]
+
+    # Warm up
+    predict_separately(photos[0])
+    predict_batched(photos[0])
+
+    total = args.clients*args.requests
+    print('%d clients making %d predictions each, %d torch threads' % (
+        args.clients, args.requests, torch.get_num_threads()))
+    results = {}
+    for name,predict in [('separate', predict_separately), ('batched', predict_batched)]:
+        elapsed,latencies = run_clients(predict, photos, args.clients, args.requests)
+        results[name] = total/elapsed
+        print('%-8s %7.1f photos/s   p50 %7.1f ms   p99 %7.1f ms' % (
+            name, total/elapsed, np.percentile(latencies, 50)*1000, np.percentile(latencies, 99)*1000))
+    stats = scheduler.stats()
+    print('Mean batch size: %.1f' % stats['mean_batch_size'])
+    print('Speedup: %.1fx' % (results['batched']/results['separate']))
+    scheduler.close()
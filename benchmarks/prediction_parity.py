@@ -0,0 +1,54 @@
+""" Check that `Food101Model` predicts the same foods as `tracker_data.food101.train.evaluate_image`, which the app used before models were kept in memory, for a checkpoint and a directory of photos.
+Run it for every new checkpoint or change to the model's preprocessing. Exits with a non-zero status if the most likely food differs for any photo, or if a probability differs by more than the tolerance.
+
+Usage, from the root of the repository: PYTHONPATH=. python benchmarks/prediction_parity.py --checkpoint FILE --images DIRECTORY [--arch ARCH] [--classes FILE] [--count N] [--tolerance P]
+"""
+import argparse
+import os
+import sys
+
+from PIL import Image
+
+import tracker_data
+import tracker_data.food101.train
+from fitnessapp.ml import food101
+
+def parse_reference(predictions):
+    """ Return the reference predictions as a list of (name, probability) tuples, most likely first. Probabilities are None if only names were returned.
+    """
+    output = []
+    for p in predictions:
+        if isinstance(p, (list, tuple)):
+            output.append((str(p[0]), float(p[1]) if len(p) > 1 else None))
+        else:
+            output.append((str(p), None))
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--images', type=str, required=True, help='Directory of photos')
+    parser.add_argument('--arch', type=str, default='resnet18')
+    parser.add_argument('--classes', type=str, default=None, help='File listing the class names in training order')
+    parser.add_argument('--count', type=int, default=100, help='Number of photos')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Largest allowed difference between probabilities')
+    args = parser.parse_args()
+
+    model = food101.Food101Model(args.checkpoint, arch=args.arch, classes=args.classes)
+    file_names = sorted(os.listdir(args.images))[:args.count]
+    mismatches = 0
+    max_difference = 0
+    for file_name in file_names:
+        path = os.path.join(args.images, file_name)
+        expected = parse_reference(tracker_data.food101.train.evaluate_image(args.checkpoint, path))
+        with Image.open(path) as img:
+            actual = model.predict([img])[0]
+        probabilities = dict(actual)
+        differences = [abs(probabilities.get(name, 0)-p) for name,p in expected if p is not None]
+        max_difference = max([max_difference]+differences)
+        if expected[0][0] != actual[0][0] or any([d > args.tolerance for d in differences]):
+            mismatches += 1
+            print('%s: expected %s, got %s' % (file_name, expected[:3], actual[:3]))
+    print('%d of %d photos differ, largest probability difference %.2g' % (
+        mismatches, len(file_names), max_difference))
+    sys.exit(1 if mismatches > 0 else 0)
@@ -0,0 +1,81 @@
+""" Compare the latency of single-photo food predictions with the fp32 model and with the quantized CPU inference mode, and how often both agree on the most likely food.
+Uses the given checkpoint, or untrained weights if there is none, and either the photos in a directory or a fixed set of generated ones. The quantized model is calibrated on a separate set of photos.
+
+Usage, from the root of the repository: PYTHONPATH=. python benchmarks/prediction_quantization.py [--checkpoint FILE] [--images DIRECTORY] [--calibration DIRECTORY] [--count N] [--runs N] [--threads N]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+import torch
+
+from fitnessapp.ml import food101
+
+def make_photo(seed):
+    """ Create a photo with smooth colour gradients and noise, so that the model's outputs aren't all the same.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, 700)[None,:,None]
+    y = np.linspace(0, 1, 525)[:,None,None]
+    colour = rng.uniform(0, 255, size=(1,1,3))
+    pixels = colour*x + (255-colour)*y + rng.normal(0, 30, size=(525,700,3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def load_photos(directory, count, seed=0):
+    if directory is None:
+        return [make_photo(seed+i) for i in range(count)]
+    file_names = sorted(os.listdir(directory))[:count]
+    photos = []
+    for file_name in file_names:
+        with Image.open(os.path.join(directory, file_name)) as img:
+            photos.append(img.convert('RGB'))
+    return photos
+
+def benchmark(model, batches, runs):
+    """ Run every preprocessed photo through the model `runs` times.
+    Returns:
+        A tuple containing the latency of every pass, and the most likely class of each photo.
+    """
+    latencies = []
+    top1 = []
+    for run in range(runs):
+        for batch in batches:
+            start = time.perf_counter()
+            probabilities = model.forward(batch)
+            latencies.append(time.perf_counter()-start)
+            if run == 0:
+                top1.append(int(np.argmax(probabilities[0])))
+    return np.array(latencies), np.array(top1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--arch', type=str, default='resnet18')
+    parser.add_argument('--images', type=str, default=None, help='Directory of photos to use instead of generated ones')
+    parser.add_argument('--calibration', type=str, default=None, help='Directory of photos to calibrate the quantized model with instead of generated ones')
+    parser.add_argument('--count', type=int, default=50, help='Number of photos')
+    parser.add_argument('--runs', type=int, default=3, help='Passes over the set of photos')
+    parser.add_argument('--threads', type=int, default=None, help='Threads used by torch')
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    photos = load_photos(args.images, args.count)
+    calibration = load_photos(args.calibration, args.count, seed=args.count)
+    batches = [food101.preprocess(img)[np.newaxis] for img in photos]
+
+    results = {}
+    for name,options in [('fp32', {}), ('int8', {'quantize': True, 'calibration': calibration, 'channels_last': True})]:
+        # Same seed for both, so that untrained weights are the same
+        torch.manual_seed(0)
+        model = food101.Food101Model(args.checkpoint, arch=args.arch, **options)
+        # Warm up
+        model.forward(batches[0])
+        latencies,top1 = benchmark(model, batches, args.runs)
+        results[name] = top1
+        print('%-5s p50 %7.1f ms   p99 %7.1f ms   mean %7.1f ms' % (
+            name, np.percentile(latencies, 50)*1000, np.percentile(latencies, 99)*1000, np.mean(latencies)*1000))
+    print('Top-1 agreement: %.1f%% of %d photos' % (
+        np.mean(results['fp32'] == results['int8'])*100, len(photos)))
@@ -0,0 +1,118 @@
+import flask
+from flask import Flask, jsonify
+import sqlalchemy
+import json
+import threading
+import traceback
+
+from fitnessapp.extensions import login_manager, db, swagger, cors
+from fitnessapp import search, models, dbutils, jobs, photocache
+from fitnessapp.ml import registry
+
+from tracker_database import User
+
+app = Flask(__name__,
+        instance_relative_config=True,
+        # static_paths with the `static/*` path doesn't work without this.
+        static_url_path='/thisshouldneverbeused',
+        static_folder='./static')
+app.secret_key = 'super secret key'
+app.config.from_object('config')
+app.config.from_pyfile('config.py')
+
+cors.init_app(app, supports_credentials=True)
+swagger.init_app(app)
+db.init_app(app)
+login_manager.init_app(app)
+
+@app.route('/favicon.ico')
+def favicon_paths():
+    return app.send_static_file("favicon.ico")
+
+@app.route('/static', defaults={'path': ''})
+@app.route('/static/<path:path>')
+def static_paths(path):
+    return app.send_static_file('static/'+path)
+
+@app.route('/', defaults={'path': ''})
+@app.route('/<path:path>')
+def react_paths(path):
+    return app.send_static_file("index.html")
+
+@app.errorhandler(sqlalchemy.exc.TimeoutError)
+def timeouterror_handler(error):
+    print(traceback.format_exc())
+    db.session.rollback()
+    return json.dumps({
+        'error': 'Server too busy. Try again later.'
+    }), 503
+
+@app.errorhandler(Exception)
+def exception_handler(error):
+    print(traceback.format_exc())
+    db.session.rollback()
+    return json.dumps({
+        'error': 'Server error encountered'
+    }), 500
+
+from fitnessapp.resources.auth import auth_bp
+from fitnessapp.resources.food import blueprint as food_bp
+from fitnessapp.resources.photos import blueprint as photos_bp
+from fitnessapp.resources.tags import blueprint as tags_bp
+from fitnessapp.resources.labels import blueprint as labels_bp
+from fitnessapp.resources.body import blueprint as body_bp
+from fitnessapp.resources.users import blueprint as user_bp
+from fitnessapp.resources.workout import blueprint as workout_bp
+from fitnessapp.resources.exercises import blueprint as exercise_bp
+
+app.register_blueprint(auth_bp, url_prefix='/api/auth')
+app.register_blueprint(user_bp, url_prefix='/api/data')
+app.register_blueprint(food_bp, url_prefix='/api/data')
+app.register_blueprint(photos_bp, url_prefix='/api/data')
+app.register_blueprint(tags_bp, url_prefix='/api/data')
+app.register_blueprint(labels_bp, url_prefix='/api/data')
+app.register_blueprint(body_bp, url_prefix='/api/data')
+app.register_blueprint(workout_bp, url_prefix='/api/data')
+app.register_blueprint(exercise_bp, url_prefix='/api/data')
+
+if len(app.config.get('PREDICTION_WARMUP', [])) > 0:
+    # Load the prediction models in the background so that startup isn't delayed
+    def warmup_models():
+        with app.app_context():
+            registry.get_registry().warmup(app.config['PREDICTION_WARMUP'])
+    threading.Thread(target=warmup_models, daemon=True).start()
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes_command():
+    """ Create the trigram index used by the food search. """
+    search.create_indexes()
+
+@app.cli.command('create-tables')
+def create_tables_command():
+    """ Create the tables owned by this app. """
+    models.create_tables()
+
+@app.cli.command('rebuild-food-summary')
+def rebuild_food_summary_command():
+    """ Recompute the daily nutrition totals of every user. """
+    dbutils.rebuild_food_daily_summary()
+
+@app.cli.command('backfill-food-quantities')
+def backfill_food_quantities_command():
+    """ Parse the quantities of food entries created before quantities were stored. """
+    dbutils.backfill_food_quantities()
+
+@app.cli.command('process-photo-jobs')
+def process_photo_jobs_command():
+    """ Process uploaded photos that are still waiting to be processed. """
+    jobs.run_pending_photo_jobs()
+
+@app.cli.command('backfill-photo-embeddings')
+def backfill_photo_embeddings_command():
+    """ Compute the visual embeddings of photos uploaded before embeddings were enabled. """
+    dbutils.backfill_photo_embeddings()
+
+@app.cli.command('photo-cache-stats')
+def photo_cache_stats_command():
+    """ Print the size of the cache of resized photos, and its hits, misses and evictions in every process. """
+    print(json.dumps(photocache.get_cache().stats()))
@@ -0,0 +1,163 @@
+import datetime
+import math
+from sqlalchemy.sql import func, not_
+
+from tracker_database import Food
+from fitnessapp.extensions import db
+from fitnessapp.usercache import UserCache
+
+def recency_score(count, date, half_life):
+    """ Rank of a food name logged `count` times, most recently on `date`.
+    Equivalent to `count` decayed by half every `half_life` days since `date`, up to a term that is the same for all names, so the ordering does not change over time.
+    """
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    days = date.toordinal() if date is not None else 0
+    return math.log(max(count, 1)) + days*math.log(2)/half_life
+
+class _Node:
+    __slots__ = ['children', 'key', 'top']
+    def __init__(self):
+        self.children = {} # first character of edge label -> (edge label, child node)
+        self.key = None # Set if a name ends at this node
+        self.top = [] # Highest-scoring keys in this subtree, best first
+
+class RadixTrie:
+    """ Radix trie of food names, where each node keeps its highest-scoring completions.
+    Lookups only walk the prefix, so they don't depend on the number of names.
+    """
+    def __init__(self, half_life=30, top_k=10):
+        self.half_life = half_life
+        self.top_k = top_k
+        self.root = _Node()
+        self.entries = {} # key -> dictionary of name, count, date, score
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name, count=1, date=None):
+        """ Record `count` more uses of `name`, the last of which was on `date`.
+        """
+        key = name.lower()
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {'name': name, 'count': 0, 'date': None}
+        entry['count'] += count
+        if date is not None and (entry['date'] is None or str(date) > str(entry['date'])):
+            entry['date'] = date
+            entry['name'] = name
+        entry['score'] = recency_score(entry['count'], entry['date'], self.half_life)
+        for node in self._insert(key):
+            self._update_top(node, key)
+
+    def _insert(self, key):
+        """ Walk down to the node for `key`, creating and splitting nodes as needed.
+        Returns the list of nodes on the path, starting with the root.
+        """
+        node = self.root
+        path = [node]
+        rest = key
+        while len(rest) > 0:
+            edge = node.children.get(rest[0])
+            if edge is None:
+                child = _Node()
+                node.children[rest[0]] = (rest, child)
+                node = child
+                path.append(node)
+                break
+            label,child = edge
+            # Length of the common prefix of the label and the rest of the key
+            i = 0
+            while i < len(label) and i < len(rest) and label[i] == rest[i]:
+                i += 1
+            if i < len(label):
+                # Split the edge
+                middle = _Node()
+                middle.top = list(child.top)
+                middle.children[label[i]] = (label[i:], child)
+                node.children[rest[0]] = (label[:i], middle)
+                child = middle
+            node = child
+            path.append(node)
+            rest = rest[i:]
+        node.key = key
+        return path
+
+    def _update_top(self, node, key):
+        if key not in node.top:
+            node.top.append(key)
+        node.top.sort(key=lambda k: self.entries[k]['score'], reverse=True)
+        del node.top[self.top_k:]
+
+    def complete(self, prefix, limit=5):
+        """ Return the entries of the highest-scoring names starting with `prefix`, ignoring case.
+        """
+        node = self.root
+        rest = prefix.lower()
+        while len(rest) > 0:
+            edge = node.children.get(rest[0])
+            if edge is None:
+                return []
+            label,child = edge
+            if label.startswith(rest):
+                node = child
+                break
+            if not rest.startswith(label):
+                return []
+            node = child
+            rest = rest[len(label):]
+        return [self.entries[k] for k in node.top[:limit]]
+
+def load_trie(user_id, half_life=30, top_k=10):
+    """ Build a trie of all food names logged by the given user.
+    """
+    names = db.session.query(Food) \
+            .with_entities(
+                    func.mode().within_group(Food.name),
+                    func.count('*'),
+                    func.max(Food.date)
+            ) \
+            .filter_by(user_id=user_id) \
+            .filter(Food.name.isnot(None)) \
+            .filter(not_(Food.name == '')) \
+            .group_by(func.lower(Food.name)) \
+            .all()
+    trie = RadixTrie(half_life=half_life, top_k=top_k)
+    for name,count,date in names:
+        trie.add(name, count, date)
+    return trie
+
+class AutocompleteIndex:
+    """ Per-process collection of food name tries, one per user.
+    Tries are built lazily and the least recently used ones are evicted. New entries created by this process are added to its tries directly. Edits and deletions drop the user's trie so that it gets rebuilt, and tries older than `max_age` seconds are rebuilt to pick up changes made by other processes.
+    """
+    def __init__(self, max_users=200, max_age=600, half_life=30):
+        self.half_life = half_life
+        self.tries = UserCache(lambda user_id: load_trie(user_id, half_life=self.half_life),
+                max_users=max_users, max_age=max_age)
+
+    def complete(self, user_id, prefix, limit=5):
+        """ Return the user's highest-scoring food names starting with `prefix`.
+        """
+        trie = self.tries.get(user_id)
+        # Tries are modified in place by `add`
+        with self.tries.lock:
+            return trie.complete(prefix, limit)
+
+    def add(self, user_id, foods):
+        """ Record newly created food entries in the user's trie, if it is loaded.
+        Args:
+            foods: list of (name, date) tuples.
+        """
+        def add(trie):
+            for name,date in foods:
+                if name:
+                    trie.add(name, 1, date)
+        self.tries.update(user_id, add)
+
+    def invalidate(self, user_id):
+        """ Drop the user's trie so that it is rebuilt on the next lookup.
+        """
+        self.tries.invalidate(user_id)
+
+index = AutocompleteIndex()
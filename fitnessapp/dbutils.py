@@ -1,136 +1,553 @@
 from collections import defaultdict
-from sqlalchemy.sql import func, or_, and_, not_
+from sqlalchemy.sql import func, or_, and_, not_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 import datetime
 import os
 from PIL import Image
 from io import BytesIO
 import base64
-import boto3
+import json
 import re
+import tempfile
+import traceback
+import sqlalchemy
 
 from flask import current_app as app
 
 from tracker_database import Food, Photo
-import tracker_data
-import tracker_data.food101.train
 from fitnessapp.extensions import db
-
-s3 = boto3.resource('s3')
+from fitnessapp import search, autocomplete, imageutils, photocache, storage, photohash, embeddings
+from fitnessapp.models import FoodDailySummary, FoodQuantity, FoodDayVersion, FoodVersion, PhotoHash
+from fitnessapp.ml import registry
 
 def food_to_dict(food, with_photos=True, with_children_ids=True, with_children_data=False):
     """ Convert a food entry to a dictionary, along with a list of photo IDs, and children
     """
-    output = food.to_dict()
+    return foods_to_dict([food], with_photos, with_children_ids, with_children_data)[0]
+
+def foods_to_dict(foods, with_photos=True, with_children_ids=True, with_children_data=False):
+    """ Convert a list of food entries to dictionaries, along with their photo IDs and children.
+    Produces the same output as calling `food_to_dict` on each entry, but loads the photos and children of every entry with a fixed number of queries, regardless of how many entries there are.
+    Args:
+        foods: list of `Food` objects.
+    Returns:
+        A list of dictionaries in the same order as `foods`.
+    """
+    foods = list(foods)
+    if len(foods) == 0:
+        return []
+    food_ids = [f.id for f in foods]
+
+    # Load children. If nested children are needed, load the whole subtree at once with a recursive query.
+    children = []
+    if with_children_data:
+        tree = db.session.query(Food.id) \
+                .filter(Food.parent_id.in_(food_ids)) \
+                .cte(name='tree', recursive=True)
+        tree = tree.union_all(
+                db.session.query(Food.id) \
+                        .filter(Food.parent_id == tree.c.id)
+        )
+        children = db.session.query(Food) \
+                .filter(Food.id.in_(db.session.query(tree.c.id))) \
+                .order_by(Food.id) \
+                .all()
+    elif with_children_ids:
+        children = db.session.query(Food) \
+                .with_entities(
+                        Food.id,
+                        Food.user_id,
+                        Food.parent_id
+                )\
+                .filter(Food.parent_id.in_(food_ids)) \
+                .order_by(Food.id) \
+                .all()
+    children_by_parent = defaultdict(list)
+    for c in children:
+        children_by_parent[c.parent_id].append(c)
 
-    # Add photo data
+    # Load photo IDs of every entry and of their loaded descendants
+    photos_by_food = defaultdict(list)
     if with_photos:
+        ids = food_ids
+        if with_children_data:
+            ids = ids + [c.id for c in children]
         photo_ids = db.session.query(Photo) \
                 .with_entities(
+                        Photo.user_id,
+                        Photo.food_id,
                         Photo.id
                 )\
-                .filter_by(user_id=food.user_id) \
-                .filter_by(food_id=food.id) \
+                .filter(Photo.food_id.in_(ids)) \
+                .order_by(Photo.id) \
                 .all()
-        output['photo_ids'] = [x[0] for x in photo_ids]
+        for user_id,food_id,photo_id in photo_ids:
+            photos_by_food[(user_id,food_id)].append(photo_id)
 
-    # Add children data
-    if with_children_ids:
-        children = db.session.query(Food) \
-                .filter_by(user_id=food.user_id) \
-                .filter_by(parent_id=food.id) \
-                .all()
-        output['children_ids'] = [
-            c.id for c in children
-        ]
-    if with_children_data:
-        children = db.session.query(Food) \
-                .filter_by(user_id=food.user_id) \
-                .filter_by(parent_id=food.id) \
-                .all()
-        output['children'] = [
-            food_to_dict(c, with_photos, with_children_ids, with_children_data) for c in children
-        ]
+    def get_children(food):
+        return [c for c in children_by_parent[food.id] if c.user_id == food.user_id]
+    def to_dict(food):
+        output = food.to_dict()
+        if with_photos:
+            output['photo_ids'] = photos_by_food[(food.user_id,food.id)]
+        if with_children_ids:
+            output['children_ids'] = [c.id for c in get_children(food)]
+        if with_children_data:
+            output['children'] = [to_dict(c) for c in get_children(food)]
+        return output
 
-    return output
+    return [to_dict(f) for f in foods]
+
+def after_commit(function):
+    """ Call `function` once the session's current transaction is committed, or never if it is rolled back.
+    Used to update the per-process caches only with changes that made it to the database.
+    """
+    db.session.info.setdefault('after_commit', []).append(function)
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit(session):
+    for function in session.info.pop('after_commit', []):
+        try:
+            function()
+        except Exception:
+            print(traceback.format_exc())
+
+@event.listens_for(Session, 'after_rollback')
+def discard_after_commit(session):
+    session.info.pop('after_commit', None)
 
 def update_food_from_dict(data, user_id, parent=None):
     """ Parse a dictionary representing a food entry and return make the appropriate updates in the database
+    The whole tree is planned before anything is written. New entries are then created with a single insert, existing entries are updated with a single update, and photos are reassigned with a single update.
     Args:
         data: dictionary representing the food entry.
             children: children food entries of the same format as `data`
             photo_ids: a list containing IDs of photos associated with this entry.
         user_id: User who owns these entries
-        parent_id: ID of the food entry that is parent to the entry represented by `data`.
+        parent: food entry that is parent to the entry represented by `data`.
+    Returns:
+        A list of all food entries that were created or modified, in the order in which they appear in `data`.
+        If `parent` is given, changes are not committed, and the search and autocomplete caches are only updated once the caller commits them.
     """
-    # If editing an existing entry, load it up. Otherwise, create a new entry.
-    if 'id' in data and data['id'] is not None:
-        f = db.session.query(Food) \
-            .filter_by(id = data['id']) \
-            .filter_by(user_id=user_id) \
-            .first()
-        f.update_from_dict(data)
-    else:
-        f = Food.from_dict(data)
-        f.user_id = user_id
-        db.session.add(f)
-        db.session.flush()
-
-    if parent is not None:
-        f.parent_id = parent.id
-        f.date = parent.date
-
-    if 'photo_ids' in data:
-        # Unset food id
-        if f.id is not None:
-            photos = db.session.query(Photo) \
-                    .filter_by(food_id=f.id) \
-                    .filter(not_(Photo.id.in_(data['photo_ids']))) \
-                    .all()
-            for p in photos:
-                p.food_id = None
-        # Set food id
+    food_table = Food.__table__
+    photo_table = Photo.__table__
+    columns = [(a.key, a.columns[0]) for a in sqlalchemy.inspect(Food).column_attrs]
+    quantity_column = Food.__table__.c.quantity.name
+    name_column = Food.__table__.c.name.name
+    date_column = Food.__table__.c.date.name
+
+    # Flatten the tree. Parents always come before their children.
+    nodes = [] # (data, index of parent node)
+    def flatten(d, parent_index):
+        nodes.append((d, parent_index))
+        index = len(nodes)-1
+        if 'children' in d and d['children'] is not None:
+            for child in d['children']:
+                flatten(child, index)
+    flatten(data, None)
+
+    # Load all existing entries at once
+    existing_ids = [d['id'] for d,_ in nodes if 'id' in d and d['id'] is not None]
+    existing = {}
+    if len(existing_ids) > 0:
+        existing = db.session.query(Food) \
+                .filter_by(user_id=user_id) \
+                .filter(Food.id.in_(existing_ids)) \
+                .all()
+        existing = dict([(f.id, f) for f in existing])
+    for food_id in existing_ids:
+        if food_id not in existing:
+            raise Exception('Unable to find food entry with ID %d.' % food_id)
+    # Days whose totals need to be recomputed
+    dates = set([f.date for f in existing.values()])
+
+    # Reserve IDs for new entries so that children can reference their parents before anything is inserted
+    new_ids = []
+    if len(nodes) > len(existing_ids):
+        new_ids = db.session.execute(
+                sqlalchemy.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                {'table': food_table.name, 'count': len(nodes)-len(existing_ids)}
+        ).fetchall()
+        new_ids = [x[0] for x in new_ids]
+    new_ids.reverse()
+
+    # Compute the final state of every entry
+    foods = []
+    inserted_rows = []
+    updated_rows = []
+    for d,parent_index in nodes:
+        if 'id' in d and d['id'] is not None:
+            f = existing[d['id']]
+            f.update_from_dict(d)
+        else:
+            f = Food.from_dict(d)
+            f.user_id = user_id
+            f.id = new_ids.pop()
+        if parent_index is not None:
+            f.parent_id = foods[parent_index].id
+            f.date = foods[parent_index].date
+        elif parent is not None:
+            f.parent_id = parent.id
+            f.date = parent.date
+        foods.append(f)
+        row = dict([(col.name, getattr(f, key)) for key,col in columns])
+        if f.id in existing:
+            updated_rows.append(row)
+        else:
+            inserted_rows.append(row)
+    food_ids = [f.id for f in foods]
+    dates.update([f.date for f in foods])
+    # Discard the changes made to the ORM objects so they don't get flushed one row at a time
+    for f in existing.values():
+        db.session.expire(f)
+
+    # Plan photo reassignments and check for conflicts
+    photo_owners = {} # photo id -> food id
+    foods_with_photos = []
+    for (d,_),food_id in zip(nodes, food_ids):
+        if 'photo_ids' not in d:
+            continue
+        foods_with_photos.append(food_id)
+        for photo_id in d['photo_ids']:
+            if photo_owners.get(photo_id, food_id) != food_id:
+                raise Exception('Photo %d is already assigned to diet entry %d. Cannot reassign.' % (photo_id, photo_owners[photo_id]))
+            photo_owners[photo_id] = food_id
+    if len(photo_owners) > 0:
         photos = db.session.query(Photo) \
-                .filter(Photo.id.in_(data['photo_ids'])) \
+                .with_entities(
+                        Photo.id,
+                        Photo.food_id
+                )\
+                .filter(Photo.id.in_(list(photo_owners.keys()))) \
                 .all()
-        for p in photos:
-            if p.food_id is not None and p.food_id != f.id:
-                raise Exception('Photo %d is already assigned to diet entry %d. Cannot reassign.' % (p.id, p.food_id))
-            p.food_id = f.id
+        for photo_id,food_id in photos:
+            if food_id is None or food_id == photo_owners[photo_id]:
+                continue
+            # Photos can be moved between entries that are both part of this submission
+            if food_id in foods_with_photos:
+                continue
+            raise Exception('Photo %d is already assigned to diet entry %d. Cannot reassign.' % (photo_id, food_id))
 
-    db.session.flush()
+    # Insert new entries
+    if len(inserted_rows) > 0:
+        # Leave out columns that are never set so that the database defaults apply
+        names = [col.name for _,col in columns
+                if any(r[col.name] is not None for r in inserted_rows)]
+        inserted_rows = [dict([(n,r[n]) for n in names]) for r in inserted_rows]
+        db.session.execute(
+                food_table.insert() \
+                        .values(inserted_rows) \
+                        .returning(food_table.c.id)
+        ).fetchall()
 
-    changed_entities = [f]
+    # Update existing entries
+    if len(updated_rows) > 0:
+        values = {}
+        for _,col in columns:
+            if col.primary_key:
+                continue
+            values[col.name] = sqlalchemy.case([
+                (food_table.c.id == r['id'], sqlalchemy.cast(sqlalchemy.literal(r[col.name]), col.type))
+                for r in updated_rows
+            ], else_=col)
+        db.session.execute(
+                food_table.update() \
+                        .where(food_table.c.id.in_([r['id'] for r in updated_rows])) \
+                        .where(food_table.c.user_id == user_id) \
+                        .values(values)
+        )
 
-    # Parse children
-    if 'children' in data and data['children'] is not None:
-        for child in data['children']:
-            changed_entities += update_food_from_dict(child, user_id, parent=f)
+    # Reassign photos
+    if len(foods_with_photos) > 0:
+        if len(photo_owners) > 0:
+            new_food_id = sqlalchemy.case([
+                (photo_table.c.id == photo_id, food_id)
+                for photo_id,food_id in photo_owners.items()
+            ])
+            condition = or_(
+                    photo_table.c.food_id.in_(foods_with_photos),
+                    photo_table.c.id.in_(list(photo_owners.keys()))
+            )
+        else:
+            new_food_id = None
+            condition = photo_table.c.food_id.in_(foods_with_photos)
+        db.session.execute(
+                photo_table.update() \
+                        .where(condition) \
+                        .where(photo_table.c.user_id == user_id) \
+                        .values(food_id=new_food_id)
+        )
+
+    update_food_quantities([(r['id'], r.get(quantity_column)) for r in inserted_rows+updated_rows])
+    update_food_daily_summary(user_id, dates)
+    bump_food_day_versions(user_id, dates)
+
+    def update_caches():
+        search.invalidate(user_id)
+        if len(updated_rows) > 0:
+            autocomplete.index.invalidate(user_id)
+        else:
+            autocomplete.index.add(user_id, [(r.get(name_column), r.get(date_column)) for r in inserted_rows])
+    after_commit(update_caches)
 
     # Commit once when everything is done.
     if parent is None:
         db.session.commit()
 
-    return changed_entities
+    # Reload all entries in a single query
+    changed_entities = db.session.query(Food) \
+            .filter(Food.id.in_(food_ids)) \
+            .populate_existing() \
+            .all()
+    changed_entities = dict([(f.id, f) for f in changed_entities])
+    return [changed_entities[i] for i in food_ids]
 
-def delete_food(food, depth=0):
+def encode_cursor(values):
+    """ Encode a list of JSON-serializable values into an opaque pagination cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """ Decode a cursor created by `encode_cursor`.
+    Raises a ValueError if the cursor is malformed.
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+def parse_date(value, name='date'):
+    """ Parse a date in the YYYY-MM-DD format.
+    Raises a ValueError naming the parameter `name` if it is malformed.
+    """
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('Invalid %s. Dates must be in the YYYY-MM-DD format.' % name)
+
+def list_food_page(user_id, start_date=None, end_date=None, cursor=None, limit=None):
+    """ Return the user's top-level food entries between the given dates (inclusive), most recent first, optionally a page at a time.
+    Pages are located by the (date, id) of the last entry of the previous page rather than an offset, so every page costs the same regardless of how far back it is. Entries without a date can't be located that way, so they are only returned when all entries are listed at once, after the others.
+    Args:
+        start_date: Earliest date to include, as a YYYY-MM-DD string.
+        end_date: Latest date to include, as a YYYY-MM-DD string.
+        cursor: `next_cursor` returned with the previous page, or None for the first page.
+        limit: Number of entries per page. If both it and `cursor` are None, every matching entry is returned.
+    Returns:
+        A tuple containing the list of food entries and the cursor for the next page, or None if this is the last page.
+    Raises:
+        ValueError: A date or the cursor is malformed.
+    """
+    paginate = limit is not None or cursor is not None
+    if limit is None:
+        limit = 50
+    foods = db.session.query(Food) \
+            .filter_by(user_id=user_id) \
+            .filter(Food.parent_id.is_(None))
+    if paginate:
+        foods = foods.filter(Food.date.isnot(None))
+    if start_date is not None:
+        foods = foods.filter(Food.date >= parse_date(start_date, 'start_date'))
+    if end_date is not None:
+        foods = foods.filter(Food.date <= parse_date(end_date, 'end_date'))
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+        if not isinstance(cursor, list) or len(cursor) != 2 or not isinstance(cursor[1], int):
+            raise ValueError('Invalid cursor.')
+        cursor_date = parse_date(cursor[0], 'cursor')
+        foods = foods.filter(tuple_(Food.date, Food.id) < tuple_(cursor_date, cursor[1]))
+    foods = foods \
+            .order_by(Food.date.desc().nullslast()) \
+            .order_by(Food.id.desc())
+    if not paginate:
+        return foods.all(), None
+    foods = foods.limit(limit+1).all()
+    next_cursor = None
+    if len(foods) > limit:
+        foods = foods[:limit]
+        next_cursor = encode_cursor([str(foods[-1].date), foods[-1].id])
+    return foods, next_cursor
+
+def delete_food(food, commit=True):
     """ Delete a food entry along with all children recursively.
     """
-    deleted_ids = [food.id]
-    children = db.session.query(Food) \
-                .filter_by(parent_id=food.id) \
-                .all()
-    for c in children:
-        deleted_ids += delete_food(c, depth=depth+1)
+    deleted_ids,_ = delete_food_trees([food.id], food.user_id, commit=commit)
+    return deleted_ids
 
-    db.session.delete(food)
-    db.session.flush()
+def delete_food_trees(food_ids, user_id, commit=True):
+    """ Delete food entries along with all of their descendants in a single statement.
+    Photos associated with any of the deleted entries are unlinked.
+    Args:
+        food_ids: IDs of the entries to delete. IDs that do not exist or do not belong to the user are ignored.
+        user_id: User who owns these entries
+    Returns:
+        A tuple containing a list of the IDs of deleted food entries, and a list of the IDs of photos that were unlinked.
+    """
+    food_ids = list(food_ids)
+    if len(food_ids) == 0:
+        return [], []
+    results = db.session.execute(sqlalchemy.text("""
+        WITH RECURSIVE tree AS (
+            SELECT id FROM {food}
+            WHERE id = ANY(:food_ids)
+              AND user_id = :user_id
+          UNION
+            SELECT child.id FROM {food} AS child
+            JOIN tree ON child.parent_id = tree.id
+        ), unlinked AS (
+            UPDATE {photo} SET food_id = NULL
+            WHERE food_id IN (SELECT id FROM tree)
+            RETURNING id
+        ), deleted AS (
+            DELETE FROM {food}
+            WHERE id IN (SELECT id FROM tree)
+            RETURNING id, date
+        )
+        SELECT 'food', id, date FROM deleted
+        UNION ALL
+        SELECT 'photo', id, NULL FROM unlinked
+    """.format(food=Food.__table__.name, photo=Photo.__table__.name)),
+        {'food_ids': food_ids, 'user_id': user_id}
+    ).fetchall()
+    deleted_ids = [i for t,i,_ in results if t == 'food']
+    unlinked_photo_ids = [i for t,i,_ in results if t == 'photo']
+    deleted_dates = set([d for t,_,d in results if t == 'food'])
+    update_food_daily_summary(user_id, deleted_dates)
+    bump_food_day_versions(user_id, deleted_dates)
 
-    if depth == 0:
+    # The ORM session does not know about the rows modified above
+    db.session.expire_all()
+    def update_caches():
+        search.invalidate(user_id)
+        autocomplete.index.invalidate(user_id)
+    after_commit(update_caches)
+    if commit:
         db.session.commit()
 
-    return deleted_ids
+    return deleted_ids, unlinked_photo_ids
 
-def search_food_frequent(search_term, user_id):
+FOOD_DAILY_SUMMARY_SQL = """
+    INSERT INTO {summary} (user_id, date, calories, protein)
+    SELECT t.user_id, t.date,
+        SUM(CASE WHEN t.parent_id IS NULL OR p.calories IS NULL THEN t.calories END),
+        SUM(CASE WHEN t.parent_id IS NULL OR p.protein IS NULL THEN t.protein END)
+    FROM {food} AS t
+    LEFT JOIN {food} AS p ON p.id = t.parent_id
+    WHERE t.date IS NOT NULL {condition}
+    GROUP BY t.user_id, t.date
+    ON CONFLICT (user_id, date) DO UPDATE
+    SET calories = EXCLUDED.calories, protein = EXCLUDED.protein
+"""
+
+def update_food_daily_summary(user_id, dates):
+    """ Recompute the user's daily nutrition totals for the given dates.
+    Must be called whenever food entries on those dates are created, modified or deleted. Changes are not committed.
+    """
+    dates = [str(d) for d in dates if d is not None]
+    if len(dates) == 0:
+        return
+    params = {'user_id': user_id, 'dates': dates}
+    # Days that no longer have any entries
+    db.session.query(FoodDailySummary) \
+            .filter_by(user_id=user_id) \
+            .filter(FoodDailySummary.date.in_(dates)) \
+            .delete(synchronize_session=False)
+    db.session.execute(sqlalchemy.text(FOOD_DAILY_SUMMARY_SQL.format(
+        summary=FoodDailySummary.__table__.name,
+        food=Food.__table__.name,
+        condition='AND t.user_id = :user_id AND t.date = ANY(CAST(:dates AS DATE[]))'
+    )), params)
+
+def bump_food_day_versions(user_id, dates):
+    """ Increment the version of the user's food entries on each of the given dates, and the version of all of their entries. Changes are not committed.
+    Must be called whenever anything included in the food entries of those dates changes, including their photos.
+    """
+    dates = set([str(d) for d in dates if d is not None])
+    if len(dates) == 0:
+        return
+    table = FoodDayVersion.__table__
+    stmt = insert(table).values([
+        {'user_id': user_id, 'date': d, 'version': 1} for d in dates
+    ])
+    stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.date],
+            set_={'version': table.c.version+1}
+    )
+    db.session.execute(stmt)
+    table = FoodVersion.__table__
+    stmt = insert(table).values(user_id=user_id, version=1)
+    stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={'version': table.c.version+1}
+    )
+    db.session.execute(stmt)
+
+def get_food_version(user_id):
+    """ Return the version of all of the user's food entries, which changes whenever any of them does.
+    """
+    version = db.session.query(FoodVersion) \
+            .with_entities(FoodVersion.version) \
+            .filter_by(user_id=user_id) \
+            .first()
+    return version[0] if version is not None else 0
+
+def bump_food_day_versions_for_foods(user_id, food_ids):
+    """ Increment the version of the days on which the given food entries were logged. Changes are not committed.
+    """
+    food_ids = [i for i in food_ids if i is not None]
+    if len(food_ids) == 0:
+        return
+    dates = db.session.query(Food) \
+            .with_entities(Food.date) \
+            .filter_by(user_id=user_id) \
+            .filter(Food.id.in_(food_ids)) \
+            .distinct() \
+            .all()
+    bump_food_day_versions(user_id, [d[0] for d in dates])
+
+def food_day_etag(user_id, date):
+    """ Return the ETag of the user's food entries on the given date.
+    """
+    version = db.session.query(FoodDayVersion) \
+            .with_entities(FoodDayVersion.version) \
+            .filter_by(user_id=user_id) \
+            .filter_by(date=date) \
+            .first()
+    version = version[0] if version is not None else 0
+    return '"food-%s-%s-%d"' % (user_id, date, version)
+
+def food_entry_etag(user_id, food_id):
+    """ Return the ETag of the food entries on the same date as the given entry, or None if the entry doesn't exist.
+    """
+    row = db.session.query(Food) \
+            .with_entities(
+                    Food.date,
+                    FoodDayVersion.version
+            )\
+            .outerjoin(FoodDayVersion, and_(
+                FoodDayVersion.user_id == Food.user_id,
+                FoodDayVersion.date == Food.date)) \
+            .filter(Food.user_id == user_id) \
+            .filter(Food.id == food_id) \
+            .first()
+    if row is None:
+        return None
+    return '"food-%s-%s-%d"' % (user_id, row[0], row[1] or 0)
+
+def rebuild_food_daily_summary():
+    """ Recompute the daily nutrition totals of every user from scratch.
+    """
+    db.session.query(FoodDailySummary).delete(synchronize_session=False)
+    db.session.execute(sqlalchemy.text(FOOD_DAILY_SUMMARY_SQL.format(
+        summary=FoodDailySummary.__table__.name,
+        food=Food.__table__.name,
+        condition=''
+    )))
+    db.session.commit()
+
+def search_food_frequent(search_term, user_id, limit=5):
     """ Search the user's history for the search term, ordered by frequency.
     Food items that have been logged more often will appear first.
     """
@@ -145,7 +562,7 @@ def search_food_frequent(search_term, user_id):
             ) \
             .filter_by(user_id=user_id) \
             .filter(not_(Food.name == '')) \
-            .filter(Food.name.ilike('%{0}%'.format(search_term))) \
+            .filter(search.matches(Food.name, search_term, user_id)) \
             .group_by(
                     func.lower(Food.name),
                     Food.quantity,
@@ -153,7 +570,7 @@ def search_food_frequent(search_term, user_id):
                     Food.protein,
             ) \
             .order_by(func.count('*').desc()) \
-            .limit(5) \
+            .limit(limit) \
             .all()
 
     def cast_decimal(dec):
@@ -171,16 +588,16 @@ def search_food_frequent(search_term, user_id):
 
     return [to_dict(f) for f in foods]
 
-def search_food_recent(search_term, user_id):
+def search_food_recent(search_term, user_id, limit=5):
     """ Search the user's history for the search term and return the five most recent matching entries.
     """
     foods = db.session.query(Food) \
             .filter_by(user_id=user_id) \
-            .filter(Food.name.ilike('%{0}%'.format(search_term))) \
+            .filter(search.matches(Food.name, search_term, user_id)) \
             .order_by(Food.date.desc()) \
-            .limit(5) \
+            .limit(limit) \
             .all()
-    return [food_to_dict(f, with_children_data=True) for f in foods]
+    return foods_to_dict(foods, with_children_data=True)
 
 def search_food_premade(search_term, user_id):
     """ Search the user's history for the search term and return the five most recent matching entries.
@@ -189,158 +606,442 @@ def search_food_premade(search_term, user_id):
             .filter_by(user_id=user_id) \
             .filter(Food.premade == True) \
             .filter(or_(Food.finished == False, Food.finished == None)) \
-            .filter(Food.name.ilike('%{0}%'.format(search_term))) \
+            .filter(search.matches(Food.name, search_term, user_id)) \
             .order_by(Food.date.desc()) \
             .all()
-    return [food_to_dict(f, with_children_data=True) for f in foods]
+    return foods_to_dict(foods, with_children_data=True)
 
-def search_food_nutrition(name, units, user_id):
-    """ Search the user's history for the search term and return the five most recent matching entries.
+def search_food(search_term, user_id):
+    """ Run the frequent, recent and premade searches, reusing cached results where possible.
+    The searches run one after another in the request's own database session, so a search holds a single pooled connection.
+    Returns:
+        A dictionary mapping each result set name to its list of results.
     """
-    foods = db.session.query(Food) \
-            .filter(Food.name.ilike('%{0}%'.format(name))) \
-            .filter(Food.quantity.ilike('%{0}'.format(units))) \
-            .order_by(Food.date.desc()) \
-            .all()
-    # Compute average
-    def parse_quantity(qty):
-        m = re.search('([-]?[0-9]+[,.]?[0-9]*([\/][0-9]+[,.]?[0-9]*)*)([a-zA-Z]*)', qty)
-        if m is None:
-            return None, None
-        val = m.group(1)
+    searches = {
+        'frequent': (search_food_frequent, 5),
+        'recent': (search_food_recent, 5),
+        'premade': (search_food_premade, None),
+    }
+    max_age = app.config.get('FOOD_SEARCH_CACHE_TTL', 60)
+    # Read before searching, so that results are never tagged with a version newer than they are
+    version = get_food_version(user_id)
+    # Names matched by trigrams can't be found by filtering the results of a shorter query
+    fuzzy = search.fallback_enabled()
+    results = {}
+    for name,(fn,limit) in searches.items():
+        results[name] = search.cache.get(user_id, name, search_term, version, max_age)
+        if results[name] is not None:
+            continue
+        if limit is None:
+            results[name] = fn(search_term, user_id)
+        else:
+            results[name] = fn(search_term, user_id, limit=limit)
+        search.cache.set(user_id, name, search_term, results[name],
+                complete=(limit is None or len(results[name]) < limit) and not fuzzy,
+                version=version)
+    return results
+
+def parse_quantity(qty):
+    """ Split a quantity string such as "1/2cup" or "100g" into a numeric value and units.
+    Returns:
+        A tuple containing the value and the units, or (None, None) if no number was found.
+    """
+    if qty is None:
+        return None, None
+    m = re.search('([-]?[0-9]+[,.]?[0-9]*([\/][0-9]+[,.]?[0-9]*)*)([a-zA-Z]*)', qty)
+    if m is None:
+        return None, None
+    val = m.group(1).replace(',','.')
+    try:
         if '/' in val:
-            num,den = val.split('/')
+            num,den = val.split('/')[:2]
             val = float(num)/float(den)
         else:
             val = float(val)
-        unit = m.group(3)
-        return val, unit
-    def normalize(f):
-        qty_val,qty_units = parse_quantity(f.quantity)
-        if qty_units != units:
-            return {'calories': None, 'protein': None}
-        def scale(v):
-            if v is None:
-                return None
-            return v/qty_val
-        return {
-                'calories': scale(f.calories),
-                'protein': scale(f.protein)
-        }
+    except (ValueError, ZeroDivisionError):
+        return None, None
+    unit = m.group(3)
+    return val, unit
+
+def update_food_quantities(foods):
+    """ Store the parsed quantities of the given food entries with a single statement. Changes are not committed.
+    Args:
+        foods: list of (food id, quantity string) tuples.
+    """
+    rows = []
+    for food_id,quantity in foods:
+        value,unit = parse_quantity(quantity)
+        rows.append({'food_id': food_id, 'value': value, 'unit': unit})
+    if len(rows) == 0:
+        return
+    stmt = insert(FoodQuantity.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+            index_elements=[FoodQuantity.food_id],
+            set_={'value': stmt.excluded.value, 'unit': stmt.excluded.unit}
+    )
+    db.session.execute(stmt)
+
+def backfill_food_quantities(batch_size=1000):
+    """ Parse the quantities of all food entries that don't have one stored yet.
+    Entries are processed in batches of `batch_size`, committing after each batch.
+    """
+    last_id = 0
+    while True:
+        foods = db.session.query(Food) \
+                .with_entities(
+                        Food.id,
+                        Food.quantity
+                )\
+                .outerjoin(FoodQuantity, FoodQuantity.food_id == Food.id) \
+                .filter(FoodQuantity.food_id.is_(None)) \
+                .filter(Food.id > last_id) \
+                .order_by(Food.id) \
+                .limit(batch_size) \
+                .all()
+        if len(foods) == 0:
+            break
+        update_food_quantities(foods)
+        db.session.commit()
+        last_id = foods[-1][0]
+        print('Parsed quantities up to food entry', last_id)
+
+def search_food_nutrition(name, units, user_id, limit=10):
+    """ Search all food entries for the given name and units and compute the mean nutritional value per unit.
+    Also returns the `limit` most recent matching entries.
+    """
+    def cast_float(val):
+        if val is None:
+            return None
+        return float(val)
+    # Compute average
+    mean = db.session.query(FoodQuantity) \
+            .with_entities(
+                    func.avg(Food.calories/FoodQuantity.value),
+                    func.avg(Food.protein/FoodQuantity.value)
+            ) \
+            .join(Food, Food.id == FoodQuantity.food_id) \
+            .filter(FoodQuantity.unit == units) \
+            .filter(FoodQuantity.value != 0) \
+            .filter(search.contains(Food.name, name)) \
+            .one()
     mean_entry = {
-            'calories': [], 'protein': [], 
+            'calories': cast_float(mean[0]),
+            'protein': cast_float(mean[1]),
             'quantity': ('1 '+units).strip()
     }
-    for f in foods:
-        nf = normalize(f)
-        if nf['calories'] is not None:
-            mean_entry['calories'].append(nf['calories'])
-        if nf['protein'] is not None:
-            mean_entry['protein'].append(nf['protein'])
-    if len(mean_entry['calories']) > 0:
-        mean_entry['calories'] = sum(mean_entry['calories'])/len(mean_entry['calories'])
-    else:
-        mean_entry['calories'] = None
-    if len(mean_entry['protein']) > 0:
-        mean_entry['protein'] = sum(mean_entry['protein'])/len(mean_entry['protein'])
-    else:
-        mean_entry['protein'] = None
+    foods = db.session.query(Food) \
+            .filter(search.contains(Food.name, name)) \
+            .filter(search.ends_with(Food.quantity, units)) \
+            .order_by(Food.date.desc()) \
+            .limit(limit) \
+            .all()
     return {
-            'all': [food_to_dict(f, with_children_data=True) for f in foods],
+            'all': foods_to_dict(foods, with_children_data=True),
             'mean': mean_entry
     }
 
-def get_photo_file_name(photo_id, format='png', size=32):
-    filename = str(photo_id)
-    fp = db.session.query(Photo) \
-            .filter_by(id=photo_id) \
-            .one()
-    if fp is None:
-        raise Exception("File ID not found.")
-    if not os.path.isdir(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
+def open_photo_file(photo_id, format='jpeg', size=32, file_name=None):
+    """ Return an open binary file with the photo resized to fit within `size`, downloading and resizing it if it isn't cached.
+    Args:
+        format: 'jpeg' or 'webp'. Other formats are served as JPEG.
+        file_name: File name of the photo. If not provided, it is looked up from `photo_id`.
+    """
+    if file_name is None:
+        fp = db.session.query(Photo) \
+                .filter_by(id=photo_id) \
+                .one()
+        file_name = fp.file_name
+    cache = photocache.get_cache()
 
-    local_file_name = os.path.join(
-                app.config['UPLOAD_FOLDER'],
-                '%s-%s'%(fp.file_name, size))
-    def get_Local_image(size):
-        try:
-            return Image.open(local_file_name)
-        except Exception:
-            print('Failed to load tiny thumbnail locally for file %s.' % filename)
-    def get_s3_image(size):
-        filename = os.path.join(
-                app.config['UPLOAD_FOLDER'],
-                '%s-700'%(fp.file_name))
-        filename_resized = local_file_name
-        try:
-            with open(filename, "wb") as f:
-                s3.Bucket(app.config['LOGS_PHOTO_BUCKET_NAME']) \
-                  .Object(str(photo_id)) \
-                  .download_fileobj(f)
-            img = Image.open(filename)
-            if size == 700:
-                return img
-            img.thumbnail((size,size))
-            img.save(filename_resized,'PNG')
-            return img
-        except Exception as e:
-            print("Unable to retrieve file %s from AWS servers." % filename)
-
-    img = get_Local_image(size)
-    if img is None:
-        img = get_s3_image(size)
-    if img is None:
+    if format != 'webp' or not imageutils.WEBP_SUPPORTED:
+        format = 'jpeg'
+    key = '%s-%s' % (file_name, size)
+    if format != 'jpeg':
+        key = '%s.%s' % (key, format)
+    f = cache.get(key)
+    if f is not None:
+        return f
+
+    # All other sizes are created from the 700px version
+    f = None
+    if key != '%s-700' % file_name:
+        f = cache.get('%s-700' % file_name)
+    try:
+        if f is not None:
+            with f:
+                data = f.read()
+        else:
+            data = storage.get_storage().get(file_name)
+            cache.put('%s-700' % file_name, data)
+    except Exception:
+        print(traceback.format_exc())
         raise Exception(
-            'Unable to retrieve file %s.' % filename
+            'Unable to retrieve file %s.' % file_name
         )
+    if size == 700 and format == 'jpeg':
+        return BytesIO(data)
+
+    img,_ = imageutils.decode_image(data, max_size=size)
+    data = imageutils.create_derivatives(img, [size], format)[size]
+    cache.put(key, data)
+    return BytesIO(data)
 
-    return local_file_name
+def get_photo_file_name(photo_id, format='jpeg', size=32, file_name=None):
+    """ Return the path of a local copy of the photo resized to fit within `size`, downloading and resizing it if it isn't cached.
+    The file can be evicted by another process at any time, so opening it can raise `FileNotFoundError`, in which case this should be called again. Use `open_photo_file` where a path isn't needed.
+    """
+    if file_name is None:
+        fp = db.session.query(Photo) \
+                .filter_by(id=photo_id) \
+                .one()
+        file_name = fp.file_name
+    with open_photo_file(photo_id, format, size, file_name):
+        pass
+    if format != 'webp' or not imageutils.WEBP_SUPPORTED:
+        format = 'jpeg'
+    key = '%s-%s' % (file_name, size)
+    if format != 'jpeg':
+        key = '%s.%s' % (key, format)
+    return photocache.get_cache().path(key)
 
 def get_photo_data_base64(photo_id, format='png', size=32):
-    file_name = get_photo_file_name(photo_id, format, size)
-    with open(file_name, 'rb') as f:
+    with open_photo_file(photo_id, size=size) as f:
         img = Image.open(f)
+        img.load()
     buffered = BytesIO()
     img.save(buffered, format=format)
     img_str = base64.b64encode(buffered.getvalue())
     return img_str.decode()
 
-def save_photo_data(file, file_name, delete_local=True):
+def get_photo_thumbnails(photos, size=32):
+    """ Return the resized versions of the given photos.
+    Args:
+        photos: list of `Photo` objects.
+    Returns:
+        A list of (photo id, JPEG bytes) tuples, in the same order as `photos`. Photos that could not be retrieved are left out.
+    """
+    cache = photocache.get_cache()
+    # Look each photo up once, then download the missing 700px versions concurrently
+    cached = {} # photo id -> (data of the resized or 700px version, whether it is already resized to `size`)
+    missing = []
+    for p in photos:
+        f = cache.get('%s-%s' % (p.file_name, size))
+        resized = f is not None
+        if f is None and size != 700:
+            f = cache.get('%s-700' % p.file_name)
+        if f is None:
+            missing.append(p.file_name)
+        else:
+            with f:
+                cached[p.id] = (f.read(), resized or size == 700)
+    downloaded = {}
+    if len(missing) > 0:
+        downloaded = storage.get_storage().get_many(missing)
+        for file_name,data in downloaded.items():
+            cache.put('%s-700' % file_name, data)
+
+    output = []
+    for photo in photos:
+        try:
+            data,resized = cached.get(photo.id, (None, size == 700))
+            if data is None:
+                data = downloaded[photo.file_name]
+            if not resized:
+                # Resize from the 700px version
+                img,_ = imageutils.decode_image(data, max_size=size)
+                data = imageutils.create_derivatives(img, [size])[size]
+                cache.put('%s-%s' % (photo.file_name, size), data)
+            output.append((photo.id, data))
+        except Exception:
+            print('Unable to retrieve thumbnail for photo %d.' % photo.id)
+    return output
+
+def save_photo_original(file, file_name):
+    """ Save an uploaded file as is, to be processed later by `process_photo`.
+    """
+    if not os.path.isdir(app.config['UPLOAD_FOLDER']):
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+    file.save(os.path.join(app.config['UPLOAD_FOLDER'], file_name))
+
+def delete_photo_original(file_name):
+    """ Delete the original of a photo saved by `save_photo_original` or `create_photos_from_uploads`, if it is still there.
+    """
+    try:
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file_name))
+    except FileNotFoundError:
+        pass
+
+def upload_stream_factory(total_content_length, content_type, filename, content_length=None):
+    """ Stream factory for `werkzeug.formparser.parse_form_data` that writes each uploaded file straight into the upload folder, so that files are never held in memory.
+    The files are renamed by `create_photos_from_uploads`.
+    """
+    if not os.path.isdir(app.config['UPLOAD_FOLDER']):
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+    return tempfile.NamedTemporaryFile('wb+', prefix='.upload-', dir=app.config['UPLOAD_FOLDER'], delete=False)
+
+def check_food_owner(food_id, user_id):
+    """ Raise a ValueError unless the food entry with the given ID exists and belongs to the user.
+    """
+    count = db.session.query(Food) \
+            .filter_by(id=food_id) \
+            .filter_by(user_id=user_id) \
+            .count()
+    if count == 0:
+        raise ValueError('Unable to find food entry with ID %d.' % food_id)
+
+def create_photos_from_uploads(files, user_id, date=None, time=None, food_id=None):
+    """ Create photo entries for files streamed to disk by `upload_stream_factory`, with a single insert. Changes are not committed.
+    Args:
+        files: list of `FileStorage` objects.
+        food_id: ID of the user's food entry to attach the photos to, if any.
+    Returns:
+        The list of newly-created photos, in the same order as the files.
+    Raises:
+        ValueError: The food entry doesn't exist or belongs to another user.
+    """
+    if len(files) == 0:
+        return []
+    if food_id is not None:
+        check_food_owner(food_id, user_id)
+    photo_table = Photo.__table__
+    # Reserve the IDs first, since they are also the file names
+    ids = db.session.execute(
+            sqlalchemy.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            {'table': photo_table.name, 'count': len(files)}
+    ).fetchall()
+    ids = [x[0] for x in ids]
+    upload_time = datetime.datetime.utcnow()
+    db.session.execute(insert(photo_table).values([{
+        'id': photo_id,
+        'file_name': str(photo_id),
+        'user_id': user_id,
+        'upload_time': upload_time,
+        'date': date,
+        'time': time,
+        'food_id': food_id
+    } for photo_id in ids]))
+    for photo_id,file in zip(ids,files):
+        file.stream.close()
+        os.replace(file.stream.name, os.path.join(app.config['UPLOAD_FOLDER'], str(photo_id)))
+    bump_food_day_versions_for_foods(user_id, [food_id])
+    return db.session.query(Photo) \
+            .filter(Photo.id.in_(ids)) \
+            .order_by(Photo.id) \
+            .all()
+
+def save_photo_data(file_name, delete_local=True):
+    """ Create the resized versions of a photo saved by `save_photo_original` and upload them.
+    The original is read and decoded once, and all resized versions and the photo's hash are produced in memory.
+    Returns:
+        A tuple containing the photo's EXIF data (or None if it has none), and its difference hash.
+    """
     print('saving file ', file_name)
-    # Save file
     file_name_original = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
-    file_name_700 = os.path.join(app.config['UPLOAD_FOLDER'],'%s-700' % file_name)
-    file_name_32 = os.path.join(app.config['UPLOAD_FOLDER'],'%s-32' % file_name)
-    file.save(file_name_original)
-    # Resize photo
-    img = Image.open(file_name_original)
-    # Remove transparency if there's an alpha channel
-    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-        print('Found transparency. Processing alpha channels.')
-        alpha = img.split()[3]
-        background = Image.new("RGB", img.size, (255, 255, 255))
-        background.paste(img, mask=alpha)
-        img = background
-    # Save smaller image
-    img.thumbnail((700,700))
-    img.save(file_name_700, 'jpeg') 
-    # Upload small image to AWS
-    with open(file_name_700, 'rb') as data:
-        s3.Bucket(app.config['LOGS_PHOTO_BUCKET_NAME']).put_object(Key=file_name, Body=data)
-    # Resize to tiny thumbnail size
-    img.thumbnail((32,32))
-    img.save(file_name_32, 'jpeg') 
-    # Delete large local files
+    with open(file_name_original, 'rb') as f:
+        data = f.read()
+    derivatives,exif,h = imageutils.process_image(data, sizes=[700,32])
+    # Upload small image
+    storage.get_storage().put(file_name, derivatives[700])
+    # Keep local copies
+    cache = photocache.get_cache()
+    for size,data in derivatives.items():
+        cache.put('%s-%s' % (file_name, size), data)
     if delete_local:
         os.remove(file_name_original)
-        os.remove(file_name_700)
+    return exif, h
 
-def get_photo_exif(file_name):
-    # Save file
-    file_name_original = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
-    img = Image.open(file_name_original)
-    return img._getexif()
+def process_photo(photo):
+    """ Create the resized versions of an uploaded photo, and fill in its date and time from its EXIF data if they weren't provided. Changes are not committed.
+    The original is kept, so that the photo can be processed again if the changes aren't committed. `jobs.run_photo_job` deletes it once they are.
+    """
+    exif_data,h = save_photo_data(photo.file_name, delete_local=False)
+    if app.config.get('PHOTO_EMBEDDINGS', False):
+        try:
+            embed_photos([photo])
+            # Keep the similar photo search index up to date here rather than in requests
+            embeddings.get_store().refresh_index(photo.user_id)
+        except Exception:
+            # Similar photo search is optional, so it shouldn't fail the upload
+            print(traceback.format_exc())
+    # Photos uploaded in batches aren't hashed at upload time
+    hashed = db.session.query(PhotoHash) \
+            .filter_by(photo_id=photo.id) \
+            .count()
+    if hashed == 0:
+        photohash.save_hashes(photo.user_id, [(photo.id, h)])
+    if exif_data is not None:
+        if photo.time is None and 0x9003 in exif_data:
+            photo.time = exif_data[0x9003].split(' ')[1]
+        if photo.date is None and 0x9003 in exif_data:
+            photo.date = exif_data[0x9003].split(' ')[0].replace(':','-')
+
+def embed_photos(photos):
+    """ Compute the visual embeddings of the given photos with the `EMBEDDING_MODEL_VERSION` model, and store them.
+    Returns:
+        An array with one row per photo.
+    """
+    images = []
+    for p in photos:
+        with open_photo_file(p.id, size=700, file_name=p.file_name) as f:
+            images.append(Image.open(f).convert('RGB'))
+    version = app.config.get('EMBEDDING_MODEL_VERSION') or app.config.get('PREDICTION_MODEL_VERSION')
+    vectors = registry.get_registry().embed(images, version)
+    by_user = defaultdict(list)
+    for i,p in enumerate(photos):
+        by_user[p.user_id].append(i)
+    for user_id,indices in by_user.items():
+        embeddings.get_store().add(user_id, [photos[i].id for i in indices], vectors[indices])
+    return vectors
+
+def backfill_photo_embeddings(batch_size=32):
+    """ Compute the embeddings of photos that don't have one, and drop the embeddings of deleted photos.
+    """
+    store = embeddings.get_store()
+    user_ids = db.session.query(Photo) \
+            .with_entities(Photo.user_id) \
+            .distinct() \
+            .all()
+    for user_id, in user_ids:
+        photos = db.session.query(Photo) \
+                .filter_by(user_id=user_id) \
+                .order_by(Photo.id) \
+                .all()
+        loaded = store.load(user_id)
+        existing = set(loaded[0].tolist())-set([-1]) if loaded is not None else set()
+        photo_ids = set([p.id for p in photos])
+        deleted = list(existing-photo_ids)
+        if len(deleted) > 0:
+            store.remove(user_id, deleted)
+        missing = [p for p in photos if p.id not in existing]
+        for i in range(0,len(missing),batch_size):
+            batch = missing[i:i+batch_size]
+            try:
+                embed_photos(batch)
+            except Exception:
+                print(traceback.format_exc())
+                print('Unable to embed photos', [p.id for p in batch])
+        store.refresh_index(user_id)
+        print('User %s: %d photos embedded, %d removed' % (user_id, len(missing), len(deleted)))
+
+def find_similar_photos(photo, k=5):
+    """ Return the user's `k` photos linked to a food entry that look the most like the given photo, as a list of (photo, cosine similarity) tuples, most similar first.
+    """
+    store = embeddings.get_store()
+    vector = store.get(photo.user_id, photo.id)
+    if vector is None:
+        vector = embed_photos([photo])[0]
+    # Extra candidates make up for photos without a food entry and deleted photos still in the store
+    matches = store.search(photo.user_id, vector, k*4+1)
+    matches = [(photo_id,s) for photo_id,s in matches if photo_id != photo.id]
+    if len(matches) == 0:
+        return []
+    photos = db.session.query(Photo) \
+            .filter_by(user_id=photo.user_id) \
+            .filter(Photo.id.in_([photo_id for photo_id,_ in matches])) \
+            .filter(Photo.food_id.isnot(None)) \
+            .all()
+    photos = dict([(p.id,p) for p in photos])
+    return [(photos[photo_id],s) for photo_id,s in matches if photo_id in photos][:k]
 
 def photo_to_dict(photo, with_data=True):
     output = photo.to_dict()
@@ -349,51 +1050,217 @@ def photo_to_dict(photo, with_data=True):
     return output
 
 def delete_photo(photo, commit=True):
+    """ Delete a photo entry, and its files once the deletion is committed.
+    Args:
+        commit: If False, the deletion is not committed, and the caller must pass the photo's file name to `delete_photo_files` after committing it.
+    """
     # Get food entries that reference this photo and remove the reference
+    bump_food_day_versions_for_foods(photo.user_id, [photo.food_id])
+    file_name = photo.file_name
     db.session.delete(photo)
     db.session.flush()
+    photohash.index.invalidate(photo.user_id)
     if commit:
         db.session.commit()
+        delete_photo_files([file_name])
 
+def delete_photo_files(file_names):
+    """ Delete the stored files of deleted photos, along with originals that were not processed yet.
+    Failures are logged rather than raised, since the photos are already gone from the database.
+    """
+    file_names = list(file_names)
+    if len(file_names) == 0:
+        return
+    for file_name in file_names:
+        delete_photo_original(file_name)
+    try:
+        storage.get_storage().delete_many(file_names)
+    except Exception:
+        print(traceback.format_exc())
+        print('Unable to delete files', file_names)
 
-def predict_food_name_from_photo(photo_id):
-    checkpoint_filename = '/home/howardh/checkpoints/checkpoint-6.pt'
-    photo_filename = get_photo_file_name(photo_id, size=700)
-    return tracker_data.food101.train.evaluate_image(checkpoint_filename, photo_filename)
 
-def autogoup_photos(photo_ids):
-    # Group by time taken and photo similarity
-    pass
+def predict_food_name_from_photo(photo, version=None):
+    """ Return the most likely foods in the given photo, as a list of (name, probability) tuples.
+    Args:
+        photo: `Photo` object, which the caller must have checked belongs to the current user.
+        version: version of the model to use, as listed in `PREDICTION_MODELS`. Defaults to `PREDICTION_MODEL_VERSION`.
+    """
+    with open_photo_file(photo.id, size=700, file_name=photo.file_name) as f:
+        img = Image.open(f).convert('RGB')
+    return registry.get_registry().predict([img], version)[0]
+
+def find_duplicate_photos(user_id, h, max_distance):
+    """ Return the user's photos whose perceptual hash is within `max_distance` bits of `h`, closest first.
+    """
+    matches = photohash.index.search(user_id, h, max_distance)
+    if len(matches) == 0:
+        return []
+    # The index can briefly hold photos that have since been deleted
+    photos = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .filter(Photo.id.in_([photo_id for _,photo_id in matches])) \
+            .all()
+    photos = dict([(p.id,p) for p in photos])
+    return [photos[photo_id] for _,photo_id in matches if photo_id in photos]
+
+def photo_datetime(photo):
+    """ Return the date and time at which a photo was taken, or None if either is unknown.
+    """
+    if photo.date is None or photo.time is None:
+        return None
+    return datetime.datetime.strptime('%s %s' % (photo.date, str(photo.time)[:8]), '%Y-%m-%d %H:%M:%S')
+
+def autogoup_photos(photo_ids, max_seconds=None, max_distance=None):
+    """ Group photos taken within `max_seconds` of each other, or whose perceptual hashes are within `max_distance` bits of each other, e.g. bursts of photos of the same meal.
+    Returns:
+        A list of lists of photo IDs, each ordered by time taken, with the groups ordered by their first photo.
+    """
+    if max_seconds is None:
+        max_seconds = app.config.get('PHOTO_GROUP_SECONDS', 120)
+    if max_distance is None:
+        max_distance = app.config.get('PHOTO_GROUP_DISTANCE', 10)
+    if len(photo_ids) == 0:
+        return []
+    photos = db.session.query(Photo) \
+            .filter(Photo.id.in_(photo_ids)) \
+            .all()
+    groups = group_photos(photos, max_seconds, max_distance)
+    return [[p.id for p in g] for g in groups]
+
+def group_photos(photos, max_seconds, max_distance=None):
+    """ Group already-loaded photos as described in `autogoup_photos`.
+    If `max_distance` is None, photos are only grouped by the time at which they were taken.
+    Returns:
+        A list of lists of photos.
+    """
+    hashes = []
+    if max_distance is not None:
+        hashes = db.session.query(PhotoHash) \
+                .with_entities(PhotoHash.photo_id, PhotoHash.hash) \
+                .filter(PhotoHash.photo_id.in_([p.id for p in photos])) \
+                .all()
+
+    # Union-find over photo IDs
+    parents = dict([(p.id,p.id) for p in photos])
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    def union(i, j):
+        parents[find(i)] = find(j)
+
+    # Sort by time taken, with photos of unknown time last
+    def sort_key(photo):
+        t = photo_datetime(photo)
+        return (t is None, t or datetime.datetime.min, photo.id)
+    photos.sort(key=sort_key)
+    times = [photo_datetime(p) for p in photos]
+    for i in range(1,len(photos)):
+        if times[i] is not None and times[i-1] is not None and (times[i]-times[i-1]).total_seconds() <= max_seconds:
+            union(photos[i-1].id, photos[i].id)
+
+    # Link similar-looking photos
+    tree = photohash.BKTree()
+    for photo_id,h in hashes:
+        h = photohash.to_unsigned(h)
+        for _,other_id in tree.search(h, max_distance):
+            union(photo_id, other_id)
+        tree.add(h, photo_id)
+
+    groups = defaultdict(list)
+    for p in photos:
+        groups[find(p.id)].append(p)
+    order = dict([(p.id,i) for i,p in enumerate(photos)])
+    return sorted(groups.values(), key=lambda g: order[g[0].id])
 
 def autogenerate_food_entry(photos):
     """ Given a list of photos, create a food entry to go with it """
-    # Get photo date and data
-    date = photos[0].date
     user_id = photos[0].user_id
-    photo_id = photos[0].id
-    if len(photos) > 1:
-        photo_id = None
     # Check that date and user id matches for all photos
     for p in photos:
-        if p.date != date:
+        if p.date != photos[0].date:
             raise Exception('Photos were not taken on the same date.')
         if p.user_id != user_id:
             raise Exception('Photos do not belong to the same user.')
-    # Pass through classifiers or object detectors and see if it matches with any known foods
-    # Create appropriate entry
-    food = Food()
-    food.name = 'Unknown'
-    food.date = date
-    food.user_id = user_id
-    food.photo_id = photo_id
-    db.session.add(food)
-    db.session.flush()
-    for p in photos:
-        p.food_id = food.id
-    db.session.flush()
+    food_ids = autogenerate_food_entries(user_id, [photos])
     db.session.commit()
-    print('Creating food entry', food.id)
+    search.invalidate(user_id)
+    autocomplete.index.add(user_id, [('Unknown', photos[0].date)])
+    print('Creating food entry', food_ids[0])
 
-def autogenerate_food_entry_for_date(date):
-    # TODO
-    pass
+def autogenerate_food_entries(user_id, groups):
+    """ Create a placeholder food entry for each group of photos and assign the photos to it, with a fixed number of queries regardless of the number of groups. Changes are not committed.
+    Args:
+        groups: list of lists of photos. All photos in a group must have been taken on the same date.
+    Returns:
+        The list of IDs of the new food entries, in the same order as the groups.
+    """
+    if len(groups) == 0:
+        return []
+    food_table = Food.__table__
+    photo_table = Photo.__table__
+    # Reserve the IDs first so that photos can be linked without another round trip
+    food_ids = db.session.execute(
+            sqlalchemy.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            {'table': food_table.name, 'count': len(groups)}
+    ).fetchall()
+    food_ids = [x[0] for x in food_ids]
+    # Pass through classifiers or object detectors and see if it matches with any known foods
+    db.session.execute(insert(food_table).values([{
+        'id': food_id,
+        'name': 'Unknown',
+        'date': group[0].date,
+        'user_id': user_id,
+        # Entries with several photos don't have a main one
+        'photo_id': group[0].id if len(group) == 1 else None
+    } for food_id,group in zip(food_ids,groups)]))
+    owners = [(p.id,food_id) for food_id,group in zip(food_ids,groups) for p in group]
+    db.session.execute(
+            photo_table.update() \
+                    .where(photo_table.c.id.in_([photo_id for photo_id,_ in owners])) \
+                    .where(photo_table.c.user_id == user_id) \
+                    .values(food_id=sqlalchemy.case([
+                        (photo_table.c.id == photo_id, food_id)
+                        for photo_id,food_id in owners
+                    ]))
+    )
+    dates = list(set([group[0].date for group in groups]))
+    update_food_daily_summary(user_id, dates)
+    bump_food_day_versions(user_id, dates)
+    return food_ids
+
+def autogenerate_food_entry_for_date(date, user_id, max_photos=None):
+    """ Create placeholder food entries for the photos taken on the given date that aren't assigned to any entry, one entry per group of photos taken within `PHOTO_GROUP_SECONDS` of each other.
+    Photos are not grouped by how they look, since the same meal eaten twice in a day would end up in one entry.
+    All entries are created in one transaction. The photos are locked while grouping, so that concurrent calls don't create entries for the same photos twice.
+    Args:
+        max_photos: maximum number of photos to handle in one call, so that it finishes in bounded time. Defaults to the `AUTOGENERATE_MAX_PHOTOS` config value. Remaining photos are handled by the next call.
+    Returns:
+        A tuple containing the list of IDs of the new food entries, and the number of photos that remain unassigned.
+    """
+    if max_photos is None:
+        max_photos = app.config.get('AUTOGENERATE_MAX_PHOTOS', 500)
+    photos = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .filter_by(date=date) \
+            .filter(Photo.food_id.is_(None)) \
+            .order_by(Photo.time, Photo.id) \
+            .limit(max_photos) \
+            .with_for_update(skip_locked=True) \
+            .all()
+    groups = group_photos(photos, app.config.get('PHOTO_GROUP_SECONDS', 120))
+    food_ids = autogenerate_food_entries(user_id, groups)
+    # Photos handled above are assigned by now, so this counts the ones left, including those locked by another call
+    remaining = db.session.query(Photo) \
+            .filter_by(user_id=user_id) \
+            .filter_by(date=date) \
+            .filter(Photo.food_id.is_(None)) \
+            .count()
+    # Commit once when everything is done.
+    db.session.commit()
+    if len(food_ids) > 0:
+        search.invalidate(user_id)
+        autocomplete.index.add(user_id, [('Unknown', date)]*len(food_ids))
+    return food_ids, remaining
@@ -0,0 +1,285 @@
+from collections import OrderedDict
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+from flask import current_app as app
+
+class IVFIndex:
+    """ Inverted file index over a matrix of normalized vectors.
+    The vectors are clustered with k-means, and a search only compares against the vectors in the `probes` clusters whose centroids are closest to the query, instead of against every vector.
+    """
+    def __init__(self, centroids, assignments):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.lists = [np.flatnonzero(assignments == i) for i in range(len(centroids))]
+
+    def __len__(self):
+        """ Number of rows of the matrix the index was built from. """
+        return len(self.assignments)
+
+    @classmethod
+    def build(cls, matrix, clusters=None, seed=0):
+        from sklearn.cluster import MiniBatchKMeans
+        if clusters is None:
+            clusters = max(int(np.sqrt(len(matrix))), 1)
+        kmeans = MiniBatchKMeans(n_clusters=clusters, random_state=seed)
+        assignments = kmeans.fit_predict(np.asarray(matrix, dtype=np.float32))
+        return cls(kmeans.cluster_centers_.astype(np.float32), assignments.astype(np.int32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['assignments'])
+
+    def save(self, f):
+        np.savez(f, centroids=self.centroids, assignments=self.assignments)
+
+    def candidates(self, query, probes=8):
+        """ Return the indices of the rows in the `probes` clusters whose centroids are the most similar to `query`.
+        """
+        nearest = np.argsort(-(self.centroids @ query))[:probes]
+        return np.concatenate([self.lists[i] for i in nearest])
+
+class EmbeddingStore:
+    """ Visual embeddings of each user's photos, stored as one float16 matrix per user, with one L2-normalized row per photo.
+    Each user's matrix and the matching photo IDs are kept in raw files that new rows are appended to, and are memory-mapped when searched. A small metadata file, replaced atomically after every write, gives the number of rows that are complete, and lists the rows that were replaced or removed. Once those make up half of the matrix, it is compacted into new files. Writes hold a lock file, so that several processes can share the directory.
+    Accounts with many photos are searched with an IVF index, which is saved next to the matrix by `refresh_index`. Rows appended since it was built are searched exhaustively until it is rebuilt.
+    """
+    def __init__(self, directory, ivf_min_photos=20000, ivf_probes=8, ivf_max_growth=0.2, max_indexes=20):
+        self.directory = directory
+        self.ivf_min_photos = ivf_min_photos
+        self.ivf_probes = ivf_probes
+        self.ivf_max_growth = ivf_max_growth
+        self.max_indexes = max_indexes
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict() # path of the index file -> (modification time, IVF index), least recently used first
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, user_id, suffix):
+        return os.path.join(self.directory, '%s%s' % (user_id, suffix))
+
+    def data_path(self, user_id, meta, suffix):
+        """ Path of a file belonging to the user's current set of data files, which changes whenever they are compacted.
+        """
+        return self.path(user_id, '-%d%s' % (meta['generation'], suffix))
+
+    def read_meta(self, user_id):
+        """ Return the metadata of the user's embeddings, or None if they have none.
+        """
+        try:
+            with open(self.path(user_id, '.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, user_id, meta):
+        fd,temp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            os.replace(temp_path, self.path(user_id, '.json'))
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _load(self, user_id, meta):
+        ids = np.fromfile(self.data_path(user_id, meta, '.ids'), dtype=np.int64, count=meta['rows'])
+        matrix = np.memmap(self.data_path(user_id, meta, '.vectors'),
+                dtype=np.float16, mode='r', shape=(meta['rows'], meta['dim']))
+        if len(ids) != meta['rows']:
+            raise ValueError('Embedding IDs of user %s are truncated' % user_id)
+        ids[meta['dead']] = -1
+        return ids, matrix
+
+    def load(self, user_id, with_meta=False):
+        """ Return the user's photo IDs and their embeddings as a read-only memory-mapped matrix, or None if the user has none.
+        Replaced and removed rows are still in the matrix, with an ID of -1.
+        Args:
+            with_meta: If True, the metadata the files were read with is returned as well, as a third element.
+        """
+        for attempt in range(3):
+            meta = self.read_meta(user_id)
+            if meta is None or meta['rows'] == 0:
+                return None
+            try:
+                ids,matrix = self._load(user_id, meta)
+            except FileNotFoundError:
+                # Compacted by another process after reading the metadata
+                continue
+            if with_meta:
+                return ids, matrix, meta
+            return ids, matrix
+        return None
+
+    def update(self, user_id, add_ids=(), add_vectors=None, remove_ids=()):
+        """ Add or replace the embeddings of the given photos, and remove those of others.
+        """
+        with open(self.path(user_id, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self.read_meta(user_id)
+            if meta is None:
+                meta = {'generation': 0, 'version': 0, 'rows': 0, 'dim': None, 'dead': []}
+            if meta['rows'] == 0:
+                ids = np.zeros(0, dtype=np.int64)
+            else:
+                ids,_ = self._load(user_id, meta)
+            dead = set(meta['dead'])
+            dead.update(np.flatnonzero(np.isin(ids, list(add_ids)+list(remove_ids))).tolist())
+            if len(add_ids) > 0:
+                vectors = np.asarray(add_vectors, dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                if meta['dim'] is None:
+                    meta['dim'] = vectors.shape[1]
+                elif meta['dim'] != vectors.shape[1]:
+                    raise ValueError('Embeddings of user %s have %d dimensions, not %d' % (
+                        user_id, meta['dim'], vectors.shape[1]))
+                for suffix,array in [('.vectors', vectors.astype(np.float16)), ('.ids', np.asarray(add_ids, dtype=np.int64))]:
+                    with open(self.data_path(user_id, meta, suffix), 'ab') as f:
+                        # Drop anything left by a write that failed before updating the metadata
+                        f.truncate(meta['rows']*array.itemsize*int(np.prod(array.shape[1:])))
+                        f.write(array.tobytes())
+                meta['rows'] += len(add_ids)
+            elif len(dead) == len(meta['dead']):
+                return
+            meta['dead'] = sorted(dead)
+            meta['version'] += 1
+            if len(dead) > 0 and len(dead)*2 >= meta['rows']:
+                self._compact(user_id, meta)
+            else:
+                self._write_meta(user_id, meta)
+
+    def _compact(self, user_id, meta):
+        """ Copy the live rows to a new set of data files and remove the old ones. Must be called with the lock held.
+        """
+        ids,matrix = self._load(user_id, meta)
+        live = ids >= 0
+        old = dict(meta)
+        meta['generation'] += 1
+        meta['rows'] = int(np.count_nonzero(live))
+        meta['dead'] = []
+        with open(self.data_path(user_id, meta, '.vectors'), 'wb') as f:
+            f.write(np.ascontiguousarray(matrix[live]).tobytes())
+        with open(self.data_path(user_id, meta, '.ids'), 'wb') as f:
+            f.write(ids[live].tobytes())
+        self._write_meta(user_id, meta)
+        for suffix in ['.vectors', '.ids', '-ivf.npz']:
+            try:
+                os.remove(self.data_path(user_id, old, suffix))
+            except FileNotFoundError:
+                pass
+
+    def get(self, user_id, photo_id):
+        """ Return the stored embedding of the given photo, or None if it doesn't have one.
+        """
+        loaded = self.load(user_id)
+        if loaded is None:
+            return None
+        ids,matrix = loaded
+        rows = np.flatnonzero(ids == photo_id)
+        if len(rows) == 0:
+            return None
+        return matrix[rows[0]].astype(np.float32)
+
+    def add(self, user_id, photo_ids, vectors):
+        self.update(user_id, add_ids=photo_ids, add_vectors=vectors)
+
+    def remove(self, user_id, photo_ids):
+        self.update(user_id, remove_ids=photo_ids)
+
+    def refresh_index(self, user_id):
+        """ Build and save an IVF index of the user's matrix if they have enough photos, and it is missing or too many rows were added since it was built.
+        Slow for large accounts, so it is meant to be called by background jobs rather than during requests.
+        Returns:
+            True if the index was rebuilt.
+        """
+        meta = self.read_meta(user_id)
+        if meta is None or meta['rows'] < self.ivf_min_photos:
+            return False
+        index = self.get_index(user_id, meta)
+        if index is not None and meta['rows'] <= len(index)*(1+self.ivf_max_growth):
+            return False
+        loaded = self.load(user_id, with_meta=True)
+        if loaded is None:
+            return False
+        _,matrix,meta = loaded
+        index = IVFIndex.build(matrix)
+        # Saved under the generation of the matrix it was built from, in case it was compacted in the meantime
+        path = self.path(user_id, '-%d-ivf.npz' % meta['generation'])
+        fd,temp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.npz', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                index.save(f)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return True
+
+    def get_index(self, user_id, meta):
+        """ Return the saved IVF index of the user's current matrix, or None if there is none.
+        """
+        path = self.data_path(user_id, meta, '-ivf.npz')
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            cached = self.indexes.get(path)
+            if cached is not None and cached[0] == mtime:
+                self.indexes.move_to_end(path)
+                return cached[1]
+        try:
+            index = IVFIndex.load(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.indexes[path] = (mtime, index)
+            self.indexes.move_to_end(path)
+            while len(self.indexes) > self.max_indexes:
+                self.indexes.popitem(last=False)
+        return index
+
+    def search(self, user_id, vector, k):
+        """ Return a list of (photo ID, cosine similarity) tuples for the user's `k` photos most similar to `vector`, most similar first.
+        Accounts with an IVF index are searched approximately.
+        """
+        loaded = self.load(user_id, with_meta=True)
+        if loaded is None:
+            return []
+        ids,matrix,meta = loaded
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        index = self.get_index(user_id, meta) if len(matrix) >= self.ivf_min_photos else None
+        if index is not None and len(index) <= len(matrix):
+            rows = np.concatenate([index.candidates(query, self.ivf_probes), np.arange(len(index), len(matrix))])
+            rows = rows[ids[rows] >= 0]
+        else:
+            rows = np.flatnonzero(ids >= 0)
+        similarities = matrix[rows].astype(np.float32) @ query
+        if k < len(similarities):
+            top = np.argpartition(-similarities, k)[:k]
+        else:
+            top = np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top])]
+        return [(int(ids[rows[i]]), float(similarities[i])) for i in top]
+
+stores = {}
+stores_lock = threading.Lock()
+
+def get_store():
+    """ Return the embedding store configured for the current app.
+    """
+    directory = app.config.get('EMBEDDING_FOLDER')
+    if directory is None:
+        directory = os.path.join(app.config['UPLOAD_FOLDER'], 'embeddings')
+    with stores_lock:
+        if directory not in stores:
+            stores[directory] = EmbeddingStore(directory,
+                    ivf_min_photos=app.config.get('EMBEDDING_IVF_MIN_PHOTOS', 20000),
+                    ivf_probes=app.config.get('EMBEDDING_IVF_PROBES', 8))
+        return stores[directory]
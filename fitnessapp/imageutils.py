@@ -0,0 +1,101 @@
+from io import BytesIO
+from PIL import Image
+
+DERIVATIVE_SIZES = [700, 32]
+
+Image.init()
+WEBP_SUPPORTED = 'WEBP' in Image.SAVE
+
+def decode_image(data, max_size=None):
+    """ Decode an image from its bytes.
+    If `max_size` is given, JPEG images are scaled down by the decoder itself to the smallest size that still covers `max_size`, which is much faster than decoding the full image.
+    Returns:
+        A tuple containing the decoded RGB or grayscale image, and its EXIF data (or None if it has none).
+    """
+    img = Image.open(BytesIO(data))
+    # EXIF data is read from the file header, so it doesn't need the image to be decoded
+    exif = None
+    if hasattr(img, '_getexif'):
+        exif = img._getexif()
+    if max_size is not None and img.format == 'JPEG':
+        img.draft('RGB', (max_size,max_size))
+    img.load()
+    return remove_transparency(img), exif
+
+def remove_transparency(img):
+    """ Return the image in a mode that can be saved as a JPEG, painting transparent areas white.
+    """
+    if img.mode in ('RGB', 'L'):
+        return img
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    return img.convert('RGB')
+
+def create_derivatives(img, sizes=DERIVATIVE_SIZES, format='jpeg'):
+    """ Resize a decoded image to fit within each of the given sizes and encode the results in memory.
+    Each size is resized from the next larger one rather than from the original.
+    Returns:
+        A dictionary mapping each size to the encoded image.
+    """
+    output = {}
+    img = img.copy()
+    for size in sorted(sizes, reverse=True):
+        img.thumbnail((size,size))
+        buffered = BytesIO()
+        img.save(buffered, format=format)
+        output[size] = buffered.getvalue()
+    return output
+
+def process_image(data, sizes=DERIVATIVE_SIZES, format='jpeg'):
+    """ Decode an uploaded image once and create all of its resized versions and its difference hash from that single decode.
+    Returns:
+        A tuple containing a dictionary mapping each size to the encoded image, the image's EXIF data, and its difference hash.
+    """
+    img,exif = decode_image(data, max_size=max(sizes))
+    return create_derivatives(img, sizes, format), exif, dhash(img)
+
+def dhash(img, hash_size=8):
+    """ Difference hash of a decoded image: one bit per pair of horizontally adjacent pixels of a small grayscale version, set if the brightness increases.
+    Similar-looking images have hashes that differ in few bits.
+    Returns:
+        The hash as an unsigned integer of `hash_size`*`hash_size` bits.
+    """
+    small = img.convert('L').resize((hash_size+1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    h = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row*(hash_size+1)+col
+            h = (h << 1) | (pixels[i+1] > pixels[i])
+    return h
+
+def dhash_from_bytes(data):
+    """ Difference hash of an encoded image. JPEGs are only partially decoded, at the smallest size the decoder supports.
+    """
+    img,_ = decode_image(data, max_size=64)
+    return dhash(img)
+
+def create_sprite(images, cell_size, columns=16, format='jpeg'):
+    """ Paste encoded images into a grid of `cell_size` by `cell_size` cells and encode the result as a single image.
+    Args:
+        images: list of (key, encoded image) tuples.
+    Returns:
+        A tuple containing the encoded sprite sheet, and a dictionary mapping each key to the x, y, width and height of its image within the sheet.
+    """
+    columns = max(min(columns, len(images)), 1)
+    rows = (len(images)+columns-1)//columns
+    sheet = Image.new('RGB', (columns*cell_size, max(rows,1)*cell_size), (255, 255, 255))
+    offsets = {}
+    for i,(key,data) in enumerate(images):
+        img = Image.open(BytesIO(data))
+        img.thumbnail((cell_size,cell_size))
+        x = (i % columns)*cell_size
+        y = (i // columns)*cell_size
+        sheet.paste(remove_transparency(img), (x,y))
+        offsets[key] = {'x': x, 'y': y, 'width': img.size[0], 'height': img.size[1]}
+    buffered = BytesIO()
+    sheet.save(buffered, format=format)
+    return buffered.getvalue(), offsets
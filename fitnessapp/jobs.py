@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import threading
+import traceback
+
+from flask import current_app as app
+from sqlalchemy.sql import or_, and_
+
+from tracker_database import Photo
+from fitnessapp.extensions import db
+from fitnessapp.models import PhotoJob
+from fitnessapp import dbutils
+
+executor = None
+executor_lock = threading.Lock()
+
+def get_executor():
+    """ Return the pool of threads processing photo jobs in this process, creating it on first use.
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=app.config.get('PHOTO_WORKERS', 2))
+        return executor
+
+def create_photo_job(photo):
+    """ Create a pending job to process the given photo. Changes are not committed.
+    """
+    job = PhotoJob()
+    job.photo_id = photo.id
+    job.user_id = photo.user_id
+    job.status = 'pending'
+    job.created = datetime.datetime.utcnow()
+    db.session.add(job)
+    return job
+
+def create_photo_jobs(photos):
+    """ Create pending jobs for several photos with a single insert. Changes are not committed.
+    Returns:
+        The list of job IDs, in the same order as the photos.
+    """
+    if len(photos) == 0:
+        return []
+    created = datetime.datetime.utcnow()
+    job_table = PhotoJob.__table__
+    rows = db.session.execute(job_table.insert().values([{
+        'photo_id': photo.id,
+        'user_id': photo.user_id,
+        'status': 'pending',
+        'created': created
+    } for photo in photos]).returning(job_table.c.id)).fetchall()
+    return [r[0] for r in rows]
+
+def run_inline():
+    """ Whether photo jobs should run in the request that created them rather than in background threads.
+    On AWS Lambda (e.g. when deployed with Zappa), the process is frozen as soon as the response is sent, so background threads can't be relied on.
+    """
+    inline = app.config.get('PHOTO_JOBS_INLINE')
+    if inline is None:
+        return 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+    return inline
+
+def submit_photo_job(job_id):
+    """ Process the given job in the background, or right away if `run_inline` says so. The job must already be committed.
+    """
+    if run_inline():
+        try:
+            run_photo_job(job_id)
+        except Exception:
+            print(traceback.format_exc())
+        return
+    flask_app = app._get_current_object()
+    def run():
+        # Each job gets its own database session through its own app context
+        with flask_app.app_context():
+            try:
+                run_photo_job(job_id)
+            except Exception:
+                print(traceback.format_exc())
+    get_executor().submit(run)
+
+def claimable():
+    """ Filter matching the jobs that can be claimed: pending ones, and ones whose worker has been processing them for longer than `PHOTO_JOB_TIMEOUT` seconds, which most likely died.
+    """
+    stale = datetime.datetime.utcnow()-datetime.timedelta(seconds=app.config.get('PHOTO_JOB_TIMEOUT', 600))
+    return or_(
+            PhotoJob.status == 'pending',
+            and_(PhotoJob.status == 'processing', PhotoJob.updated < stale)
+    )
+
+def run_photo_job(job_id):
+    """ Process the given job if it is still pending, or if its previous claim is stale, and record the outcome.
+    Returns:
+        True if the job was run, False if it was already taken.
+    """
+    # Claim the job so that it doesn't get processed twice
+    claimed = db.session.query(PhotoJob) \
+            .filter_by(id=job_id) \
+            .filter(claimable()) \
+            .update({
+                'status': 'processing',
+                'updated': datetime.datetime.utcnow()
+            }, synchronize_session=False)
+    db.session.commit()
+    if claimed == 0:
+        return False
+
+    job = db.session.query(PhotoJob) \
+            .filter_by(id=job_id) \
+            .one()
+    file_name = None
+    try:
+        photo = db.session.query(Photo) \
+                .filter_by(id=job.photo_id) \
+                .one()
+        file_name = photo.file_name
+        dbutils.process_photo(photo)
+        job.status = 'done'
+        job.error = None
+    except Exception as e:
+        print(traceback.format_exc())
+        db.session.rollback()
+        job = db.session.query(PhotoJob) \
+                .filter_by(id=job_id) \
+                .one()
+        job.status = 'failed'
+        job.error = str(e)
+    job.updated = datetime.datetime.utcnow()
+    status = job.status
+    db.session.flush()
+    db.session.commit()
+    if status == 'done':
+        # Kept until now so that a failed job can be retried
+        dbutils.delete_photo_original(file_name)
+    return True
+
+def run_pending_photo_jobs():
+    """ Process all pending jobs in the current thread, including ones lost when a worker process exited.
+    Meant to be run periodically, e.g. by cron, so that no job stays pending or processing forever.
+    """
+    jobs = db.session.query(PhotoJob) \
+            .with_entities(PhotoJob.id) \
+            .filter(claimable()) \
+            .order_by(PhotoJob.id) \
+            .all()
+    for job_id, in jobs:
+        if run_photo_job(job_id):
+            print('Processed photo job', job_id)
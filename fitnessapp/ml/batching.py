@@ -0,0 +1,110 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+class SchedulerClosed(Exception):
+    pass
+
+class BatchScheduler:
+    """ Runs a model on batches of inputs gathered from concurrent callers.
+    A single worker thread waits for the first input, then keeps collecting inputs for up to `max_wait` seconds or until it has `max_batch_size` of them, and runs them through the model in one pass. Each caller gets back its own row of the output.
+    """
+    def __init__(self, forward, max_batch_size=8, max_wait=0.005):
+        """
+        Args:
+            forward: function taking an array of stacked inputs and returning an array with one row per input.
+        """
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        """ Queue one input to be run through the model.
+        Returns:
+            A `Future` resolving to the model's output for `x`.
+        Raises:
+            SchedulerClosed: `close` was called.
+        """
+        future = Future()
+        # Checked and queued under the lock, so that nothing is queued after the sentinel put by `close`
+        with self.lock:
+            if self.closed:
+                raise SchedulerClosed('Scheduler is closed.')
+            self.queue.put((x, future))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.drain()
+                return
+            batch = [item]
+            deadline = time.time()+self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline-time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Finish the current batch before stopping
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            output = self.forward(np.stack([x for x,_ in batch]))
+        except Exception as e:
+            print(traceback.format_exc())
+            for _,future in batch:
+                future.set_exception(e)
+            return
+        for (_,future),y in zip(batch,output):
+            future.set_result(y)
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+
+    def drain(self):
+        """ Fail any input left in the queue once the worker has stopped, so that no caller waits forever.
+        """
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(SchedulerClosed('Scheduler is closed.'))
+
+    def close(self):
+        """ Stop the worker thread once the inputs already queued have been run. Later calls to `submit` raise `SchedulerClosed`.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items/self.batches if self.batches > 0 else 0
+            }
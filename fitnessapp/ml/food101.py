@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+from PIL import Image
+import torch
+import torchvision
+
+FOOD101_CLASSES = [
+    'apple_pie', 'baby_back_ribs', 'baklava', 'beef_carpaccio', 'beef_tartare',
+    'beet_salad', 'beignets', 'bibimbap', 'bread_pudding', 'breakfast_burrito',
+    'bruschetta', 'caesar_salad', 'cannoli', 'caprese_salad', 'carrot_cake',
+    'ceviche', 'cheese_plate', 'cheesecake', 'chicken_curry', 'chicken_quesadilla',
+    'chicken_wings', 'chocolate_cake', 'chocolate_mousse', 'churros', 'clam_chowder',
+    'club_sandwich', 'crab_cakes', 'creme_brulee', 'croque_madame', 'cup_cakes',
+    'deviled_eggs', 'donuts', 'dumplings', 'edamame', 'eggs_benedict',
+    'escargots', 'falafel', 'filet_mignon', 'fish_and_chips', 'foie_gras',
+    'french_fries', 'french_onion_soup', 'french_toast', 'fried_calamari', 'fried_rice',
+    'frozen_yogurt', 'garlic_bread', 'gnocchi', 'greek_salad', 'grilled_cheese_sandwich',
+    'grilled_salmon', 'guacamole', 'gyoza', 'hamburger', 'hot_and_sour_soup',
+    'hot_dog', 'huevos_rancheros', 'hummus', 'ice_cream', 'lasagna',
+    'lobster_bisque', 'lobster_roll_sandwich', 'macaroni_and_cheese', 'macarons', 'miso_soup',
+    'mussels', 'nachos', 'omelette', 'onion_rings', 'oysters',
+    'pad_thai', 'paella', 'pancakes', 'panna_cotta', 'peking_duck',
+    'pho', 'pizza', 'pork_chop', 'poutine', 'prime_rib',
+    'pulled_pork_sandwich', 'ramen', 'ravioli', 'red_velvet_cake', 'risotto',
+    'samosa', 'sashimi', 'scallops', 'seaweed_salad', 'shrimp_and_grits',
+    'spaghetti_bolognese', 'spaghetti_carbonara', 'spring_rolls', 'steak', 'strawberry_shortcake',
+    'sushi', 'tacos', 'takoyaki', 'tiramisu', 'tuna_tartare',
+    'waffles'
+]
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(1,1,3)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(1,1,3)
+
+def load_classes(file_name):
+    """ Read class names from a file with one name per line, such as `meta/classes.txt` of the Food-101 dataset.
+    """
+    with open(file_name, 'r') as f:
+        return [line.strip() for line in f if line.strip() != '']
+
+def preprocess(img, size=224, resize=256):
+    """ Scale a PIL image so that its shorter side is `resize` pixels, crop the `size` by `size` center, and normalize it as the torchvision models expect.
+    This is the usual evaluation transform of torchvision classifiers (`Resize(resize)`, `CenterCrop(size)`, `ToTensor()`, `Normalize(...)`).
+    Returns:
+        A float32 array of shape (3, size, size).
+    """
+    img = img.convert('RGB')
+    scale = resize/min(img.size)
+    width,height = max(round(img.size[0]*scale), size), max(round(img.size[1]*scale), size)
+    img = img.resize((width,height), Image.BILINEAR)
+    left,top = (width-size)//2, (height-size)//2
+    img = img.crop((left, top, left+size, top+size))
+    pixels = (np.asarray(img, dtype=np.float32)/255 - MEAN)/STD
+    return pixels.transpose(2,0,1)
+
+class Food101Model:
+    """ Torchvision classifier fine-tuned on Food-101, loaded once from a checkpoint.
+    The checkpoint holds either the model's state dict, or a dictionary with the state dict under 'model'. Without a checkpoint, the weights are left untrained, which is only useful for benchmarks.
+    Photos are preprocessed with `preprocess`, and the outputs are named after `classes`, a file listing one class per line in the order used for training, or the Food-101 classes in alphabetical order if it isn't given. `benchmarks/prediction_parity.py` checks that the predictions match those of `tracker_data`'s training code for a checkpoint.
+    For faster inference on the CPU, `quantize` runs the whole network, convolutions included, in int8 with static quantization (fbgemm backend), and `channels_last` stores the weights and inputs in NHWC order. The number of threads torch uses is a setting of the whole process, so it is set once by `PREDICTION_TORCH_THREADS` rather than per model.
+    Static quantization needs `calibration` photos, either PIL images or a directory of photos, to choose the scale of each layer's activations. They should look like the photos the model is used on. Only the architectures in `torchvision.models.quantization` can be quantized.
+    """
+    def __init__(self, checkpoint, arch='resnet18', top_k=5, classes=None, size=224, resize=256,
+            quantize=False, calibration=None, calibration_count=100, channels_last=False):
+        self.top_k = top_k
+        self.size = size
+        self.resize = resize
+        self.channels_last = channels_last
+        self.classes = load_classes(classes) if classes is not None else FOOD101_CLASSES
+        if quantize:
+            # Same weights as the regular model, with quantization stubs and fusable modules
+            self.model = getattr(torchvision.models.quantization, arch)(num_classes=len(self.classes), quantize=False)
+        else:
+            self.model = getattr(torchvision.models, arch)(num_classes=len(self.classes))
+        if checkpoint is not None:
+            state = torch.load(checkpoint, map_location='cpu')
+            if 'model' in state:
+                state = state['model']
+            # Checkpoints saved from `nn.DataParallel` prefix every key with 'module.'
+            state = dict([(k[len('module.'):] if k.startswith('module.') else k, v) for k,v in state.items()])
+            self.model.load_state_dict(state)
+        self.model.eval()
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        if quantize:
+            self.quantize(calibration, calibration_count)
+            # Everything but the final classification layer, between the stubs converting to and from int8
+            children = [m for name,m in self.model.named_children() if name not in ('quant', 'dequant')]
+            self.features = torch.nn.Sequential(self.model.quant, *children[:-1], self.model.dequant)
+        else:
+            # Everything but the final classification layer
+            self.features = torch.nn.Sequential(*list(self.model.children())[:-1])
+
+    def quantize(self, calibration, calibration_count):
+        """ Convert the model to int8 with static quantization, observing the activations on the calibration photos.
+        """
+        if calibration is None:
+            raise ValueError('Quantized models need calibration photos.')
+        if isinstance(calibration, str):
+            images = []
+            for file_name in sorted(os.listdir(calibration))[:calibration_count]:
+                with Image.open(os.path.join(calibration, file_name)) as img:
+                    images.append(img.convert('RGB'))
+            calibration = images
+        torch.backends.quantized.engine = 'fbgemm'
+        self.model.fuse_model()
+        self.model.qconfig = torch.quantization.get_default_qconfig('fbgemm')
+        torch.quantization.prepare(self.model, inplace=True)
+        with torch.no_grad():
+            for i in range(0, len(calibration), 16):
+                batch = np.stack([self.preprocess(img) for img in calibration[i:i+16]])
+                self.model(self.to_tensor(batch))
+        torch.quantization.convert(self.model, inplace=True)
+
+    @classmethod
+    def from_config(cls, config):
+        if 'threads' in config:
+            raise ValueError('Torch threads are set for the whole process with PREDICTION_TORCH_THREADS, not per model.')
+        return cls(config['checkpoint'],
+                arch=config.get('arch', 'resnet18'),
+                top_k=config.get('top_k', 5),
+                classes=config.get('classes'),
+                size=config.get('size', 224),
+                resize=config.get('resize', 256),
+                quantize=config.get('quantize', False),
+                calibration=config.get('calibration'),
+                calibration_count=config.get('calibration_count', 100),
+                channels_last=config.get('channels_last', False))
+
+    def to_tensor(self, batch):
+        x = torch.from_numpy(batch)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def forward(self, batch):
+        """ Run the model on a batch of preprocessed images.
+        Args:
+            batch: float32 array of shape (N, 3, H, W).
+        Returns:
+            Class probabilities as an array of shape (N, number of classes).
+        """
+        with torch.no_grad():
+            scores = self.model(self.to_tensor(batch))
+            return torch.nn.functional.softmax(scores, dim=1).numpy()
+
+    def embed(self, batch):
+        """ Return the penultimate layer features of a batch of preprocessed images, as an array of shape (N, number of features).
+        """
+        with torch.no_grad():
+            return torch.flatten(self.features(self.to_tensor(batch)), 1).numpy()
+
+    def preprocess(self, img):
+        return preprocess(img, self.size, self.resize)
+
+    def postprocess(self, probabilities):
+        """ Return the `top_k` most likely foods for each row of class probabilities, as lists of (name, probability) tuples, most likely first.
+        """
+        top = np.argsort(-probabilities, axis=1)[:,:self.top_k]
+        return [
+            [(self.classes[i], float(p[i])) for i in indices]
+            for p,indices in zip(probabilities,top)
+        ]
+
+    def predict(self, images):
+        """ Return the `top_k` most likely foods in each PIL image.
+        """
+        return self.postprocess(self.forward(np.stack([self.preprocess(img) for img in images])))
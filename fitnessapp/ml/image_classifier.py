@@ -1,8 +1,15 @@
-import torch
-import torchvision
-import torchvision.models as models
-from PIL import Image
+""" ImageNet classifier used to tell whether a photo contains food, and which of the ImageNet food classes it is.
+
+Usage: python -m fitnessapp.ml.image_classifier DIRECTORY --checkpoint FILE [--arch ARCH] [--batch-size N] [--workers N] [--top-k K]
+
+The checkpoint is the state dict of a torchvision ImageNet model of the given architecture, such as the file torchvision downloads for `resnet18(pretrained=True)`. Weights are never downloaded at runtime.
+"""
+import argparse
+import os
+import threading
+
 import numpy as np
+from PIL import Image
 
 food_classes = {
     440: 'beer bottle',
@@ -61,32 +68,140 @@ food_classes = {
     987: 'corn'
 }
 
-#inception = models.inception_v3(pretrained=True)
-resnet = models.resnet18(pretrained=True)
-resnet.eval()
-
-n = 299
-n = 224
-#file_name = '/home/howardh/data/uploads/Cat03.jpg'
-#file_name = '/home/howardh/data/uploads/875806_R.jpg'
-file_name = '/home/howardh/data/uploads/Eq_it-na_pizza-margherita_sep2005_sml.jpg'
-img = Image.open(file_name)
-img = img.resize((n,n))
-img = np.array(img)/255
-normalize = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-img = normalize(torch.from_numpy(img))
-img = img.permute([2,0,1]).view(-1,3,n,n).float()
-#x = inception(torch.cat([img,img],dim=0))
-x = resnet(img)
-scores = x[0].detach().numpy()
-indices = np.argsort(scores) # Descending order, so look at the last entry
-top_5 = indices[-5:]
-
-for i in top_5:
-    if i in food_classes:
-        print(food_classes[i])
-        break
-else:
-    print('None found')
+FOOD_CLASS_MASK = np.zeros(1000, dtype=bool)
+FOOD_CLASS_MASK[list(food_classes.keys())] = True
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+def load_image(file_name, size=224):
+    """ Read an image file and resize it to the classifier's input size.
+    Returns:
+        A uint8 array of shape (size, size, 3).
+    """
+    with Image.open(file_name) as img:
+        return np.asarray(img.convert('RGB').resize((size,size)), dtype=np.uint8)
+
+def preprocess_batch(images):
+    """ Normalize a batch of images as the torchvision models expect, in a single pass over the whole batch.
+    Args:
+        images: uint8 array of shape (N, H, W, 3).
+    Returns:
+        A float32 array of shape (N, 3, H, W).
+    """
+    batch = (images.astype(np.float32)/255 - MEAN)/STD
+    return np.ascontiguousarray(batch.transpose(0,3,1,2))
+
+class FoodImageClassifier:
+    """ Pretrained ImageNet classifier whose predictions are restricted to `food_classes`.
+    The model is only created, and its weights loaded from `checkpoint`, the first time it is used.
+    """
+    def __init__(self, checkpoint, arch='resnet18', size=224, top_k=5):
+        self.checkpoint = checkpoint
+        self.arch = arch
+        self.size = size
+        self.top_k = top_k
+        self.model = None
+        self.lock = threading.Lock()
+
+    def get_model(self):
+        with self.lock:
+            if self.model is None:
+                import torch
+                import torchvision
+                model = getattr(torchvision.models, self.arch)()
+                model.load_state_dict(torch.load(self.checkpoint, map_location='cpu'))
+                model.eval()
+                self.model = model
+            return self.model
+
+    def scores(self, batch):
+        """ Return the ImageNet class scores of a batch of preprocessed images.
+        """
+        import torch
+        model = self.get_model()
+        with torch.no_grad():
+            return model(torch.from_numpy(batch)).numpy()
+
+    def food_classes_from_scores(self, scores):
+        """ For each row of class scores, return the index of the highest-scoring food class among the `top_k` highest-scoring classes, or -1 if none of them are food.
+        """
+        top = np.argsort(-scores, axis=1)[:,:self.top_k]
+        is_food = FOOD_CLASS_MASK[top]
+        first_food = is_food.argmax(axis=1)
+        indices = top[np.arange(len(top)), first_food]
+        return np.where(is_food.any(axis=1), indices, -1)
+
+    def classify(self, images):
+        """ Return the name of the food class found in each PIL image, or None if it doesn't look like food.
+        """
+        batch = np.stack([np.asarray(img.convert('RGB').resize((self.size,self.size)), dtype=np.uint8) for img in images])
+        return self.classify_batch(batch)
+
+    def classify_batch(self, images):
+        """ Same as `classify`, for an array of already-resized uint8 images of shape (N, H, W, 3).
+        """
+        indices = self.food_classes_from_scores(self.scores(preprocess_batch(images)))
+        return [food_classes[i] if i >= 0 else None for i in indices]
+
+class ImageFolder:
+    """ Dataset of the image files in a directory, resized for the classifier.
+    Files that can't be read as images are returned as None.
+    """
+    def __init__(self, directory, size=224):
+        self.size = size
+        self.file_names = sorted([
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, f))
+        ])
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getitem__(self, index):
+        file_name = self.file_names[index]
+        try:
+            return file_name, load_image(file_name, self.size)
+        except Exception:
+            return file_name, None
+
+def collate(items):
+    """ Combine dataset items into a list of file names that couldn't be read, a list of file names that could, and their images stacked into one array.
+    """
+    failed = [f for f,img in items if img is None]
+    items = [(f,img) for f,img in items if img is not None]
+    if len(items) == 0:
+        return failed, [], None
+    return failed, [f for f,_ in items], np.stack([img for _,img in items])
+
+def classify_directory(directory, classifier, batch_size=32, workers=4):
+    """ Classify every image file in a directory. Images are read and resized by `workers` background processes, which keep the next batches ready while the current one runs through the model.
+    Yields:
+        (file name, food class name or None) tuples. Files that couldn't be read are also given None.
+    """
+    from torch.utils.data import DataLoader
+    loader = DataLoader(ImageFolder(directory, classifier.size),
+            batch_size=batch_size, num_workers=workers, collate_fn=collate)
+    for failed,file_names,images in loader:
+        for file_name in failed:
+            yield file_name, None
+        if images is None:
+            continue
+        for file_name,name in zip(file_names, classifier.classify_batch(images)):
+            yield file_name, name
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', type=str, help='Directory of photos to classify')
+    parser.add_argument('--checkpoint', type=str, required=True, help='State dict of a torchvision ImageNet model')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=4, help='Processes reading and resizing photos')
+    parser.add_argument('--top-k', type=int, default=5, help='Number of top ImageNet classes in which to look for a food class')
+    parser.add_argument('--arch', type=str, default='resnet18')
+    args = parser.parse_args()
+
+    classifier = FoodImageClassifier(args.checkpoint, arch=args.arch, top_k=args.top_k)
+    for file_name,name in classify_directory(args.directory, classifier, args.batch_size, args.workers):
+        print('%s\t%s' % (file_name, name if name is not None else 'None found'))
 
 # See https://discuss.pytorch.org/t/pretrained-resnet-constant-output/2760/8
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import threading
+import traceback
+
+import numpy as np
+from flask import current_app as app
+
+from fitnessapp.ml.batching import BatchScheduler, SchedulerClosed
+
+def load_food101(config):
+    from fitnessapp.ml import food101
+    return food101.Food101Model.from_config(config)
+
+LOADERS = {
+    'food101': load_food101
+}
+
+class ModelRegistry:
+    """ Prediction models held in memory by this process, keyed by version, so that each checkpoint is only loaded once.
+    Models are loaded on first use, or ahead of time with `warmup`. When more than `max_models` are loaded, the least recently used one is dropped.
+    If `batching` is given, concurrent predictions with the same model are run together in batches (see `BatchScheduler`).
+    """
+    def __init__(self, models, default_version, max_models=2, batching=None, timeout=None):
+        """
+        Args:
+            models: dictionary mapping each version to its config, a dictionary with the name of its loader under 'type' and the loader's own settings.
+            batching: dictionary of `max_batch_size` and `max_wait` for the `BatchScheduler` of each model, or None to run every prediction separately.
+            timeout: seconds to wait for a batched prediction before raising `concurrent.futures.TimeoutError`, or None to wait indefinitely.
+        """
+        self.models = models
+        self.default_version = default_version
+        self.max_models = max_models
+        self.batching = batching
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.loaded = OrderedDict() # version -> model, least recently used first
+        self.schedulers = {} # version -> batch scheduler of the loaded model
+        self.load_locks = {} # version -> lock held while that version is loading
+
+    def get(self, version=None):
+        """ Return the model of the given version, loading it if needed.
+        """
+        if version is None:
+            version = self.default_version
+        if version not in self.models:
+            raise KeyError('Unknown model version %s.' % version)
+        with self.lock:
+            if version in self.loaded:
+                self.loaded.move_to_end(version)
+                return self.loaded[version]
+            load_lock = self.load_locks.setdefault(version, threading.Lock())
+        # Load outside of the main lock so that requests for other models aren't blocked, but only once per version
+        with load_lock:
+            with self.lock:
+                if version in self.loaded:
+                    self.loaded.move_to_end(version)
+                    return self.loaded[version]
+            config = self.models[version]
+            model = LOADERS[config['type']](config)
+            with self.lock:
+                self.loaded[version] = model
+                if self.batching is not None:
+                    self.schedulers[version] = BatchScheduler(model.forward, **self.batching)
+                while len(self.loaded) > self.max_models:
+                    evicted,_ = self.loaded.popitem(last=False)
+                    if evicted in self.schedulers:
+                        self.schedulers.pop(evicted).close()
+            print('Loaded model', version)
+            return model
+
+    def predict(self, images, version=None):
+        """ Run the given PIL images through the model of the given version, and return its predictions for each.
+        """
+        model = self.get(version)
+        with self.lock:
+            scheduler = self.schedulers.get(version if version is not None else self.default_version)
+        if scheduler is None:
+            return model.predict(images)
+        # Preprocessing happens in the caller's thread, so only the forward pass is serialized
+        try:
+            futures = [scheduler.submit(model.preprocess(img)) for img in images]
+        except SchedulerClosed:
+            # The model was evicted in the meantime
+            return model.predict(images)
+        return model.postprocess(np.stack([f.result(timeout=self.timeout) for f in futures]))
+
+    def embed(self, images, version=None):
+        """ Return the visual embeddings of the given PIL images computed by the model of the given version, as an array with one row per image.
+        """
+        model = self.get(version)
+        return model.embed(np.stack([model.preprocess(img) for img in images]))
+
+    def warmup(self, versions):
+        """ Load the given models now rather than on the first prediction.
+        """
+        for version in versions:
+            try:
+                self.get(version)
+            except Exception:
+                print(traceback.format_exc())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'loaded': list(self.loaded.keys()),
+                'max_models': self.max_models,
+                'batching': dict([(v,s.stats()) for v,s in self.schedulers.items()])
+            }
+
+registry = None
+registry_lock = threading.Lock()
+
+def get_registry():
+    """ Return the model registry of this process, configured from the `PREDICTION_*` config values on first use.
+    """
+    global registry
+    with registry_lock:
+        if registry is None:
+            threads = app.config.get('PREDICTION_TORCH_THREADS')
+            if threads is not None:
+                import torch
+                torch.set_num_threads(threads)
+            batching = None
+            if app.config.get('PREDICTION_BATCHING', False):
+                batching = {
+                    'max_batch_size': app.config.get('PREDICTION_MAX_BATCH_SIZE', 8),
+                    'max_wait': app.config.get('PREDICTION_MAX_WAIT', 0.005)
+                }
+            registry = ModelRegistry(
+                    app.config.get('PREDICTION_MODELS', {}),
+                    app.config.get('PREDICTION_MODEL_VERSION'),
+                    max_models=app.config.get('PREDICTION_MAX_MODELS', 2),
+                    batching=batching,
+                    timeout=app.config.get('PREDICTION_TIMEOUT', 10))
+        return registry
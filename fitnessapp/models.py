@@ -0,0 +1,94 @@
+import sqlalchemy
+from sqlalchemy import Column, Integer, BigInteger, Date, DateTime, Numeric, Float, String, ForeignKey
+
+from tracker_database import Food, Photo
+
+from fitnessapp.extensions import db
+
+class FoodDailySummary(db.Model):
+    """ Nutrition consumed by a user on a given day.
+    Maintained by `dbutils.update_food_daily_summary` whenever food entries change. Children of an entry are only counted when the parent has no value of its own.
+    """
+    __tablename__ = 'food_daily_summary'
+    user_id = Column(Integer, primary_key=True)
+    date = Column(Date, primary_key=True)
+    calories = Column(Numeric)
+    protein = Column(Numeric)
+
+class FoodDayVersion(db.Model):
+    """ Counter incremented every time a user's food entries on a given day change.
+    Used as the ETag of the day's entries. Maintained by `dbutils.bump_food_day_versions`.
+    """
+    __tablename__ = 'food_day_version'
+    user_id = Column(Integer, primary_key=True)
+    date = Column(Date, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class FoodVersion(db.Model):
+    """ Counter incremented every time any of a user's food entries change.
+    Cached food search results are tagged with it, so that changes made by any process make them stale. Maintained by `dbutils.bump_food_day_versions`.
+    """
+    __tablename__ = 'food_version'
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class FoodQuantity(db.Model):
+    """ Numeric value and units parsed from a food entry's quantity string.
+    Written alongside the food entry by `dbutils.update_food_from_dict`, so that nutrition can be aggregated per unit in SQL.
+    """
+    __tablename__ = 'food_quantity'
+    food_id = Column(Integer, ForeignKey(Food.__table__.c.id, ondelete='CASCADE'), primary_key=True)
+    value = Column(Float)
+    unit = Column(String, index=True)
+
+class PhotoJob(db.Model):
+    """ Background processing of an uploaded photo.
+    Status is one of 'pending', 'processing', 'done' or 'failed'.
+    """
+    __tablename__ = 'photo_job'
+    id = Column(Integer, primary_key=True)
+    photo_id = Column(Integer, ForeignKey(Photo.__table__.c.id, ondelete='CASCADE'), nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default='pending', index=True)
+    error = Column(String)
+    created = Column(DateTime, nullable=False)
+    updated = Column(DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'photo_id': self.photo_id,
+            'status': self.status,
+            'error': self.error,
+            'created': str(self.created) if self.created is not None else None,
+            'updated': str(self.updated) if self.updated is not None else None
+        }
+
+class PhotoHash(db.Model):
+    """ Perceptual hash (dHash) of a photo, used to find near-duplicate and similar photos.
+    The unsigned 64 bit hash is stored as a signed integer, see `photohash.to_signed`.
+    """
+    __tablename__ = 'photo_hash'
+    photo_id = Column(Integer, ForeignKey(Photo.__table__.c.id, ondelete='CASCADE'), primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    hash = Column(BigInteger, nullable=False)
+
+def create_tables():
+    """ Create the tables defined in this module, along with the indexes this app relies on, if they don't already exist.
+    """
+    tables = [
+        FoodDailySummary.__table__,
+        FoodQuantity.__table__,
+        FoodDayVersion.__table__,
+        FoodVersion.__table__,
+        PhotoJob.__table__,
+        PhotoHash.__table__
+    ]
+    db.metadata.create_all(bind=db.engine, tables=tables)
+    # Index for paging through a user's food history by date
+    db.session.execute(sqlalchemy.text(
+        'CREATE INDEX IF NOT EXISTS {table}_user_id_date_id_idx ON {table} (user_id, date DESC, id DESC)'.format(
+            table=Food.__table__.name
+        )
+    ))
+    db.session.commit()
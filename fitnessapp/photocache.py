@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+from flask import current_app as app
+
+TEMP_PREFIX = '.tmp-'
+LOCK_FILE = '.lock'
+USAGE_FILE = '.usage'
+COUNTERS = ['hits', 'misses', 'evictions']
+
+class DerivativeCache:
+    """ Directory of resized photos that stays within a byte budget by evicting the least recently used files.
+    The directory is shared by every process of the app, and is its own index: the modification time of a file is updated whenever it is read, and is used as its last use. The total size is kept in a usage file that processes update under a file lock. When it goes over the budget, the directory is scanned, which also corrects the total, and the oldest files are deleted until it is below `low_water` of the budget.
+    Hits, misses and evictions are counted in memory, and added to the totals in the usage file whenever a process writes to it.
+    Files are written to a temporary file and renamed into place, so readers never see a partially written file. `get` returns an open file, which stays readable even if another process evicts it.
+    """
+    def __init__(self, directory, max_bytes, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        # Counted since they were last added to the usage file
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    @contextmanager
+    def locked(self):
+        """ Hold the lock shared by all processes using the directory.
+        """
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def get(self, key):
+        """ Return an open binary file with the cached data for `key`, or None if it isn't cached.
+        """
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(f.fileno())
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return f
+
+    def put(self, key, data):
+        """ Store `data` under `key` and return the path of the cached file.
+        """
+        fd,temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with self.locked():
+                try:
+                    replaced = os.path.getsize(self.path(key))
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(temp_path, self.path(key))
+                usage = self._read_usage()
+                if usage['bytes'] is None:
+                    usage['bytes'] = self._evict()
+                else:
+                    usage['bytes'] += len(data)-replaced
+                    if usage['bytes'] > self.max_bytes:
+                        usage['bytes'] = self._evict(keep=key)
+                self._write_usage(usage)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.path(key)
+
+    def _read_usage(self):
+        """ Return the contents of the usage file: the total size of the files in bytes, or None if it is unknown, and the counters of all processes. Must be called with the lock held.
+        """
+        try:
+            with open(os.path.join(self.directory, USAGE_FILE), 'r') as f:
+                usage = json.load(f)
+        except (FileNotFoundError, ValueError):
+            usage = None
+        if not isinstance(usage, dict):
+            usage = {'bytes': None}
+        for name in COUNTERS:
+            usage[name] = usage.get(name, 0)
+        return usage
+
+    def _write_usage(self, usage):
+        """ Write the usage file, adding this process's counters to it. Must be called with the lock held.
+        """
+        with self.lock:
+            for name in COUNTERS:
+                usage[name] += getattr(self, name)
+                setattr(self, name, 0)
+        with open(os.path.join(self.directory, USAGE_FILE), 'w') as f:
+            json.dump(usage, f)
+
+    def _scan(self):
+        """ Return a list of (last use, key, size in bytes) tuples for every cached file, least recently used first.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        return files
+
+    def _evict(self, keep=None):
+        """ Delete the least recently used files until the directory is below `low_water` of the budget. Must be called with the lock held.
+        Returns:
+            The total size of the remaining files.
+        """
+        files = self._scan()
+        total = sum([size for _,_,size in files])
+        if total <= self.max_bytes:
+            return total
+        for _,key,size in files:
+            if total <= self.max_bytes*self.low_water:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self.lock:
+                self.evictions += 1
+        return total
+
+    def stats(self):
+        """ Return the size of the cache and the counters of every process using it, for monitoring.
+        """
+        with self.locked():
+            usage = self._read_usage()
+            if usage['bytes'] is None:
+                usage['bytes'] = sum([size for _,_,size in self._scan()])
+            self._write_usage(usage)
+        usage['max_bytes'] = self.max_bytes
+        return usage
+
+caches = {}
+caches_lock = threading.Lock()
+
+def get_cache():
+    """ Return the derivative cache configured for the current app.
+    """
+    directory = app.config.get('PHOTO_CACHE_FOLDER')
+    if directory is None:
+        directory = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
+    with caches_lock:
+        if directory not in caches:
+            caches[directory] = DerivativeCache(
+                    directory, app.config.get('PHOTO_CACHE_MAX_BYTES', 1024*1024*1024))
+        return caches[directory]
@@ -0,0 +1,123 @@
+from sqlalchemy.dialects.postgresql import insert
+
+from fitnessapp.extensions import db
+from fitnessapp.models import PhotoHash
+from fitnessapp.usercache import UserCache
+
+def to_signed(h):
+    """ Convert an unsigned 64 bit hash to the signed value stored in the database.
+    """
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def to_unsigned(h):
+    return h + (1 << 64) if h < 0 else h
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """ BK-tree of perceptual hashes under the Hamming distance.
+    Searches only visit the subtrees that can contain a hash within the given distance, by the triangle inequality, rather than comparing against every hash.
+    """
+    def __init__(self):
+        self.root = None # [hash, list of keys, dictionary of distance -> child node]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, h, key):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [key], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [key], {}]
+                return
+            node = child
+
+    def search(self, h, max_distance):
+        """ Return a list of (distance, key) tuples for all hashes within `max_distance` of `h`, closest first.
+        """
+        if self.root is None:
+            return []
+        results = []
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= max_distance:
+                results += [(d,k) for k in node[1]]
+            for child_distance,child in node[2].items():
+                if d-max_distance <= child_distance <= d+max_distance:
+                    stack.append(child)
+        results.sort(key=lambda x: x[0])
+        return results
+
+def load_tree(user_id):
+    """ Build a tree of the hashes of all of the given user's photos, keyed by photo ID.
+    """
+    hashes = db.session.query(PhotoHash) \
+            .with_entities(PhotoHash.photo_id, PhotoHash.hash) \
+            .filter_by(user_id=user_id) \
+            .all()
+    tree = BKTree()
+    for photo_id,h in hashes:
+        tree.add(to_unsigned(h), photo_id)
+    return tree
+
+def save_hashes(user_id, hashes):
+    """ Store the hashes of the given photos, replacing any existing ones. Changes are not committed.
+    Args:
+        hashes: list of (photo id, unsigned hash) tuples.
+    """
+    if len(hashes) == 0:
+        return
+    stmt = insert(PhotoHash.__table__).values([
+        {'photo_id': photo_id, 'user_id': user_id, 'hash': to_signed(h)}
+        for photo_id,h in hashes
+    ])
+    stmt = stmt.on_conflict_do_update(
+            index_elements=[PhotoHash.photo_id],
+            set_={'user_id': stmt.excluded.user_id, 'hash': stmt.excluded.hash})
+    db.session.execute(stmt)
+    index.add(user_id, hashes)
+
+class HashIndex:
+    """ Per-process collection of photo hash trees, one per user.
+    Trees are built lazily and the least recently used ones are evicted. Hashes of photos uploaded through this process are added to its trees directly. Deleting photos drops the user's tree so that it gets rebuilt, and trees older than `max_age` seconds are rebuilt to pick up changes made by other processes.
+    """
+    def __init__(self, max_users=200, max_age=600):
+        self.trees = UserCache(load_tree, max_users=max_users, max_age=max_age)
+
+    def search(self, user_id, h, max_distance):
+        """ Return a list of (distance, photo id) tuples for the user's photos whose hash is within `max_distance` of `h`, closest first.
+        """
+        tree = self.trees.get(user_id)
+        # Trees are modified in place by `add`
+        with self.trees.lock:
+            return tree.search(h, max_distance)
+
+    def add(self, user_id, hashes):
+        """ Record the hashes of new photos in the user's tree, if it is loaded.
+        Args:
+            hashes: list of (photo id, unsigned hash) tuples.
+        """
+        def add(tree):
+            for photo_id,h in hashes:
+                tree.add(h, photo_id)
+        self.trees.update(user_id, add)
+
+    def invalidate(self, user_id):
+        """ Drop the user's tree so that it is rebuilt on the next lookup.
+        """
+        self.trees.invalidate(user_id)
+
+index = HashIndex()
@@ -18,9 +18,10 @@ import numpy as np
 import os
 import boto3
 
-from fitnessapp import dbutils
+from fitnessapp import dbutils, autocomplete
 from fitnessapp.extensions import db
 from tracker_database import Food, Photo
+from fitnessapp.models import FoodDailySummary
 
 import tracker_data
 
@@ -61,10 +62,19 @@ class FoodEndpoint(Resource):
                 type: integer
         responses:
           200:
-            description: Food entry
+            description: All food entries on the same date as this entry. The `ETag` header changes whenever any of them change.
             schema:
               $ref: '#/definitions/Food'
+          304:
+            description: The entries match the ETag given in `If-None-Match`.
         """
+        etag = dbutils.food_entry_etag(current_user.get_id(), food_id)
+        if etag is None:
+            return {
+                'error': 'Unable to find food entry with ID %d.' % food_id
+            }, 404
+        if request.if_none_match.contains_raw(etag):
+            return '', 304, {'ETag': etag}
         food = db.session.query(Food) \
                 .filter_by(user_id=current_user.get_id()) \
                 .filter_by(id=food_id) \
@@ -75,12 +85,12 @@ class FoodEndpoint(Resource):
                 .order_by(Food.date.desc()) \
                 .order_by(Food.id) \
                 .all()
-        data = dict([(f.id,dbutils.food_to_dict(f)) for f in foods])
+        data = dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods)))
         return {
             'entities': {
                 'food': data
             }
-        }, 200
+        }, 200, {'ETag': etag, 'Cache-Control': 'private, no-cache'}
 
     @login_required
     def put(self, food_id):
@@ -117,7 +127,7 @@ class FoodEndpoint(Resource):
         return {
             'message': 'success',
             'entities': {
-                'food': dict([(f.id,dbutils.food_to_dict(f)) for f in changed_entities])
+                'food': dict(zip([f.id for f in changed_entities], dbutils.foods_to_dict(changed_entities)))
             }
         }, 200
 
@@ -147,26 +157,19 @@ class FoodEndpoint(Resource):
                   type: string
         """
         print("Requesting to delete entry %s." % food_id)
-        f = db.session.query(Food) \
-                .filter_by(id=food_id) \
-                .filter_by(user_id=current_user.get_id()) \
-                .first()
+        deleted_ids, photo_ids = dbutils.delete_food_trees(
+                [food_id], user_id=current_user.get_id())
 
-        if f is None:
+        if len(deleted_ids) == 0:
             return {
                 "error": "Unable to find food entry with ID %d." % food_id
             }, 404
 
-        # Check for photos referencing this food item
-        photos = db.session.query(Photo) \
-                .filter_by(food_id=food_id) \
-                .filter_by(user_id=current_user.get_id()) \
-                .all()
-        for p in photos:
-            p.food_id = None
-        db.session.flush()
-
-        deleted_ids = dbutils.delete_food(f)
+        photos = []
+        if len(photo_ids) > 0:
+            photos = db.session.query(Photo) \
+                    .filter(Photo.id.in_(photo_ids)) \
+                    .all()
         return {
             "message": "Deleted successfully",
             "entities": {
@@ -179,6 +182,7 @@ class FoodList(Resource):
     @login_required
     def get(self):
         """ Return all food entries matching the given criteria.
+        If a date is given, all entries on that date are returned. Otherwise, top-level entries are returned most recent first, followed by those without a date. If `limit` or `cursor` is given, they are returned a page at a time, leaving out entries without a date.
         ---
         tags:
           - food
@@ -186,38 +190,102 @@ class FoodList(Resource):
           - name: date
             in: query
             type: string
-            required: true
+            required: false
             format: date
             description: Date
+          - name: start_date
+            in: query
+            type: string
+            required: false
+            format: date
+            description: Earliest date to include when paginating.
+          - name: end_date
+            in: query
+            type: string
+            required: false
+            format: date
+            description: Latest date to include when paginating.
+          - name: cursor
+            in: query
+            type: string
+            required: false
+            description: Value of `next_cursor` from the previous page.
+          - name: limit
+            in: query
+            type: integer
+            required: false
+            description: Number of entries per page, up to 200. Defaults to 50 if a cursor is given.
         responses:
           200:
             description: A list of food entries.
             schema:
-              type: array
-              items:
-                $ref: '#/definitions/Food'
+              type: object
+              properties:
+                entities:
+                  type: object
+                next_cursor:
+                  type: string
+                  description: Cursor for the next page, or null if there are no more entries.
+          304:
+            description: A date was given and its entries match the ETag given in `If-None-Match`.
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
         """
         date = request.args.get('date')
         if date is None:
-            foods = db.session.query(Food) \
-                    .filter_by(user_id=current_user.get_id()) \
-                    .filter(Food.parent_id.is_(None)) \
-                    .order_by(Food.id) \
-                    .all()
-        else:
-            foods = db.session.query(Food) \
-                    .order_by(Food.date.desc()) \
-                    .filter_by(user_id=current_user.get_id()) \
-                    .filter_by(date=date) \
-                    .order_by(Food.id) \
-                    .all()
-            print(len(foods), 'entries found')
-        data = dict([(f.id,dbutils.food_to_dict(f)) for f in foods])
+            limit = request.args.get('limit')
+            if limit is not None:
+                try:
+                    limit = min(max(int(limit), 1), 200)
+                except ValueError:
+                    return {
+                        'error': 'Invalid request. The limit must be an integer.'
+                    }, 400
+            try:
+                foods, next_cursor = dbutils.list_food_page(
+                        current_user.get_id(),
+                        start_date=request.args.get('start_date'),
+                        end_date=request.args.get('end_date'),
+                        cursor=request.args.get('cursor'),
+                        limit=limit)
+            except ValueError as e:
+                return {
+                    'error': str(e)
+                }, 400
+            data = dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods)))
+            return {
+                'entities': {
+                    'food': data
+                },
+                'next_cursor': next_cursor
+            }, 200
+
+        try:
+            dbutils.parse_date(date)
+        except ValueError as e:
+            return {
+                'error': str(e)
+            }, 400
+        etag = dbutils.food_day_etag(current_user.get_id(), date)
+        if request.if_none_match.contains_raw(etag):
+            return '', 304, {'ETag': etag}
+        foods = db.session.query(Food) \
+                .order_by(Food.date.desc()) \
+                .filter_by(user_id=current_user.get_id()) \
+                .filter_by(date=date) \
+                .order_by(Food.id) \
+                .all()
+        print(len(foods), 'entries found')
+        data = dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods)))
         return {
             'entities': {
                 'food': data
             }
-        }, 200
+        }, 200, {'ETag': etag, 'Cache-Control': 'private, no-cache'}
 
     @login_required
     def post(self):
@@ -263,15 +331,12 @@ class FoodList(Resource):
                         .filter(Food.id == data['parent_id']) \
                         .one()
                 foods.append(parent)
-            if 'photo_ids' in data and len(foods) == 1:
-                for pid in data['photo_ids']:
-                    photo = db.session.query(Photo) \
-                            .filter_by(user_id=current_user.get_id()) \
-                            .filter(Photo.id == pid) \
-                            .one()
-                    photo.food_id = foods[0].id
-                    updated_photos.append(photo)
-                db.session.flush()
+            if 'photo_ids' in data and len(data['photo_ids']) > 0:
+                # Photos were assigned by `update_food_from_dict`. Load them up to return them.
+                updated_photos = db.session.query(Photo) \
+                        .filter_by(user_id=current_user.get_id()) \
+                        .filter(Photo.id.in_(data['photo_ids'])) \
+                        .all()
         except Exception as e:
             print(traceback.format_exc())
             return {
@@ -280,7 +345,7 @@ class FoodList(Resource):
 
         return {
             'entities': {
-                'food': dict([(f.id, dbutils.food_to_dict(f)) for f in foods]),
+                'food': dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods))),
                 'photos': dict([(p.id, dbutils.photo_to_dict(p)) for p in updated_photos])
             }
         }, 201
@@ -313,18 +378,10 @@ class FoodList(Resource):
                   type: string
         """
         data = request.get_json()
-        deleted_ids = []
-        for d in data:
-            print("Requesting to delete entry %s." % d['id'])
-
-            food_id = d['id']
-            f = db.session.query(Food) \
-                    .filter_by(id=food_id) \
-                    .filter_by(user_id=current_user.get_id()) \
-                    .first()
-            if f is None:
-                continue
-            deleted_ids += dbutils.delete_food(f)
+        food_ids = [d['id'] for d in data]
+        print("Requesting to delete entries %s." % food_ids)
+        deleted_ids,_ = dbutils.delete_food_trees(
+                food_ids, user_id=current_user.get_id())
 
         return {
             "message": "Deleted successfully",
@@ -366,14 +423,64 @@ class FoodSearch(Resource):
         if 'q' not in request.args:
             return 'Invalid request. A query is required.', 400
         query = request.args['q']
+        results = dbutils.search_food(query, user_id=current_user.get_id())
         return {
-            'frequent': dbutils.search_food_frequent(query, user_id=current_user.get_id()),
-            'recent': dbutils.search_food_recent(query, user_id=current_user.get_id()),
-            'premade': dbutils.search_food_premade(query, user_id=current_user.get_id()),
+            'frequent': results['frequent'],
+            'recent': results['recent'],
+            'premade': results['premade'],
             'verified': [],
             'community': []
         }, 200
 
+class FoodAutocomplete(Resource):
+    @login_required
+    def get(self):
+        """ Suggest names of previously logged foods starting with the query string.
+        Names that were logged more often and more recently appear first. The search is case-insensitive.
+        ---
+        tags:
+          - food
+        parameters:
+          - name: q
+            in: query
+            type: string
+            required: true
+          - name: limit
+            in: query
+            type: integer
+            required: false
+            description: Maximum number of suggestions. Defaults to 5, up to 10.
+        responses:
+          200:
+            description: Food names
+            schema:
+              type: array
+              items:
+                type: object
+                properties:
+                  name:
+                    type: string
+                  count:
+                    type: number
+                    description: The number of times this name was logged.
+                  date:
+                    type: string
+                    description: The last date on which this name was logged.
+        """
+        if 'q' not in request.args:
+            return 'Invalid request. A query is required.', 400
+        query = request.args['q']
+        try:
+            limit = min(int(request.args.get('limit', 5)), 10)
+        except ValueError:
+            return 'Invalid request. The limit must be an integer.', 400
+        entries = autocomplete.index.complete(current_user.get_id(), query, limit)
+        return [{
+            'name': e['name'],
+            'count': e['count'],
+            'date': str(e['date']) if e['date'] is not None else None
+        } for e in entries], 200
+
 class FoodSummary(Resource):
     @login_required
     def get(self):
@@ -392,18 +499,15 @@ class FoodSummary(Resource):
                   description: A list of total calories consumed in the last week. The number at index 0 is today's Calorie consumption, 1 is yesterday, etc.
         """
         start_date = datetime.date.today()-datetime.timedelta(days=7)
-        foods = db.engine.execute("""
-            SELECT date, SUM(calories)
-            FROM public.food as t
-            WHERE date > '{start_date}'
-              AND user_id = '{user_id}'
-              AND (
-                parent_id IS NULL
-                OR (SELECT calories FROM public.food WHERE id=t.parent_id) IS NULL
-              )
-            GROUP BY date
-            ORDER BY date DESC
-        """.format(start_date=start_date, user_id=current_user.get_id()))
+        foods = db.session.query(FoodDailySummary) \
+                .with_entities(
+                        FoodDailySummary.date,
+                        FoodDailySummary.calories
+                )\
+                .filter_by(user_id=current_user.get_id()) \
+                .filter(FoodDailySummary.date > start_date) \
+                .order_by(FoodDailySummary.date.desc()) \
+                .all()
 
         # Save the data so we can iterate over it more than once
         foods = [x for x in foods]
@@ -445,8 +549,17 @@ class FoodAutogenerate(Resource):
         if 'date' not in request.args:
             return 'Invalid request. A date is required.', 400
         date = request.args['date']
-        dbutils.autogenerate_food_entry_for_date(date)
-        return 'Autogenerated entries successfully', 200
+        food_ids,remaining = dbutils.autogenerate_food_entry_for_date(date, current_user.get_id())
+        foods = db.session.query(Food) \
+                .filter(Food.id.in_(food_ids)) \
+                .all()
+        return {
+            'message': 'Autogenerated entries successfully',
+            'remaining_photos': remaining,
+            'entities': {
+                'food': dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods)))
+            }
+        }, 200
 
 class FoodPredict(Resource):
     @login_required
@@ -498,6 +611,7 @@ class NutritionSearch(Resource):
                   properties:
                     all:
                       type: array
+                      description: The ten most recent matching entries.
                       items:
                         type: object
                         properties:
@@ -536,6 +650,7 @@ class NutritionSearch(Resource):
 api.add_resource(FoodList, '/food')
 api.add_resource(FoodEndpoint, '/food/<int:food_id>')
 api.add_resource(FoodSearch, '/food/search')
+api.add_resource(FoodAutocomplete, '/food/autocomplete')
 api.add_resource(FoodSummary, '/food/summary')
 api.add_resource(FoodAutogenerate, '/food/autogenerate')
 api.add_resource(FoodPredict, '/food/predict')
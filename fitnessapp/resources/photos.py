@@ -1,4 +1,5 @@
-from flask import Blueprint, Response, send_file
+from flask import Blueprint, Response, send_file, redirect
+from flask import current_app as app
 from flask import request
 from flask_restful import Api, Resource
 from flask_login import login_required, current_user
@@ -6,13 +7,18 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
 from werkzeug import FileWrapper
 from werkzeug.utils import secure_filename
+from werkzeug.formparser import parse_form_data
 from flasgger import SwaggerView
 
+from concurrent.futures import TimeoutError
 import datetime
+import base64
+import os
 
-from fitnessapp import dbutils
+from fitnessapp import dbutils, jobs, imageutils, storage, photohash
 from tracker_database import Photo, Food
 from fitnessapp.extensions import db
+from fitnessapp.models import PhotoJob
 
 blueprint = Blueprint('photos', __name__)
 api = Api(blueprint)
@@ -90,6 +96,8 @@ class Photos(Resource):
             return {'error': 'No photo found with this ID.'}, 404
 
         if 'food_id' in data:
+            dbutils.bump_food_day_versions_for_foods(
+                    current_user.get_id(), [photo.food_id, data['food_id']])
             photo.food_id = data['food_id']
 
         db.session.flush()
@@ -202,14 +210,20 @@ class PhotoList(Resource):
             name: file
             type: file
             description: File to upload
+          - in: formData
+            name: reject_duplicates
+            type: boolean
+            description: If true, the upload is rejected if it looks almost identical to one of the user's existing photos.
         responses:
-          201:
-            description: ID of newly-created entry.
+          202:
+            description: Newly-created entry, and the job processing it. Resized versions of the photo are available once the job is done, and the date and time are filled in from the EXIF data if they weren't provided.
             schema:
               type: object
               properties:
-                id:
-                  type: integer
+                job:
+                  $ref: '#/definitions/PhotoJob'
+          409:
+            description: The photo is a near-duplicate of the existing photos returned, and `reject_duplicates` was set.
         """
         # check if the post request has the file part
         if 'file' not in request.files:
@@ -221,6 +235,24 @@ class PhotoList(Resource):
         if file.filename == '':
             return "No file name.", 400
         if file:
+            # Hash the photo before saving anything, so that duplicates can be rejected
+            try:
+                h = imageutils.dhash_from_bytes(file.read())
+            except Exception:
+                # Not a readable image. The processing job will report the error.
+                h = None
+            file.seek(0)
+            if h is not None and request.form.get('reject_duplicates', 'false').lower() in ('true', '1'):
+                duplicates = dbutils.find_duplicate_photos(current_user.get_id(), h,
+                        app.config.get('PHOTO_DUPLICATE_DISTANCE', 4))
+                if len(duplicates) > 0:
+                    return {
+                        'error': 'This photo is a near-duplicate of photo %d.' % duplicates[0].id,
+                        'entities': {
+                            'photos': dict([(p.id,dbutils.photo_to_dict(p)) for p in duplicates])
+                        }
+                    }, 409
+
             # Create food entry
             photo = Photo()
             photo.file_name = ""
@@ -232,33 +264,39 @@ class PhotoList(Resource):
                 photo.food_id = int(request.form.get('food_id'))
             except:
                 pass
+            if photo.food_id is not None:
+                try:
+                    dbutils.check_food_owner(photo.food_id, photo.user_id)
+                except ValueError as e:
+                    return {
+                        'error': str(e)
+                    }, 400
 
             db.session.add(photo)
             db.session.flush()
 
-            # Save photo
+            # Save the file as is. Resizing and reading EXIF data happens in the background.
             file_name = str(photo.id)
             photo.file_name = file_name
-            dbutils.save_photo_data(file, file_name=file_name, delete_local=False)
-            # Get EXIF data if needed
-            exif_data = dbutils.get_photo_exif(file_name)
-            if exif_data is not None:
-                if photo.time is None and 0x9003 in exif_data:
-                    photo.time = exif_data[0x9003].split(' ')[1]
-                if photo.date is None and 0x9003 in exif_data:
-                    photo.date = exif_data[0x9003].split(' ')[0].replace(':','-')
+            dbutils.save_photo_original(file, file_name=file_name)
+            job = jobs.create_photo_job(photo)
+            if h is not None:
+                photohash.save_hashes(photo.user_id, [(photo.id, h)])
+            dbutils.bump_food_day_versions_for_foods(photo.user_id, [photo.food_id])
             # Save file name
             db.session.flush()
             db.session.commit()
+            jobs.submit_photo_job(job.id)
 
             return {
-                'message': 'Photo uploaded successfully.',
+                'message': 'Photo uploaded successfully. Processing.',
+                'job': job.to_dict(),
                 'entities': {
                     'photos': {
                         photo.id: dbutils.photo_to_dict(photo)
                     }
                 }
-            }, 200
+            }, 202
 
     @login_required
     def delete(self):
@@ -293,6 +331,7 @@ class PhotoList(Resource):
         print(type(data))
         print(data)
         deleted_ids = []
+        file_names = []
         for d in data:
             print("Requesting to delete entry %s." % d['id'])
 
@@ -306,9 +345,11 @@ class PhotoList(Resource):
                 return {
                     "error": "Unable to find photo with ID %d." % photo_id
                 }, 404
+            file_names.append(p.file_name)
             dbutils.delete_photo(p, commit=False)
 
         db.session.commit()
+        dbutils.delete_photo_files(file_names)
         return {
             "message": "Deleted successfully",
             "entities": {
@@ -316,6 +357,206 @@ class PhotoList(Resource):
             }
         }, 200
 
+class PhotoBatch(Resource):
+    @login_required
+    def post(self):
+        """ Create a photo entry for each of several uploaded files.
+        Files are written to disk as they arrive rather than being held in memory.
+        ---
+        tags:
+          - photos
+        consumes:
+          - multipart/form-data
+        parameters:
+          - in: formData
+            name: date
+            type: string
+            description: Date on which the photos were taken
+          - in: formData
+            name: file
+            type: array
+            items:
+              type: file
+            collectionFormat: multi
+            description: Files to upload
+        responses:
+          202:
+            description: Newly-created entries, and the IDs of the jobs processing them, in the same order as the files.
+            schema:
+              type: object
+              properties:
+                job_ids:
+                  type: array
+                  items:
+                    type: integer
+          400:
+            description: No files provided, too many files, or the food entry given by `food_id` doesn't belong to the user.
+        """
+        max_files = app.config.get('PHOTO_BATCH_MAX_FILES', 50)
+        if jobs.run_inline():
+            # Every photo is processed before responding, which must fit in the request's time limit
+            max_files = min(max_files, app.config.get('PHOTO_BATCH_MAX_FILES_INLINE', 10))
+        # Parse the body ourselves so that files are streamed into the upload folder
+        _,form,files = parse_form_data(request.environ,
+                stream_factory=dbutils.upload_stream_factory,
+                max_content_length=app.config.get('MAX_CONTENT_LENGTH'))
+        def discard_files(files):
+            for f in files:
+                f.stream.close()
+                try:
+                    os.remove(f.stream.name)
+                except FileNotFoundError:
+                    pass
+        # Parts without a file name are empty, but still got a file on disk
+        discard_files([f for _,f in files.items(multi=True) if f.name != 'file' or f.filename == ''])
+        files = [f for f in files.getlist('file') if f.filename != '']
+        if len(files) == 0:
+            return "No file provided.", 400
+        if len(files) > max_files:
+            discard_files(files)
+            return "Too many files. At most %d can be uploaded at once." % max_files, 400
+        try:
+            food_id = int(form.get('food_id'))
+        except:
+            food_id = None
+
+        try:
+            photos = dbutils.create_photos_from_uploads(files,
+                    user_id=current_user.get_id(),
+                    date=form.get('date') or None,
+                    time=form.get('time') or None,
+                    food_id=food_id)
+            job_ids = jobs.create_photo_jobs(photos)
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            discard_files(files)
+            return {
+                'error': str(e)
+            }, 400
+        except Exception:
+            db.session.rollback()
+            discard_files(files)
+            raise
+        for job_id in job_ids:
+            jobs.submit_photo_job(job_id)
+
+        return {
+            'message': 'Photos uploaded successfully. Processing.',
+            'job_ids': job_ids,
+            'entities': {
+                'photos': dict([(p.id,dbutils.photo_to_dict(p)) for p in photos])
+            }
+        }, 202
+
+class PhotoGroups(Resource):
+    @login_required
+    def get(self):
+        """ Group photos taken in quick succession or that look alike, e.g. several photos of the same meal.
+        ---
+        tags:
+          - photos
+        parameters:
+          - name: date
+            in: query
+            type: string
+            format: date
+            description: Group all photos taken on this date.
+          - name: id
+            in: query
+            type: array
+            items:
+              type: integer
+            collectionFormat: multi
+            description: Group the photos with these IDs.
+        responses:
+          200:
+            description: A list of groups, each a list of photo IDs ordered by time taken.
+            schema:
+              type: object
+              properties:
+                groups:
+                  type: array
+                  items:
+                    type: array
+                    items:
+                      type: integer
+        """
+        query = db.session.query(Photo) \
+                .with_entities(Photo.id) \
+                .filter_by(user_id=current_user.get_id())
+        if 'date' in request.args:
+            query = query.filter_by(date=request.args['date'])
+        elif 'id' in request.args:
+            query = query.filter(Photo.id.in_(request.args.getlist('id', type=int)))
+        else:
+            return {
+                'error': 'Provide either a date or photo IDs.'
+            }, 400
+        photo_ids = [p[0] for p in query.all()]
+        return {
+            'groups': dbutils.autogoup_photos(photo_ids)
+        }, 200
+
+class PhotoJobs(Resource):
+    @login_required
+    def get(self, job_id):
+        """ Return the status of the job processing an uploaded photo.
+        ---
+        tags:
+          - photos
+        parameters:
+          - name: job_id
+            in: path
+            type: integer
+            required: true
+        definitions:
+          PhotoJob:
+            type: object
+            properties:
+              id:
+                type: integer
+              photo_id:
+                type: integer
+              status:
+                type: string
+                enum: [pending, processing, done, failed]
+              error:
+                type: string
+        responses:
+          200:
+            description: Job status, along with the photo entry once the job is done.
+            schema:
+              $ref: '#/definitions/PhotoJob'
+          404:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        job = db.session.query(PhotoJob) \
+                .filter_by(user_id=current_user.get_id()) \
+                .filter_by(id=job_id) \
+                .first()
+        if job is None:
+            return {
+                'error': 'Job ID not found'
+            }, 404
+        photos = {}
+        if job.status == 'done':
+            photo = db.session.query(Photo) \
+                    .filter_by(id=job.photo_id) \
+                    .first()
+            if photo is not None:
+                photos[photo.id] = dbutils.photo_to_dict(photo)
+        return {
+            'job': job.to_dict(),
+            'entities': {
+                'photos': photos
+            }
+        }, 200
+
 class PhotoFood(Resource):
     @login_required
     def get(self, photo_id):
@@ -360,10 +601,100 @@ class PhotoFood(Resource):
             f, with_photos=True, with_children=True
         ) for f in food], 200
 
+PHOTO_SIZES = [32, 128, 320, 700]
+
+class PhotoThumbnails(Resource):
+    @login_required
+    def get(self):
+        """ Return the 32px thumbnails of several photos in a single response.
+        ---
+        tags:
+          - photos
+        parameters:
+          - name: ids
+            in: query
+            type: string
+            description: Comma-separated list of photo IDs.
+          - name: date
+            in: query
+            type: string
+            format: date
+            description: Return the thumbnails of all photos on this date instead.
+          - name: format
+            in: query
+            type: string
+            enum: [base64, sprite]
+            description: Return each thumbnail as a base64-encoded JPEG (default), or a single sprite sheet containing all of them.
+        responses:
+          200:
+            schema:
+              type: object
+              properties:
+                thumbnails:
+                  type: object
+                  description: Base64-encoded JPEG of each photo, by photo ID. Only with `format=base64`.
+                sprite:
+                  type: string
+                  description: Base64-encoded JPEG containing all thumbnails. Only with `format=sprite`.
+                offsets:
+                  type: object
+                  description: Position (x, y, width, height) of each photo's thumbnail in the sprite sheet, by photo ID. Only with `format=sprite`.
+          400:
+            schema:
+              type: object
+              properties:
+                error:
+                  type: string
+        """
+        format = request.args.get('format', 'base64')
+        if format not in ('base64', 'sprite'):
+            return {
+                'error': 'Format must be base64 or sprite.'
+            }, 400
+        photos = db.session.query(Photo) \
+                .filter_by(user_id=current_user.get_id())
+        if 'ids' in request.args:
+            try:
+                ids = [int(i) for i in request.args['ids'].split(',') if i != '']
+            except ValueError:
+                return {
+                    'error': 'IDs must be integers.'
+                }, 400
+            if len(ids) > 200:
+                return {
+                    'error': 'At most 200 photos can be requested at once.'
+                }, 400
+            photos = photos.filter(Photo.id.in_(ids))
+        elif 'date' in request.args:
+            photos = photos.filter_by(date=request.args['date'])
+        else:
+            return {
+                'error': 'Either ids or a date is required.'
+            }, 400
+        photos = photos \
+                .order_by(Photo.id) \
+                .limit(200) \
+                .all()
+
+        thumbnails = dbutils.get_photo_thumbnails(photos, size=32)
+        if format == 'sprite':
+            sprite,offsets = imageutils.create_sprite(thumbnails, 32)
+            return {
+                'sprite': base64.b64encode(sprite).decode(),
+                'offsets': offsets
+            }, 200
+        return {
+            'thumbnails': dict([
+                (photo_id, base64.b64encode(data).decode())
+                for photo_id,data in thumbnails
+            ])
+        }, 200
+
 class PhotoFile(Resource):
     @login_required
     def get(self, photo_id):
         """ Return the file saved under the given photo id.
+        The photo is resized to fit within the requested size, and returned as WebP if the client accepts it, or JPEG otherwise.
         ---
         tags:
           - photos
@@ -372,10 +703,35 @@ class PhotoFile(Resource):
             in: path
             type: integer
             required: true
+          - name: size
+            in: query
+            type: integer
+            required: false
+            enum: [32, 128, 320, 700]
+            description: Maximum width and height in pixels. Defaults to 700.
+        produces:
+          - image/jpeg
+          - image/webp
         responses:
           200:
-            description: PNG File
+            description: Image file
+          206:
+            description: Part of the image file, if a range was requested.
+          302:
+            description: Redirect to a short-lived signed URL for the stored JPEG, if `PHOTO_REDIRECT` is enabled and the 700px size was requested.
+          304:
+            description: The file matches the ETag given in `If-None-Match`.
+          400:
+            description: Unsupported size
         """
+        try:
+            size = int(request.args.get('size', 700))
+        except ValueError:
+            size = None
+        if size not in PHOTO_SIZES:
+            return {
+                'error': 'Size must be one of %s.' % PHOTO_SIZES
+            }, 400
         photo = db.session.query(Photo) \
                 .filter_by(user_id=current_user.get_id()) \
                 .filter_by(id=photo_id) \
@@ -385,8 +741,144 @@ class PhotoFile(Resource):
                 'error': 'Photo ID not found'
             }, 404
 
-        file_name = dbutils.get_photo_file_name(photo.id, format='png', size=700)
-        return send_file(file_name, mimetype='image/png', attachment_filename='file.png')
+        # Send the client straight to the object store for the version that is stored there.
+        # Only the JPEG is stored, so this is done before choosing a format, since every browser accepts JPEG.
+        if app.config.get('PHOTO_REDIRECT', False) and size == 700:
+            expires_in = app.config.get('PHOTO_URL_EXPIRY', 300)
+            url = storage.get_storage().url(photo.file_name, expires_in, content_type='image/jpeg')
+            response = redirect(url, code=302)
+            response.headers['Cache-Control'] = 'private, max-age=%d' % (expires_in//2)
+            response.headers['Vary'] = 'Accept'
+            return response
+
+        format = 'jpeg'
+        if imageutils.WEBP_SUPPORTED and any(m == 'image/webp' for m in request.accept_mimetypes.values()):
+            format = 'webp'
+
+        # Resized photos never change, so they can be cached indefinitely
+        etag = 'photo-%s-%d-%s' % (photo.file_name, size, format)
+        headers = {
+            'Cache-Control': 'private, max-age=31536000, immutable',
+            'Vary': 'Accept'
+        }
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        # Sent from its path so that ranges are supported. The file can be evicted by another process before it is opened, in which case it is created again.
+        for attempt in range(3):
+            file_name = dbutils.get_photo_file_name(photo.id, format=format, size=size, file_name=photo.file_name)
+            try:
+                response = send_file(file_name, mimetype='image/%s' % format,
+                        conditional=True, add_etags=False, cache_timeout=31536000)
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+        response.set_etag(etag)
+        for key,value in headers.items():
+            response.headers[key] = value
+        return response
+
+class SignedPhotoFile(Resource):
+    def get(self, token):
+        """ Return a file from local photo storage using a signed URL.
+        Only used when `PHOTO_STORAGE` is 'local' and `PHOTO_REDIRECT` is enabled.
+        ---
+        tags:
+          - photos
+        parameters:
+          - name: token
+            in: path
+            type: string
+            required: true
+        responses:
+          200:
+            description: Image file
+          403:
+            description: Invalid or expired URL
+        """
+        try:
+            key,content_type = storage.load_signed_key(token)
+        except Exception:
+            return {
+                'error': 'Invalid or expired URL.'
+            }, 403
+        local_storage = storage.get_storage()
+        if not isinstance(local_storage, storage.LocalStorage):
+            return {
+                'error': 'Invalid or expired URL.'
+            }, 403
+        response = send_file(local_storage.path(key), mimetype=content_type, conditional=True)
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
+class PhotoSimilar(Resource):
+    @login_required
+    def get(self, photo_id):
+        """ Return the user's past photos that look the most like the given photo, along with their food entries.
+        Requires `PHOTO_EMBEDDINGS` to be enabled.
+        ---
+        tags:
+          - photos
+        parameters:
+          - name: photo_id
+            in: path
+            type: integer
+            required: true
+          - name: k
+            in: query
+            type: integer
+            description: Number of similar photos to return. Defaults to 5, and can be at most 50.
+        responses:
+          200:
+            description: Similar photos, most similar first, with their cosine similarity to the given photo.
+            schema:
+              type: object
+              properties:
+                similar:
+                  type: array
+                  items:
+                    type: object
+                    properties:
+                      photo_id:
+                        type: integer
+                      food_id:
+                        type: integer
+                      similarity:
+                        type: number
+          404:
+            description: Photo ID not found
+        """
+        if not app.config.get('PHOTO_EMBEDDINGS', False):
+            return {
+                'error': 'Similar photo search is not enabled.'
+            }, 404
+        k = min(request.args.get('k', 5, type=int), 50)
+        photo = db.session.query(Photo) \
+                .filter_by(id=photo_id) \
+                .filter_by(user_id=current_user.get_id()) \
+                .first()
+        if photo is None:
+            return {
+                'error': 'Photo ID not found'
+            }, 404
+        similar = dbutils.find_similar_photos(photo, k)
+        foods = db.session.query(Food) \
+                .filter(Food.id.in_(list(set([p.food_id for p,_ in similar])))) \
+                .all()
+        return {
+            'similar': [{
+                'photo_id': p.id,
+                'food_id': p.food_id,
+                'similarity': s
+            } for p,s in similar],
+            'entities': {
+                'photos': dict([(p.id,dbutils.photo_to_dict(p)) for p,_ in similar]),
+                'food': dict(zip([f.id for f in foods], dbutils.foods_to_dict(foods)))
+            }
+        }, 200
 
 class PhotoPrediction(Resource):
     @login_required
@@ -400,16 +892,51 @@ class PhotoPrediction(Resource):
             in: path
             type: integer
             required: true
+          - name: model
+            in: query
+            type: string
+            description: Version of the model to use. Defaults to the `PREDICTION_MODEL_VERSION` config value.
         responses:
           200:
             description: Prediction on photo contents
+          400:
+            description: Unknown model version
+          404:
+            description: Photo ID not found
+          503:
+            description: The prediction took longer than `PREDICTION_TIMEOUT` seconds
         """
+        version = request.args.get('model')
+        if version is not None and version not in app.config.get('PREDICTION_MODELS', {}):
+            return {
+                'error': 'Unknown model version %s.' % version
+            }, 400
+        photo = db.session.query(Photo) \
+                .filter_by(id=photo_id) \
+                .filter_by(user_id=current_user.get_id()) \
+                .first()
+        if photo is None:
+            return {
+                'error': 'Photo ID not found'
+            }, 404
+        try:
+            predictions = dbutils.predict_food_name_from_photo(photo, version)
+        except TimeoutError:
+            return {
+                'error': 'Prediction timed out.'
+            }, 503
         return {
-                'predictions': dbutils.predict_food_name_from_photo(photo_id)
+                'predictions': predictions
         }, 200
 
 api.add_resource(PhotoList, '/photos')
 api.add_resource(Photos, '/photos/<int:photo_id>')
+api.add_resource(PhotoBatch, '/photos/batch')
+api.add_resource(PhotoGroups, '/photos/groups')
+api.add_resource(PhotoJobs, '/photos/jobs/<int:job_id>')
+api.add_resource(PhotoThumbnails, '/photos/thumbnails')
 #api.add_resource(PhotoFood, '/photos/<int:photo_id>/food')
 api.add_resource(PhotoFile, '/photos/<int:photo_id>/file')
+api.add_resource(SignedPhotoFile, '/photos/signed/<token>')
+api.add_resource(PhotoSimilar, '/photos/<int:photo_id>/similar')
 api.add_resource(PhotoPrediction, '/photos/<int:photo_id>/prediction')
@@ -0,0 +1,215 @@
+from collections import defaultdict, OrderedDict
+import re
+import time
+import sqlalchemy
+from sqlalchemy.sql import func, not_
+from flask import current_app as app
+
+from tracker_database import Food
+from fitnessapp.extensions import db
+from fitnessapp.usercache import UserCache
+
+LIKE_ESCAPE_CHAR = '\\'
+
+def escape_like(term):
+    """ Escape the characters in `term` that have a special meaning in a LIKE pattern.
+    """
+    return term \
+            .replace(LIKE_ESCAPE_CHAR, LIKE_ESCAPE_CHAR*2) \
+            .replace('%', LIKE_ESCAPE_CHAR+'%') \
+            .replace('_', LIKE_ESCAPE_CHAR+'_')
+
+def contains(column, term):
+    """ Case-insensitive substring filter on `column`.
+    With the trigram index created by `create_indexes`, Postgres can answer this without scanning the whole table.
+    """
+    return column.ilike('%'+escape_like(term)+'%', escape=LIKE_ESCAPE_CHAR)
+
+def ends_with(column, term):
+    """ Case-insensitive suffix filter on `column`.
+    """
+    return column.ilike('%'+escape_like(term), escape=LIKE_ESCAPE_CHAR)
+
+def create_indexes():
+    """ Create the trigram index on food names used by the food search.
+    Requires permission to create the `pg_trgm` extension.
+    """
+    db.session.execute(sqlalchemy.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    db.session.execute(sqlalchemy.text(
+        'CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx ON {table} USING gin ({column} gin_trgm_ops)'.format(
+            table=Food.__table__.name,
+            column=Food.__table__.c.name.name
+        )
+    ))
+    db.session.commit()
+
+def trigrams(text):
+    """ Return the set of trigrams of `text` as pg_trgm computes them: each word is lower-cased and padded with two spaces in front and one behind.
+    """
+    grams = set()
+    for word in re.findall(r'\w+', text.lower()):
+        word = '  '+word+' '
+        grams.update([word[i:i+3] for i in range(len(word)-2)])
+    return grams
+
+class NgramIndex:
+    """ In-process trigram index of names, used to search food names when the `pg_trgm` extension isn't available, e.g. in tests.
+    Names are scored like pg_trgm's `word_similarity`: by the fraction of the search term's trigrams that they contain, so that misspelt and partially typed terms still match. Names containing the term itself always match.
+    """
+    def __init__(self):
+        self.names = {}
+        self.postings = defaultdict(set)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, key, name):
+        """ Add or replace the name stored under `key`.
+        """
+        if key in self.names:
+            self.discard(key)
+        self.names[key] = name
+        for gram in trigrams(name):
+            self.postings[gram].add(key)
+
+    def discard(self, key):
+        """ Remove the name stored under `key`, if any.
+        """
+        name = self.names.pop(key, None)
+        if name is None:
+            return
+        for gram in trigrams(name):
+            keys = self.postings[gram]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.postings[gram]
+
+    def search(self, term, threshold=0.6):
+        """ Return a list of (key, score) tuples for the names scoring at least `threshold` for `term`, best first.
+        """
+        grams = trigrams(term)
+        term = term.lower().strip()
+        if len(term) == 0:
+            return []
+        counts = defaultdict(int)
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                counts[key] += 1
+        if len(term) < 3:
+            # Too short to share trigrams with names that contain it in the middle of a word
+            candidates = self.names.keys()
+        else:
+            candidates = counts.keys()
+        results = []
+        for key in candidates:
+            if term in self.names[key].lower():
+                score = 1.0
+            else:
+                score = counts.get(key, 0)/max(len(grams), 1)
+            if score >= threshold:
+                results.append((key, score))
+        results.sort(key=lambda r: (-r[1], self.names[r[0]]))
+        return results
+
+def load_name_index(user_id):
+    """ Build a trigram index of the distinct names of the given user's food entries, keyed by lower-cased name.
+    """
+    names = db.session.query(Food) \
+            .with_entities(func.lower(Food.name)) \
+            .filter_by(user_id=user_id) \
+            .filter(not_(Food.name == '')) \
+            .distinct() \
+            .all()
+    index = NgramIndex()
+    for name, in names:
+        index.add(name, name)
+    return index
+
+names = UserCache(load_name_index, max_users=200, max_age=60)
+
+trigram_extension = None # Whether pg_trgm is installed, checked on first use
+
+def fallback_enabled():
+    """ Whether food names are matched with the in-process `NgramIndex` instead of by Postgres.
+    Controlled by `FOOD_SEARCH_NGRAM_FALLBACK`. If it is None, the fallback is used when the `pg_trgm` extension isn't installed.
+    """
+    global trigram_extension
+    enabled = app.config.get('FOOD_SEARCH_NGRAM_FALLBACK')
+    if enabled is not None:
+        return enabled
+    if trigram_extension is None:
+        trigram_extension = db.session.execute(sqlalchemy.text(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'"
+        )).scalar() > 0
+    return not trigram_extension
+
+def matches(column, term, user_id):
+    """ Filter on `column` for the given user's food names matching `term`.
+    This is `contains` when Postgres has the trigram index, or else a match against the names found in the user's `NgramIndex`.
+    """
+    if not fallback_enabled():
+        return contains(column, term)
+    index = names.get(user_id)
+    with names.lock:
+        found = [key for key,_ in index.search(term)]
+    return func.lower(column).in_(found)
+
+class SearchCache:
+    """ Per-process cache of food search results for each user, keyed by query.
+    A result set that was not truncated by a limit contains every match for its query, so it is also used to answer longer queries starting with the same prefix by filtering it.
+    Entries are tagged with the version of the user's food entries stored in the database (see `dbutils.get_food_version`), and are only used for the same version, so changes made by any process make them stale.
+    """
+    def __init__(self, max_users=1000, max_queries=100):
+        self.max_queries = max_queries
+        self.users = UserCache(lambda user_id: OrderedDict(), max_users=max_users) # user id -> OrderedDict((result set name, query) -> (time, version, complete, rows))
+
+    def get(self, user_id, name, query, version, max_age):
+        """ Return the cached rows of the result set `name` for `query`, or None if they are not cached for the given version of the user's entries.
+        """
+        query = query.lower()
+        now = time.time()
+        def valid(entry):
+            return entry is not None and entry[1] == version and now-entry[0] <= max_age
+        def get(entries):
+            entry = entries.get((name, query))
+            if valid(entry):
+                return entry[3]
+            # Filter the results of a shorter query if they contain every match
+            for i in range(len(query)-1, 0, -1):
+                entry = entries.get((name, query[:i]))
+                if not valid(entry) or not entry[2]:
+                    continue
+                rows = [r for r in entry[3] if query in (r['name'] or '').lower()]
+                self._set(entries, name, query, (entry[0], version, True, rows))
+                return rows
+            return None
+        return self.users.apply(user_id, get)
+
+    def set(self, user_id, name, query, rows, complete, version):
+        """ Cache the rows of the result set `name` for `query`.
+        Args:
+            complete: True if `rows` contains every match for `query`, i.e. it was not truncated by a limit.
+            version: Version of the user's entries read before the rows were computed.
+        """
+        entry = (time.time(), version, complete, rows)
+        self.users.get(user_id)
+        self.users.apply(user_id, lambda entries: self._set(entries, name, query.lower(), entry))
+
+    def _set(self, entries, name, query, entry):
+        entries[(name, query)] = entry
+        entries.move_to_end((name, query))
+        if len(entries) > self.max_queries:
+            entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """ Drop all cached results for the given user, to free memory once they are stale.
+        """
+        self.users.invalidate(user_id)
+
+cache = SearchCache()
+
+def invalidate(user_id):
+    """ Drop the cached search results and name index of the given user, after their food entries changed.
+    """
+    cache.invalidate(user_id)
+    names.invalidate(user_id)
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import os
+import tempfile
+import threading
+import boto3
+import botocore.config
+
+from flask import current_app as app, url_for
+from itsdangerous import URLSafeTimedSerializer
+
+class Storage:
+    """ Object store holding photo files by key.
+    Subclasses implement `put`, `get` and `delete`. The bulk operations run them concurrently on a shared pool of threads.
+    """
+    def __init__(self, max_workers=16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def put(self, key, data):
+        """ Store `data` (bytes) under `key`, replacing any existing object.
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        """ Return the bytes stored under `key`.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """ Delete the object stored under `key`, if any.
+        """
+        raise NotImplementedError()
+
+    def url(self, key, expires_in, content_type=None):
+        """ Return a URL from which the object stored under `key` can be downloaded without logging in, for `expires_in` seconds.
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """ Retrieve several objects concurrently.
+        Returns:
+            A dictionary mapping each key to its bytes. Keys that could not be retrieved are left out.
+        """
+        def get(key):
+            try:
+                return key, self.get(key)
+            except Exception:
+                print('Unable to retrieve object %s.' % key)
+                return key, None
+        results = self.executor.map(get, keys)
+        return dict([(k,v) for k,v in results if v is not None])
+
+    def delete_many(self, keys):
+        """ Delete several objects concurrently.
+        """
+        list(self.executor.map(self.delete, keys))
+
+class LocalStorage(Storage):
+    """ Object store backed by a local directory, for development, tests and benchmarks.
+    """
+    def __init__(self, directory, max_workers=4):
+        super().__init__(max_workers=max_workers)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def put(self, key, data):
+        # Write to a temporary file first so that readers never see a partial file
+        fd,temp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path(key))
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key, expires_in, content_type=None):
+        # The expiry is checked when the URL is used, see `load_signed_key`.
+        token = get_serializer().dumps({'key': key, 'expires_in': expires_in, 'content_type': content_type})
+        return url_for('photos.signedphotofile', token=token)
+
+class S3Storage(Storage):
+    """ Object store backed by an S3 bucket.
+    Uses a single client, which is thread-safe, with a connection pool large enough for the bulk operations.
+    """
+    def __init__(self, bucket, max_connections=32, max_workers=16):
+        super().__init__(max_workers=max_workers)
+        self.bucket = bucket
+        config = botocore.config.Config(
+                max_pool_connections=max_connections,
+                retries={'max_attempts': 3})
+        self.client = boto3.session.Session().client('s3', config=config)
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        buffered = BytesIO()
+        self.client.download_fileobj(self.bucket, key, buffered)
+        return buffered.getvalue()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key, expires_in, content_type=None):
+        params = {'Bucket': self.bucket, 'Key': key}
+        if content_type is not None:
+            params['ResponseContentType'] = content_type
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    def delete_many(self, keys):
+        # S3 deletes up to 1000 objects per request
+        keys = list(keys)
+        batches = [keys[i:i+1000] for i in range(0, len(keys), 1000)]
+        def delete(batch):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': k} for k in batch],
+                'Quiet': True
+            })
+        list(self.executor.map(delete, batches))
+
+storages = {}
+storages_lock = threading.Lock()
+
+def get_storage():
+    """ Return the photo storage configured for the current app.
+    `PHOTO_STORAGE` is either 's3' (default), which uses the bucket in `LOGS_PHOTO_BUCKET_NAME`, or 'local', which uses the directory in `PHOTO_STORAGE_FOLDER`.
+    """
+    backend = app.config.get('PHOTO_STORAGE', 's3')
+    if backend == 'local':
+        location = app.config['PHOTO_STORAGE_FOLDER']
+    elif backend == 's3':
+        location = app.config['LOGS_PHOTO_BUCKET_NAME']
+    else:
+        raise Exception('Unknown photo storage %s.' % backend)
+    with storages_lock:
+        if (backend, location) not in storages:
+            if backend == 'local':
+                storages[(backend, location)] = LocalStorage(location)
+            else:
+                storages[(backend, location)] = S3Storage(location,
+                        max_connections=app.config.get('PHOTO_STORAGE_MAX_CONNECTIONS', 32))
+        return storages[(backend, location)]
+
+def get_serializer():
+    return URLSafeTimedSerializer(app.secret_key, salt='photo-storage')
+
+def load_signed_key(token):
+    """ Return the key and content type of the object referred to by a URL created by `LocalStorage.url`, or raise an exception if it is invalid or expired.
+    """
+    serializer = get_serializer()
+    data = serializer.loads(token)
+    # Check the age against the expiry that was signed along with the key
+    serializer.loads(token, max_age=data['expires_in'])
+    return data['key'], data['content_type']
@@ -0,0 +1,79 @@
+from collections import defaultdict, OrderedDict
+import threading
+import time
+
+class UserCache:
+    """ Per-process collection of values built for each user, such as search indexes, keeping the most recently used ones.
+    Values are built lazily by `build(user_id)`, outside of the lock so that other users aren't blocked. Values older than `max_age` seconds are rebuilt, to pick up changes made by other processes.
+    Every invalidation increments the user's generation, so that a value that was being built at the time is not kept.
+    """
+    def __init__(self, build, max_users=200, max_age=None):
+        self.build = build
+        self.max_users = max_users
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.values = OrderedDict() # user id (as a string) -> (creation time, value), least recently used first
+        self.generations = defaultdict(int)
+
+    def _fresh(self, user_id):
+        """ Return the user's value if it is loaded and not too old, marking it as recently used. Must be called with the lock held.
+        """
+        cached = self.values.get(user_id)
+        if cached is None:
+            return None
+        if self.max_age is not None and time.time()-cached[0] > self.max_age:
+            return None
+        self.values.move_to_end(user_id)
+        return cached[1]
+
+    def get(self, user_id):
+        """ Return the user's value, building it if needed.
+        """
+        user_id = str(user_id)
+        with self.lock:
+            value = self._fresh(user_id)
+            if value is not None:
+                return value
+            generation = self.generations[user_id]
+        created = time.time()
+        value = self.build(user_id)
+        with self.lock:
+            if self.generations[user_id] != generation:
+                # Invalidated while building, so the value may already be out of date
+                return value
+            self.values[user_id] = (created, value)
+            self.values.move_to_end(user_id)
+            while len(self.values) > self.max_users:
+                self.values.popitem(last=False)
+            return value
+
+    def apply(self, user_id, function):
+        """ Call `function` with the user's value while holding the lock, if the value is loaded.
+        Returns:
+            The return value of `function`, or None if it wasn't called.
+        """
+        user_id = str(user_id)
+        with self.lock:
+            value = self._fresh(user_id)
+            if value is None:
+                return None
+            return function(value)
+
+    def update(self, user_id, function):
+        """ Call `function` with the user's value while holding the lock, if the value is loaded. Otherwise, invalidate it, since a value being built right now might not include the change.
+        """
+        user_id = str(user_id)
+        with self.lock:
+            value = self._fresh(user_id)
+            if value is None:
+                self.generations[user_id] += 1
+                return
+            function(value)
+
+    def invalidate(self, user_id):
+        """ Drop the user's value so that it is rebuilt on the next lookup.
+        """
+        user_id = str(user_id)
+        with self.lock:
+            self.values.pop(user_id, None)
+            self.generations[user_id] += 1
@@ -1,10 +1,10 @@
-from setuptools import setup
+from setuptools import setup, find_packages
 
 setup(
     name='fitnessapp',
     version='1.0',
     description='Backend',
-    packages=['fitnessapp'],
+    packages=find_packages(include=['fitnessapp', 'fitnessapp.*']),
     install_requires=[
         'bcrypt',
         'boto3',
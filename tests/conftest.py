@@ -0,0 +1,61 @@
+import os
+
+import pytest
+from flask import Flask
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """ App connected to the Postgres database given by the `TEST_DATABASE_URI` environment variable, with every table created for the test and dropped after it.
+    Tests using it are skipped when the variable isn't set. The database is emptied, so it must not hold anything worth keeping.
+    """
+    uri = os.environ.get('TEST_DATABASE_URI')
+    if uri is None:
+        pytest.skip('TEST_DATABASE_URI is not set')
+    pytest.importorskip('tracker_database')
+    from fitnessapp.extensions import db
+    from fitnessapp import models, search, autocomplete, photohash
+    from fitnessapp.usercache import UserCache
+
+    # Start from empty per-process caches, since IDs are reused once the tables are recreated
+    monkeypatch.setattr(search, 'cache', search.SearchCache())
+    monkeypatch.setattr(search, 'names', UserCache(search.load_name_index, max_age=60))
+    monkeypatch.setattr(search, 'trigram_extension', None)
+    monkeypatch.setattr(autocomplete, 'index', autocomplete.AutocompleteIndex())
+    monkeypatch.setattr(photohash, 'index', photohash.HashIndex())
+
+    app = Flask('fitnessapp')
+    app.config.from_object('config')
+    app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI=uri,
+        UPLOAD_FOLDER=str(tmp_path/'uploads'),
+        PHOTO_STORAGE='local',
+        PHOTO_STORAGE_FOLDER=str(tmp_path/'photos'),
+        PHOTO_CACHE_FOLDER=str(tmp_path/'cache'),
+        EMBEDDING_FOLDER=str(tmp_path/'embeddings'),
+        PHOTO_JOBS_INLINE=True,
+    )
+    os.makedirs(app.config['UPLOAD_FOLDER'])
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        models.create_tables()
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+@pytest.fixture
+def make_user(app):
+    """ Function creating a user with the given email address and returning their ID. """
+    from tracker_database import User
+    from fitnessapp.extensions import db
+    def make_user(email='test@example.com'):
+        user = User()
+        user.email = email
+        user.password = b'not a password hash'
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+    return make_user
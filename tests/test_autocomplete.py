@@ -0,0 +1,57 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp.autocomplete import RadixTrie, recency_score
+
+def names(entries):
+    return [e['name'] for e in entries]
+
+def test_recency_score():
+    assert recency_score(2, '2020-01-01', 30) > recency_score(1, '2020-01-01', 30)
+    assert recency_score(1, '2020-01-02', 30) > recency_score(1, '2020-01-01', 30)
+    # A name logged twice as often is worth one half-life of recency
+    assert recency_score(2, '2020-01-01', 30) == pytest.approx(recency_score(1, '2020-01-31', 30))
+    assert recency_score(1, datetime.date(2020, 1, 1), 30) == recency_score(1, '2020-01-01', 30)
+
+def test_complete_prefixes():
+    trie = RadixTrie()
+    for name in ['apple', 'apple pie', 'applesauce', 'apricot', 'banana']:
+        trie.add(name, 1, '2020-01-01')
+    assert sorted(names(trie.complete('ap', 10))) == ['apple', 'apple pie', 'applesauce', 'apricot']
+    assert sorted(names(trie.complete('apple', 10))) == ['apple', 'apple pie', 'applesauce']
+    assert sorted(names(trie.complete('APPLE ', 10))) == ['apple pie']
+    assert names(trie.complete('apples', 10)) == ['applesauce']
+    assert names(trie.complete('b', 10)) == ['banana']
+    assert trie.complete('c', 10) == []
+    assert trie.complete('applesauces', 10) == []
+    assert len(trie.complete('', 3)) == 3
+    assert len(trie) == 5
+
+def test_complete_order():
+    trie = RadixTrie(half_life=30)
+    trie.add('tea', 1, '2020-01-01')
+    trie.add('toast', 5, '2020-01-01')
+    trie.add('tofu', 1, '2020-06-01')
+    assert names(trie.complete('t')) == ['tofu', 'toast', 'tea']
+    trie.add('tea', 100, '2020-06-01')
+    assert names(trie.complete('t')) == ['tea', 'tofu', 'toast']
+    assert names(trie.complete('t', 1)) == ['tea']
+
+def test_names_are_case_insensitive():
+    trie = RadixTrie()
+    trie.add('coffee', 1, '2020-01-01')
+    trie.add('Coffee', 2, '2020-01-02')
+    entries = trie.complete('c')
+    assert len(entries) == 1
+    assert entries[0]['name'] == 'Coffee'
+    assert entries[0]['count'] == 3
+    assert entries[0]['date'] == '2020-01-02'
+
+def test_top_k():
+    trie = RadixTrie(top_k=2)
+    for i,name in enumerate(['aa', 'ab', 'ac']):
+        trie.add(name, i+1, '2020-01-01')
+    assert names(trie.complete('a', 10)) == ['ac', 'ab']
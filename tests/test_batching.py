@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import numpy as np
+import pytest
+
+from fitnessapp.ml.batching import BatchScheduler, SchedulerClosed
+
+def test_batches_concurrent_inputs():
+    sizes = []
+    release = threading.Event()
+    def forward(batch):
+        # Hold the first batch so that the other inputs queue up behind it
+        release.wait()
+        sizes.append(len(batch))
+        return batch*2
+    scheduler = BatchScheduler(forward, max_batch_size=4, max_wait=0.05)
+    futures = [scheduler.submit(np.array([i], dtype=np.float32)) for i in range(9)]
+    release.set()
+    assert [f.result(timeout=5)[0] for f in futures] == [i*2 for i in range(9)]
+    assert sum(sizes) == 9
+    assert max(sizes) <= 4
+    assert len(sizes) < 9
+    stats = scheduler.stats()
+    assert stats['items'] == 9
+    assert stats['mean_batch_size'] == 9/stats['batches']
+    scheduler.close()
+
+def test_from_many_threads():
+    scheduler = BatchScheduler(lambda batch: batch+1, max_batch_size=8, max_wait=0.01)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda i: scheduler.submit(np.array([i]))
+                .result(timeout=5)[0], range(100)))
+    assert results == list(range(1, 101))
+    scheduler.close()
+
+def test_errors_reach_every_caller():
+    def forward(batch):
+        raise ValueError('Broken model')
+    scheduler = BatchScheduler(forward, max_wait=0.01)
+    futures = [scheduler.submit(np.zeros(1)) for _ in range(3)]
+    for f in futures:
+        with pytest.raises(ValueError):
+            f.result(timeout=5)
+    # The worker keeps going after a failed batch
+    scheduler.forward = lambda batch: batch
+    assert scheduler.submit(np.ones(1)).result(timeout=5)[0] == 1
+    scheduler.close()
+
+def test_close():
+    release = threading.Event()
+    def forward(batch):
+        release.wait()
+        return batch
+    scheduler = BatchScheduler(forward, max_batch_size=1, max_wait=0)
+    futures = [scheduler.submit(np.array([i])) for i in range(3)]
+    scheduler.close()
+    scheduler.close()
+    with pytest.raises(SchedulerClosed):
+        scheduler.submit(np.zeros(1))
+    release.set()
+    # Inputs queued before closing are still run
+    assert [f.result(timeout=5)[0] for f in futures] == [0, 1, 2]
+    scheduler.thread.join(timeout=5)
+    assert not scheduler.thread.is_alive()
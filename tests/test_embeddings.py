@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pytest
+
+from fitnessapp.embeddings import EmbeddingStore, IVFIndex
+
+def normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors/np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def brute_force(ids, vectors, query, k):
+    similarities = normalized(vectors) @ normalized([query])[0]
+    top = np.argsort(-similarities)[:k]
+    return [ids[i] for i in top]
+
+def test_add_get_and_search(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    assert store.search(1, np.ones(3), 2) == []
+    assert store.get(1, 10) is None
+    store.add(1, [10, 11, 12], [[1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    store.add(2, [20], [[0, 0, 1]])
+    assert np.allclose(store.get(1, 12), normalized([[1, 1, 0]])[0], atol=1e-3)
+    results = store.search(1, [1, 0.1, 0], 2)
+    assert [photo_id for photo_id,_ in results] == [10, 12]
+    assert results[0][1] == pytest.approx(normalized([[1, 0.1, 0]])[0][0], abs=1e-3)
+    assert sorted(photo_id for photo_id,_ in store.search(1, [0, 0, 1], 10)) == [10, 11, 12]
+    with pytest.raises(ValueError):
+        store.add(1, [13], [[1, 0]])
+
+def test_replace_remove_and_compact(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add(1, [1, 2, 3, 4], np.eye(4))
+    store.add(1, [2], [[1, 0, 0, 0]])
+    store.remove(1, [3])
+    assert store.read_meta(1)['dead'] == [1, 2]
+    ids,_ = store.load(1)
+    assert ids.tolist() == [1, -1, -1, 4, 2]
+    assert np.allclose(store.get(1, 2), [1, 0, 0, 0], atol=1e-3)
+    assert 3 not in [photo_id for photo_id,_ in store.search(1, [0, 0, 1, 0], 10)]
+    # Half of the rows are dead after this, so the files are rewritten
+    store.remove(1, [4])
+    meta = store.read_meta(1)
+    assert meta['generation'] == 1
+    assert meta['dead'] == []
+    ids,_ = store.load(1)
+    assert ids.tolist() == [1, 2]
+    assert sorted(os.listdir(str(tmp_path))) == ['1-1.ids', '1-1.vectors', '1.json', '1.lock']
+    # Removing photos without embeddings changes nothing
+    version = store.read_meta(1)['version']
+    store.remove(1, [99])
+    assert store.read_meta(1)['version'] == version
+
+def test_ignores_partial_writes(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.add(1, [1], [[1, 0]])
+    meta = store.read_meta(1)
+    # Left by a write that failed before updating the metadata
+    with open(store.data_path(1, meta, '.vectors'), 'ab') as f:
+        f.write(b'\0'*6)
+    store.add(1, [2], [[0, 1]])
+    ids,matrix = store.load(1)
+    assert ids.tolist() == [1, 2]
+    assert np.allclose(np.asarray(matrix, dtype=np.float32), [[1, 0], [0, 1]])
+
+def clustered(count, dim=16, clusters=10, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return normalized(centers[rng.randint(clusters, size=count)] + rng.normal(scale=0.1, size=(count, dim)))
+
+def test_ivf_index(tmp_path):
+    vectors = clustered(1000)
+    index = IVFIndex.build(vectors, clusters=10)
+    assert len(index) == 1000
+    assert sorted(np.concatenate(index.lists).tolist()) == list(range(1000))
+    path = str(tmp_path/'index.npz')
+    with open(path, 'wb') as f:
+        index.save(f)
+    loaded = IVFIndex.load(path)
+    assert np.array_equal(loaded.assignments, index.assignments)
+    # The nearest neighbour of a vector is in its own cluster
+    candidates = index.candidates(vectors[0], probes=1)
+    assert 0 in candidates.tolist()
+    assert len(candidates) < 1000
+
+def test_search_with_ivf_index(tmp_path):
+    store = EmbeddingStore(str(tmp_path), ivf_min_photos=500, ivf_probes=3)
+    vectors = clustered(800)
+    ids = list(range(1000, 1800))
+    store.add(1, ids[:600], vectors[:600])
+    assert store.refresh_index(1)
+    assert not store.refresh_index(1)
+    meta = store.read_meta(1)
+    assert store.get_index(1, meta) is store.get_index(1, meta)
+    # Rows added after the index was built are searched exhaustively
+    store.add(1, ids[600:], vectors[600:])
+    store.remove(1, [ids[0]])
+    recall = []
+    for i in [1, 5, 50, 650, 799]:
+        expected = [x for x in brute_force(ids, vectors, vectors[i], 11) if x != ids[0]][:10]
+        results = [photo_id for photo_id,_ in store.search(1, vectors[i], 10)]
+        assert ids[0] not in results
+        assert results[0] == ids[i]
+        recall.append(len(set(results) & set(expected))/len(expected))
+    assert np.mean(recall) >= 0.9
+    # Rebuilt once it covers too few of the rows
+    assert store.refresh_index(1)
+    assert len(store.get_index(1, store.read_meta(1))) == 800
+    # Users below the threshold are never indexed
+    store.add(2, [1], [[1]*16])
+    assert not store.refresh_index(2)
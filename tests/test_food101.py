@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+
+from fitnessapp.ml import food101
+
+def random_images(count, seed=0):
+    rng = np.random.RandomState(seed)
+    return [Image.fromarray(rng.randint(0, 256, (300, 400, 3), dtype=np.uint8)) for _ in range(count)]
+
+def test_preprocess():
+    img = Image.new('RGB', (400, 300), (255, 0, 0))
+    pixels = food101.preprocess(img, size=224, resize=256)
+    assert pixels.shape == (3, 224, 224)
+    assert pixels.dtype == np.float32
+    expected = (1-food101.MEAN.ravel())/food101.STD.ravel()
+    expected[1:] = -food101.MEAN.ravel()[1:]/food101.STD.ravel()[1:]
+    assert np.allclose(pixels[:,112,112], expected, atol=1e-5)
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'channels_last': True},
+    {'quantize': True, 'calibration': random_images(4, seed=1), 'channels_last': True},
+])
+def test_predict(options):
+    torch.manual_seed(0)
+    model = food101.Food101Model(None, top_k=3, **options)
+    predictions = model.predict(random_images(2))
+    assert len(predictions) == 2
+    for p in predictions:
+        assert len(p) == 3
+        assert all(name in food101.FOOD101_CLASSES for name,_ in p)
+        assert [prob for _,prob in p] == sorted([prob for _,prob in p], reverse=True)
+    batch = np.stack([model.preprocess(img) for img in random_images(2)])
+    assert np.allclose(model.forward(batch).sum(axis=1), 1, atol=1e-4)
+    assert model.embed(batch).shape == (2, 512)
+
+def test_quantize_needs_calibration():
+    with pytest.raises(ValueError):
+        food101.Food101Model(None, quantize=True)
+
+def test_from_config_rejects_threads():
+    with pytest.raises(ValueError):
+        food101.Food101Model.from_config({'type': 'food101', 'checkpoint': None, 'threads': 4})
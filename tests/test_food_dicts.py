@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def test_foods_to_dict(app, make_user):
+    import datetime
+    from tracker_database import Photo
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    sandwich,bread,filling,ham = dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'sandwich',
+        'children': [{'name': 'bread'}, {'name': 'filling', 'children': [{'name': 'ham'}]}]
+    }, user_id)
+    apple = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'apple'}, user_id)[0]
+    photo_ids = []
+    for food in [sandwich, sandwich, ham]:
+        photo = Photo()
+        photo.user_id = user_id
+        photo.food_id = food.id
+        photo.upload_time = datetime.datetime.utcnow()
+        db.session.add(photo)
+        db.session.flush()
+        photo_ids.append(photo.id)
+    db.session.commit()
+
+    output = dbutils.foods_to_dict([apple, sandwich])
+    assert [o['id'] for o in output] == [apple.id, sandwich.id]
+    assert output[0]['photo_ids'] == []
+    assert output[0]['children_ids'] == []
+    assert output[1]['photo_ids'] == photo_ids[:2]
+    assert output[1]['children_ids'] == [bread.id, filling.id]
+    assert 'children' not in output[1]
+
+    output = dbutils.foods_to_dict([sandwich], with_children_data=True)[0]
+    assert [c['name'] for c in output['children']] == ['bread', 'filling']
+    assert output['children'][1]['children'][0]['name'] == 'ham'
+    assert output['children'][1]['children'][0]['photo_ids'] == photo_ids[2:]
+    assert dbutils.foods_to_dict([]) == []
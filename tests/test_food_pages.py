@@ -0,0 +1,82 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def test_parse_date():
+    assert str(dbutils.parse_date('2020-02-29')) == '2020-02-29'
+    for value in ['2020-02-30', '29/02/2020', '', None]:
+        with pytest.raises(ValueError):
+            dbutils.parse_date(value)
+
+def test_cursor_round_trip():
+    cursor = dbutils.encode_cursor(['2020-01-01', 3])
+    assert dbutils.decode_cursor(cursor) == ['2020-01-01', 3]
+    with pytest.raises(ValueError):
+        dbutils.decode_cursor('not a cursor')
+
+def add_foods(user_id, entries):
+    """ Create top-level entries from (date, name) tuples, each with one child, and return their IDs. """
+    ids = []
+    for date,name in entries:
+        foods = dbutils.update_food_from_dict({
+            'date': date, 'name': name, 'children': [{'name': name+' child'}]
+        }, user_id)
+        ids.append(foods[0].id)
+    return ids
+
+def test_pages(app, make_user):
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    ids = add_foods(user_id, [
+        ('2020-01-01', 'a'), ('2020-01-02', 'b'), ('2020-01-02', 'c'),
+        ('2020-01-03', 'd'), ('2020-01-02', 'e'),
+    ])
+    add_foods(other_user_id, [('2020-01-02', 'x')])
+    expected = [ids[3], ids[4], ids[2], ids[1], ids[0]]
+
+    pages = []
+    cursor = None
+    while True:
+        foods, cursor = dbutils.list_food_page(user_id, cursor=cursor, limit=2)
+        pages.append([f.id for f in foods])
+        if cursor is None:
+            break
+    assert pages == [expected[:2], expected[2:4], expected[4:]]
+
+    foods, cursor = dbutils.list_food_page(user_id, limit=5)
+    assert [f.id for f in foods] == expected
+    assert cursor is None
+
+def test_pages_date_range(app, make_user):
+    user_id = make_user()
+    ids = add_foods(user_id, [
+        ('2020-01-01', 'a'), ('2020-01-02', 'b'), ('2020-01-03', 'c'), ('2020-01-04', 'd'),
+    ])
+    foods, cursor = dbutils.list_food_page(user_id, start_date='2020-01-02', end_date='2020-01-03', limit=1)
+    assert [f.id for f in foods] == [ids[2]]
+    foods, cursor = dbutils.list_food_page(user_id, start_date='2020-01-02', end_date='2020-01-03', cursor=cursor)
+    assert [f.id for f in foods] == [ids[1]]
+    assert cursor is None
+
+def test_all_entries_without_limit(app, make_user):
+    user_id = make_user()
+    ids = add_foods(user_id, [('2020-01-01', 'a'), (None, 'b'), ('2020-01-02', 'c'), (None, 'd')])
+    foods, cursor = dbutils.list_food_page(user_id)
+    assert [f.id for f in foods] == [ids[2], ids[0], ids[3], ids[1]]
+    assert cursor is None
+    # Entries without a date can't be paginated
+    foods, cursor = dbutils.list_food_page(user_id, limit=10)
+    assert [f.id for f in foods] == [ids[2], ids[0]]
+
+def test_invalid_arguments(app, make_user):
+    user_id = make_user()
+    with pytest.raises(ValueError):
+        dbutils.list_food_page(user_id, start_date='yesterday')
+    with pytest.raises(ValueError):
+        dbutils.list_food_page(user_id, end_date='2020-13-01')
+    with pytest.raises(ValueError):
+        dbutils.list_food_page(user_id, cursor=dbutils.encode_cursor(['DROP TABLE', 1]))
+    with pytest.raises(ValueError):
+        dbutils.list_food_page(user_id, cursor=dbutils.encode_cursor({'date': '2020-01-01'}))
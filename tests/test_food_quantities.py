@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+@pytest.mark.parametrize('quantity,expected', [
+    ('100g', (100.0, 'g')),
+    ('1/2cup', (0.5, 'cup')),
+    ('1,5l', (1.5, 'l')),
+    ('2.5', (2.5, '')),
+    ('about 3slices', (3.0, 'slices')),
+    ('-1kg', (-1.0, 'kg')),
+    ('1/0cup', (None, None)),
+    ('some', (None, None)),
+    ('', (None, None)),
+    (None, (None, None)),
+])
+def test_parse_quantity(quantity, expected):
+    assert dbutils.parse_quantity(quantity) == expected
+
+def test_quantities_stored_with_entries(app, make_user):
+    from fitnessapp.models import FoodQuantity
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    foods = dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'rice', 'quantity': '200g', 'calories': 260,
+        'children': [{'name': 'oil', 'quantity': 'a splash'}]
+    }, user_id)
+    quantities = dict([(q.food_id, (q.value, q.unit)) for q in db.session.query(FoodQuantity).all()])
+    assert quantities == {foods[0].id: (200.0, 'g'), foods[1].id: (None, None)}
+    dbutils.update_food_from_dict({'id': foods[0].id, 'quantity': '1cup'}, user_id)
+    assert db.session.query(FoodQuantity).filter_by(food_id=foods[0].id).one().unit == 'cup'
+
+def test_search_food_nutrition(app, make_user):
+    user_id = make_user()
+    for quantity,calories in [('100g', 130), ('200g', 300), ('1cup', 200)]:
+        dbutils.update_food_from_dict({
+            'date': '2020-01-01', 'name': 'White rice', 'quantity': quantity, 'calories': calories
+        }, user_id)
+    results = dbutils.search_food_nutrition('rice', 'g', user_id)
+    assert results['mean']['calories'] == pytest.approx(1.4)
+    assert results['mean']['quantity'] == '1 g'
+    assert sorted(f['quantity'] for f in results['all']) == ['100g', '200g']
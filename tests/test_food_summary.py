@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def summary(user_id):
+    from fitnessapp.extensions import db
+    from fitnessapp.models import FoodDailySummary
+    rows = db.session.query(FoodDailySummary) \
+            .filter_by(user_id=user_id) \
+            .order_by(FoodDailySummary.date) \
+            .all()
+    return [(str(r.date), r.calories, r.protein) for r in rows]
+
+def test_daily_summary(app, make_user):
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'apple', 'calories': 100}, user_id)
+    # Children are only counted when their parent has no value of its own
+    dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'sandwich', 'calories': 400,
+        'children': [{'name': 'bread', 'calories': 200, 'protein': 5}, {'name': 'ham', 'calories': 150, 'protein': 10}]
+    }, user_id)
+    salad = dbutils.update_food_from_dict({'date': '2020-01-02', 'name': 'salad', 'calories': 50}, user_id)[0]
+    dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'pie', 'calories': 300}, other_user_id)
+    dbutils.update_food_from_dict({'name': 'undated', 'calories': 1000}, user_id)
+    assert summary(user_id) == [('2020-01-01', 500, 15), ('2020-01-02', 50, None)]
+    assert summary(other_user_id) == [('2020-01-01', 300, None)]
+
+    # Moving an entry updates both days, and days without entries are removed
+    dbutils.update_food_from_dict({'id': salad.id, 'date': '2020-01-01'}, user_id)
+    assert summary(user_id) == [('2020-01-01', 550, 15)]
+    dbutils.delete_food_trees([salad.id], user_id)
+    assert summary(user_id) == [('2020-01-01', 500, 15)]
+
+def test_rebuild_daily_summary(app, make_user):
+    from fitnessapp.extensions import db
+    from fitnessapp.models import FoodDailySummary
+    user_id = make_user()
+    dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'apple', 'calories': 100}, user_id)
+    dbutils.update_food_from_dict({'date': '2020-01-03', 'name': 'pear', 'calories': 80}, user_id)
+    expected = summary(user_id)
+    db.session.query(FoodDailySummary).delete()
+    db.session.commit()
+    dbutils.rebuild_food_daily_summary()
+    assert summary(user_id) == expected
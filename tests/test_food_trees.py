@@ -0,0 +1,114 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils, autocomplete
+
+def names(entries):
+    return [e['name'] for e in entries]
+
+def test_insert_tree(app, make_user):
+    from tracker_database import Food
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    foods = dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'sandwich', 'calories': 500,
+        'children': [
+            {'name': 'bread', 'calories': 200},
+            {'name': 'filling', 'children': [{'name': 'ham', 'calories': 150}, {'name': 'cheese', 'calories': 150}]},
+        ]
+    }, user_id)
+    assert [f.name for f in foods] == ['sandwich', 'bread', 'filling', 'ham', 'cheese']
+    sandwich,bread,filling,ham,cheese = foods
+    assert sandwich.parent_id is None
+    assert (bread.parent_id, filling.parent_id) == (sandwich.id, sandwich.id)
+    assert (ham.parent_id, cheese.parent_id) == (filling.id, filling.id)
+    assert all(str(f.date) == '2020-01-01' for f in foods)
+    assert all(f.user_id == user_id for f in foods)
+    assert db.session.query(Food).count() == 5
+
+def test_update_tree(app, make_user):
+    user_id = make_user()
+    foods = dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'salad', 'children': [{'name': 'lettuce'}]
+    }, user_id)
+    salad,lettuce = foods
+    foods = dbutils.update_food_from_dict({
+        'id': salad.id, 'date': '2020-01-02', 'name': 'green salad',
+        'children': [{'id': lettuce.id, 'name': 'romaine'}, {'name': 'tomato'}]
+    }, user_id)
+    assert [f.id for f in foods[:2]] == [salad.id, lettuce.id]
+    assert [f.name for f in foods] == ['green salad', 'romaine', 'tomato']
+    assert [str(f.date) for f in foods] == ['2020-01-02']*3
+    assert foods[2].parent_id == salad.id
+
+def test_update_another_users_entry(app, make_user):
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    food = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'soup'}, other_user_id)[0]
+    with pytest.raises(Exception):
+        dbutils.update_food_from_dict({'id': food.id, 'name': 'stolen soup'}, user_id)
+
+def test_caches_updated_after_commit(app, make_user):
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    parent = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'lunch'}, user_id)[0]
+    assert names(autocomplete.index.complete(user_id, '')) == ['lunch']
+
+    # Entries added under a parent aren't committed, so the caches must not see them yet
+    dbutils.update_food_from_dict({'name': 'rice'}, user_id, parent=parent)
+    assert names(autocomplete.index.complete(user_id, '')) == ['lunch']
+    db.session.rollback()
+    assert names(autocomplete.index.complete(user_id, '')) == ['lunch']
+    db.session.commit()
+    assert names(autocomplete.index.complete(user_id, '')) == ['lunch']
+
+    dbutils.update_food_from_dict({'name': 'beans'}, user_id, parent=parent)
+    assert names(autocomplete.index.complete(user_id, '')) == ['lunch']
+    db.session.commit()
+    assert sorted(names(autocomplete.index.complete(user_id, ''))) == ['beans', 'lunch']
+
+def test_delete_trees(app, make_user):
+    from tracker_database import Food, Photo
+    from fitnessapp.extensions import db
+    import datetime
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    meal = dbutils.update_food_from_dict({
+        'date': '2020-01-01', 'name': 'meal',
+        'children': [{'name': 'main', 'children': [{'name': 'side'}]}, {'name': 'drink'}]
+    }, user_id)
+    snack = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'snack'}, user_id)[0]
+    other = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'meal'}, other_user_id)[0]
+    photo = Photo()
+    photo.user_id = user_id
+    photo.file_name = 'photo'
+    photo.upload_time = datetime.datetime.utcnow()
+    photo.food_id = meal[2].id
+    db.session.add(photo)
+    db.session.commit()
+    photo_id = photo.id
+
+    # Deleting a child deletes its own descendants only, and IDs of other users are ignored
+    deleted_ids,unlinked_ids = dbutils.delete_food_trees([meal[1].id, other.id], user_id)
+    assert sorted(deleted_ids) == sorted([meal[1].id, meal[2].id])
+    assert unlinked_ids == [photo_id]
+    remaining = db.session.query(Food).with_entities(Food.id).all()
+    assert sorted(i for i, in remaining) == sorted([meal[0].id, meal[3].id, snack.id, other.id])
+    assert db.session.query(Photo).filter_by(id=photo_id).one().food_id is None
+
+    deleted_ids = dbutils.delete_food(db.session.query(Food).filter_by(id=meal[0].id).one())
+    assert sorted(deleted_ids) == sorted([meal[0].id, meal[3].id])
+    assert dbutils.delete_food_trees([], user_id) == ([], [])
+
+def test_delete_updates_caches_after_commit(app, make_user):
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    food = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'cake'}, user_id)[0]
+    assert names(autocomplete.index.complete(user_id, '')) == ['cake']
+    dbutils.delete_food_trees([food.id], user_id, commit=False)
+    assert names(autocomplete.index.complete(user_id, '')) == ['cake']
+    db.session.rollback()
+    dbutils.delete_food_trees([food.id], user_id, commit=False)
+    db.session.commit()
+    assert names(autocomplete.index.complete(user_id, '')) == []
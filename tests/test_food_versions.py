@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def test_food_versions(app, make_user):
+    user_id = make_user()
+    assert dbutils.get_food_version(user_id) == 0
+    assert dbutils.food_day_etag(user_id, '2020-01-01') == '"food-%s-2020-01-01-0"' % user_id
+
+    apple = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'apple'}, user_id)[0]
+    day1 = dbutils.food_day_etag(user_id, '2020-01-01')
+    day2 = dbutils.food_day_etag(user_id, '2020-01-02')
+    version = dbutils.get_food_version(user_id)
+    assert day1 != '"food-%s-2020-01-01-0"' % user_id
+    assert dbutils.food_entry_etag(user_id, apple.id) == day1
+    assert version > 0
+
+    # Changes to one day leave the ETags of other days alone
+    dbutils.update_food_from_dict({'date': '2020-01-02', 'name': 'pear'}, user_id)
+    assert dbutils.food_day_etag(user_id, '2020-01-01') == day1
+    assert dbutils.food_day_etag(user_id, '2020-01-02') != day2
+    assert dbutils.get_food_version(user_id) > version
+
+    # Moving an entry changes both days
+    day2 = dbutils.food_day_etag(user_id, '2020-01-02')
+    dbutils.update_food_from_dict({'id': apple.id, 'date': '2020-01-02'}, user_id)
+    assert dbutils.food_day_etag(user_id, '2020-01-01') != day1
+    assert dbutils.food_day_etag(user_id, '2020-01-02') != day2
+    assert dbutils.food_entry_etag(user_id, apple.id) == dbutils.food_day_etag(user_id, '2020-01-02')
+
+def test_food_entry_etag_of_another_user(app, make_user):
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    food = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'soup'}, other_user_id)[0]
+    assert dbutils.food_entry_etag(user_id, food.id) is None
+    assert dbutils.food_entry_etag(other_user_id, food.id) is not None
+    assert dbutils.food_day_etag(user_id, '2020-01-01') == '"food-%s-2020-01-01-0"' % user_id
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from fitnessapp.ml import image_classifier
+
+def test_food_classes_from_scores():
+    classifier = image_classifier.FoodImageClassifier(None, top_k=3)
+    food = sorted(image_classifier.food_classes.keys())
+    not_food = [i for i in range(1000) if i not in image_classifier.food_classes][:3]
+    scores = np.zeros((3, 1000), dtype=np.float32)
+    # Food in second place
+    scores[0, not_food[0]] = 3
+    scores[0, food[0]] = 2
+    scores[0, food[1]] = 1
+    # Food outside of the top 3
+    scores[1, not_food] = [3, 2, 1]
+    scores[1, food[0]] = 0.5
+    # Food first
+    scores[2, food[2]] = 5
+    assert classifier.food_classes_from_scores(scores).tolist() == [food[0], -1, food[2]]
+
+def test_preprocess_batch():
+    images = np.zeros((2, 4, 4, 3), dtype=np.uint8)
+    images[1] = 255
+    batch = image_classifier.preprocess_batch(images)
+    assert batch.shape == (2, 3, 4, 4)
+    assert batch.dtype == np.float32
+    assert batch.flags['C_CONTIGUOUS']
+    mean = image_classifier.MEAN.ravel()
+    std = image_classifier.STD.ravel()
+    assert np.allclose(batch[0,:,0,0], -mean/std)
+    assert np.allclose(batch[1,:,0,0], (1-mean)/std)
+
+def test_model_is_loaded_lazily_from_checkpoint(tmp_path):
+    torch = pytest.importorskip('torch')
+    torchvision = pytest.importorskip('torchvision')
+    torch.manual_seed(0)
+    checkpoint = str(tmp_path/'resnet18.pt')
+    torch.save(torchvision.models.resnet18().state_dict(), checkpoint)
+    classifier = image_classifier.FoodImageClassifier(checkpoint, size=64)
+    assert classifier.model is None
+
+    directory = tmp_path/'photos'
+    directory.mkdir()
+    rng = np.random.RandomState(0)
+    for i in range(3):
+        Image.fromarray(rng.randint(0, 256, (80, 100, 3), dtype=np.uint8)).save(str(directory/('%d.jpg' % i)))
+    with open(str(directory/'notes.txt'), 'w') as f:
+        f.write('not an image')
+    results = dict(image_classifier.classify_directory(str(directory), classifier, batch_size=2, workers=0))
+    assert sorted(os.path.basename(f) for f in results) == ['0.jpg', '1.jpg', '2.jpg', 'notes.txt']
+    assert results[str(directory/'notes.txt')] is None
+    names = set(image_classifier.food_classes.values()) | set([None])
+    assert all(name in names for name in results.values())
+    assert classifier.model is not None
+    images = [Image.open(str(directory/'0.jpg'))]
+    assert classifier.classify(images) == [results[str(directory/'0.jpg')]]
+
+def test_package_imports_without_app():
+    import subprocess
+    import sys
+    # In a fresh interpreter, since other tests may have imported the app
+    code = 'import sys, fitnessapp.ml.image_classifier; assert "fitnessapp.application" not in sys.modules'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
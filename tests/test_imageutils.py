@@ -0,0 +1,67 @@
+from io import BytesIO
+
+from PIL import Image
+
+from fitnessapp import imageutils
+
+def encode(img, format='jpeg', **kwargs):
+    buffered = BytesIO()
+    img.save(buffered, format=format, **kwargs)
+    return buffered.getvalue()
+
+def gradient(width=1200, height=900):
+    img = Image.new('RGB', (width, height))
+    img.putdata([(x*255//width, y*255//height, 128) for y in range(height) for x in range(width)])
+    return img
+
+def test_decode_image_draft():
+    data = encode(gradient())
+    img,exif = imageutils.decode_image(data)
+    assert img.size == (1200, 900)
+    assert exif is None
+    # The JPEG decoder scales down by a power of two while still covering the requested size
+    img,_ = imageutils.decode_image(data, max_size=200)
+    assert img.size == (300, 225)
+
+def test_decode_image_exif():
+    exif = Image.Exif()
+    exif[0x0110] = 'Test camera'
+    data = encode(gradient(64, 48), exif=exif.tobytes())
+    _,exif = imageutils.decode_image(data)
+    assert exif[0x0110] == 'Test camera'
+
+def test_remove_transparency():
+    img = Image.new('RGBA', (4, 4), (255, 0, 0, 0))
+    img.putpixel((0, 0), (0, 0, 255, 255))
+    img = imageutils.remove_transparency(img)
+    assert img.mode == 'RGB'
+    assert img.getpixel((0, 0)) == (0, 0, 255)
+    assert img.getpixel((1, 1)) == (255, 255, 255)
+    assert imageutils.remove_transparency(Image.new('CMYK', (2, 2))).mode == 'RGB'
+    gray = Image.new('L', (2, 2))
+    assert imageutils.remove_transparency(gray) is gray
+
+def test_create_derivatives():
+    img = gradient()
+    derivatives = imageutils.create_derivatives(img, [700, 32])
+    sizes = dict([(s, Image.open(BytesIO(d)).size) for s,d in derivatives.items()])
+    assert sizes == {700: (700, 525), 32: (32, 24)}
+    assert Image.open(BytesIO(derivatives[700])).format == 'JPEG'
+    # The original isn't modified
+    assert img.size == (1200, 900)
+
+def test_process_image():
+    data = encode(gradient())
+    derivatives,exif,h = imageutils.process_image(data, sizes=[700, 32])
+    assert sorted(derivatives.keys()) == [32, 700]
+    assert exif is None
+    # Hashed from the full decode rather than a reduced one, which can only change a few bits
+    assert bin(h ^ imageutils.dhash_from_bytes(data)).count('1') <= 4
+
+def test_create_sprite():
+    images = [(i, encode(gradient(100, 50))) for i in range(5)]
+    data,offsets = imageutils.create_sprite(images, 32, columns=2)
+    assert Image.open(BytesIO(data)).size == (64, 96)
+    assert offsets[0] == {'x': 0, 'y': 0, 'width': 32, 'height': 16}
+    assert offsets[3] == {'x': 32, 'y': 32, 'width': 32, 'height': 16}
+    assert offsets[4]['y'] == 64
@@ -0,0 +1,75 @@
+import datetime
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import jobs, storage
+
+def jpeg(width=800, height=600):
+    buffered = BytesIO()
+    Image.new('RGB', (width, height), (200, 100, 50)).save(buffered, format='jpeg')
+    return buffered.getvalue()
+
+def create_photo(app, user_id, data):
+    from tracker_database import Photo
+    from fitnessapp.extensions import db
+    photo = Photo()
+    photo.user_id = user_id
+    photo.upload_time = datetime.datetime.utcnow()
+    db.session.add(photo)
+    db.session.flush()
+    photo.file_name = str(photo.id)
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], photo.file_name), 'wb') as f:
+        f.write(data)
+    job = jobs.create_photo_job(photo)
+    db.session.commit()
+    return photo.file_name, job.id
+
+def test_run_photo_job(app, make_user):
+    from fitnessapp.models import PhotoJob
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    file_name,job_id = create_photo(app, user_id, jpeg())
+    assert jobs.run_photo_job(job_id)
+    assert db.session.query(PhotoJob).filter_by(id=job_id).one().status == 'done'
+    with Image.open(BytesIO(storage.get_storage().get(file_name))) as img:
+        assert max(img.size) == 700
+    assert not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file_name))
+    # Already done
+    assert not jobs.run_photo_job(job_id)
+
+def test_failed_job_keeps_original(app, make_user):
+    from fitnessapp.models import PhotoJob
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    file_name,job_id = create_photo(app, user_id, b'not an image')
+    assert jobs.run_photo_job(job_id)
+    job = db.session.query(PhotoJob).filter_by(id=job_id).one()
+    assert job.status == 'failed'
+    assert job.error is not None
+    assert os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file_name))
+
+def test_run_pending_photo_jobs(app, make_user):
+    from fitnessapp.models import PhotoJob
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    job_ids = [create_photo(app, user_id, jpeg())[1] for _ in range(2)]
+    # Claimed by a worker that died
+    db.session.query(PhotoJob).filter_by(id=job_ids[1]).update({
+        'status': 'processing',
+        'updated': datetime.datetime.utcnow()-datetime.timedelta(seconds=app.config['PHOTO_JOB_TIMEOUT']+1)
+    })
+    db.session.commit()
+    jobs.run_pending_photo_jobs()
+    statuses = db.session.query(PhotoJob).with_entities(PhotoJob.status).all()
+    assert [s for s, in statuses] == ['done', 'done']
+
+def test_run_inline(app):
+    app.config['PHOTO_JOBS_INLINE'] = None
+    assert jobs.run_inline() == ('AWS_LAMBDA_FUNCTION_NAME' in os.environ)
+    app.config['PHOTO_JOBS_INLINE'] = False
+    assert not jobs.run_inline()
@@ -0,0 +1,76 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def photo(id, time, date='2020-01-01'):
+    return SimpleNamespace(id=id, date=date, time=time, user_id=1)
+
+def ids(groups):
+    return [[p.id for p in g] for g in groups]
+
+def test_group_photos_by_time():
+    photos = [
+        photo(1, '12:00:00'), photo(2, '12:01:30'), photo(3, '12:03:00'),
+        photo(4, '18:00:00'), photo(5, None), photo(6, '11:00:00'),
+        photo(7, '12:00:00', date=None),
+    ]
+    groups = dbutils.group_photos(photos, max_seconds=120)
+    # Chains of photos each close to the previous one form one group, and photos of unknown time are alone, last
+    assert ids(groups) == [[6], [1, 2, 3], [4], [5], [7]]
+    assert ids(dbutils.group_photos(photos, max_seconds=60)) == [[6], [1], [2], [3], [4], [5], [7]]
+    assert dbutils.group_photos([], max_seconds=120) == []
+
+def create_photos(user_id, times, date='2020-01-01'):
+    from tracker_database import Photo
+    from fitnessapp.extensions import db
+    photos = []
+    for t in times:
+        p = Photo()
+        p.user_id = user_id
+        p.file_name = ''
+        p.upload_time = datetime.datetime.utcnow()
+        p.date = date
+        p.time = t
+        db.session.add(p)
+        photos.append(p)
+    db.session.commit()
+    return [p.id for p in photos]
+
+def test_group_photos_by_hash(app, make_user):
+    from fitnessapp import photohash
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    photo_ids = create_photos(user_id, ['08:00:00', '12:00:00', '19:00:00', '19:01:00'])
+    photohash.save_hashes(user_id, [(photo_ids[0], 0), (photo_ids[1], 1 << 40), (photo_ids[2], 1)])
+    db.session.commit()
+    groups = dbutils.autogoup_photos(photo_ids, max_seconds=120, max_distance=2)
+    assert groups == [[photo_ids[0], photo_ids[2], photo_ids[3]], [photo_ids[1]]]
+    assert dbutils.autogoup_photos(photo_ids, max_seconds=120, max_distance=0) == [
+            [photo_ids[0]], [photo_ids[1]], [photo_ids[2], photo_ids[3]]]
+
+def test_autogenerate_food_entry_for_date(app, make_user):
+    from tracker_database import Food, Photo
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    photo_ids = create_photos(user_id, ['08:00:00', '08:01:00', '12:00:00', '19:00:00'])
+    create_photos(user_id, ['08:00:00'], date='2020-01-02')
+    food_ids,remaining = dbutils.autogenerate_food_entry_for_date('2020-01-01', user_id, max_photos=3)
+    assert len(food_ids) == 2
+    assert remaining == 1
+    owners = dict(db.session.query(Photo).with_entities(Photo.id, Photo.food_id).all())
+    assert owners[photo_ids[0]] == owners[photo_ids[1]] == food_ids[0]
+    assert owners[photo_ids[2]] == food_ids[1]
+    # A single photo is the entry's main photo
+    foods = dict([(f.id, f) for f in db.session.query(Food).all()])
+    assert foods[food_ids[0]].photo_id is None
+    assert foods[food_ids[1]].photo_id == photo_ids[2]
+
+    food_ids,remaining = dbutils.autogenerate_food_entry_for_date('2020-01-01', user_id)
+    assert len(food_ids) == 1
+    assert remaining == 0
+    assert dbutils.autogenerate_food_entry_for_date('2020-01-01', user_id) == ([], 0)
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import dbutils
+
+def upload(data):
+    """ Write `data` the way the batch upload endpoint streams each file. """
+    stream = dbutils.upload_stream_factory(len(data), 'image/jpeg', 'photo.jpg')
+    stream.write(data)
+    return FileStorage(stream=stream, filename='photo.jpg', name='file')
+
+def test_create_photos_from_uploads(app, make_user):
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    food = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'toast'}, user_id)[0]
+    photos = dbutils.create_photos_from_uploads([upload(b'a'), upload(b'b')], user_id,
+            date='2020-01-01', food_id=food.id)
+    db.session.commit()
+    assert [p.food_id for p in photos] == [food.id, food.id]
+    assert [p.file_name for p in photos] == [str(p.id) for p in photos]
+    for photo,data in zip(photos, [b'a', b'b']):
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], photo.file_name), 'rb') as f:
+            assert f.read() == data
+
+def test_create_photos_for_another_users_food(app, make_user):
+    from tracker_database import Photo
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    food = dbutils.update_food_from_dict({'date': '2020-01-01', 'name': 'toast'}, other_user_id)[0]
+    with pytest.raises(ValueError):
+        dbutils.create_photos_from_uploads([upload(b'a')], user_id, food_id=food.id)
+    with pytest.raises(ValueError):
+        dbutils.create_photos_from_uploads([upload(b'a')], user_id, food_id=food.id+1000)
+    db.session.rollback()
+    assert db.session.query(Photo).count() == 0
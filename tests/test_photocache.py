@@ -0,0 +1,68 @@
+import os
+import time
+
+from fitnessapp.photocache import DerivativeCache
+
+def read(f):
+    with f:
+        return f.read()
+
+def test_get_and_put(tmp_path):
+    cache = DerivativeCache(str(tmp_path), max_bytes=1000)
+    assert cache.get('a') is None
+    path = cache.put('a', b'12345')
+    assert path == cache.path('a')
+    assert read(cache.get('a')) == b'12345'
+    cache.put('a', b'123')
+    assert read(cache.get('a')) == b'123'
+    stats = cache.stats()
+    assert stats['bytes'] == 3
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 0)
+    assert stats['max_bytes'] == 1000
+    assert not any(name.startswith('.tmp-') for name in os.listdir(str(tmp_path)))
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DerivativeCache(str(tmp_path), max_bytes=300, low_water=0.7)
+    for i,key in enumerate(['a', 'b', 'c']):
+        cache.put(key, b'x'*100)
+        os.utime(cache.path(key), (i, i))
+    # Reading `a` makes `b` the least recently used
+    read(cache.get('a'))
+    cache.put('d', b'x'*100)
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+    assert read(cache.get('a')) == b'x'*100
+    assert read(cache.get('d')) == b'x'*100
+    stats = cache.stats()
+    assert stats['bytes'] == 200
+    assert stats['evictions'] == 2
+
+def test_keeps_file_being_written(tmp_path):
+    cache = DerivativeCache(str(tmp_path), max_bytes=100)
+    cache.put('a', b'x'*50)
+    os.utime(cache.path('a'), (time.time()+60, time.time()+60))
+    cache.put('b', b'x'*200)
+    assert cache.get('a') is None
+    assert read(cache.get('b')) == b'x'*200
+
+def test_shared_between_processes(tmp_path):
+    # Each process has its own instance on the same directory
+    first = DerivativeCache(str(tmp_path), max_bytes=1000)
+    second = DerivativeCache(str(tmp_path), max_bytes=1000)
+    first.put('a', b'x'*100)
+    assert read(second.get('a')) == b'x'*100
+    assert second.get('b') is None
+    second.put('b', b'x'*50)
+    stats = first.stats()
+    assert stats['bytes'] == 150
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+def test_rebuilds_missing_usage(tmp_path):
+    cache = DerivativeCache(str(tmp_path), max_bytes=1000)
+    cache.put('a', b'x'*100)
+    os.remove(os.path.join(str(tmp_path), '.usage'))
+    assert cache.stats()['bytes'] == 100
+    with open(os.path.join(str(tmp_path), '.usage'), 'w') as f:
+        f.write('100') # Written by an older version
+    cache.put('b', b'x'*10)
+    assert cache.stats()['bytes'] == 110
@@ -0,0 +1,89 @@
+import datetime
+import random
+
+import pytest
+from PIL import Image, ImageFilter
+
+from fitnessapp import imageutils
+
+def photohash():
+    return pytest.importorskip('fitnessapp.photohash')
+
+def noise(seed, size=(128, 96)):
+    rng = random.Random(seed)
+    img = Image.new('L', size)
+    img.putdata([rng.randrange(256) for _ in range(size[0]*size[1])])
+    return img.filter(ImageFilter.GaussianBlur(4)).convert('RGB')
+
+def test_dhash():
+    img = noise(0)
+    h = imageutils.dhash(img)
+    assert 0 <= h < 1 << 64
+    # Unchanged by resizing and slight blurring, unlike a different image
+    assert bin(h ^ imageutils.dhash(img.resize((64, 48)))).count('1') <= 4
+    assert bin(h ^ imageutils.dhash(img.filter(ImageFilter.GaussianBlur(1)))).count('1') <= 4
+    assert bin(h ^ imageutils.dhash(noise(1))).count('1') > 10
+    # Brightness increasing from left to right sets every bit
+    gradient = Image.new('L', (90, 80))
+    gradient.putdata([x for _ in range(80) for x in range(90)])
+    assert imageutils.dhash(gradient) == (1 << 64)-1
+
+def test_signed_conversion():
+    ph = photohash()
+    for h in [0, 1, (1 << 63)-1, 1 << 63, (1 << 64)-1]:
+        signed = ph.to_signed(h)
+        assert -(1 << 63) <= signed < 1 << 63
+        assert ph.to_unsigned(signed) == h
+
+def test_bktree_matches_brute_force():
+    ph = photohash()
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    # Near-duplicates of the first few
+    hashes += [h ^ (1 << rng.randrange(64)) for h in hashes[:20]]
+    tree = ph.BKTree()
+    for i,h in enumerate(hashes):
+        tree.add(h, i)
+    tree.add(hashes[0], 'duplicate')
+    assert len(tree) == len(hashes)+1
+    for query in hashes[:30]+[rng.getrandbits(64) for _ in range(10)]:
+        for max_distance in [0, 1, 4, 20]:
+            expected = sorted([(ph.hamming(query, h), i) for i,h in enumerate(hashes) if ph.hamming(query, h) <= max_distance])
+            results = tree.search(query, max_distance)
+            results = [r for r in results if r[1] != 'duplicate']
+            assert sorted(results) == expected
+            assert [d for d,_ in results] == sorted(d for d,_ in results)
+    assert (0, 'duplicate') in tree.search(hashes[0], 0)
+    assert ph.BKTree().search(0, 64) == []
+
+def test_find_duplicate_photos(app, make_user):
+    from tracker_database import Photo
+    from fitnessapp import dbutils
+    from fitnessapp.extensions import db
+    ph = photohash()
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    photos = []
+    for owner in [user_id, user_id, other_user_id]:
+        photo = Photo()
+        photo.user_id = owner
+        photo.file_name = ''
+        photo.upload_time = datetime.datetime.utcnow()
+        db.session.add(photo)
+        photos.append(photo)
+    db.session.flush()
+    h = (1 << 64)-1
+    ph.save_hashes(user_id, [(photos[0].id, h), (photos[1].id, 0)])
+    ph.save_hashes(other_user_id, [(photos[2].id, h)])
+    db.session.commit()
+    assert [p.id for p in dbutils.find_duplicate_photos(user_id, h ^ 1, 4)] == [photos[0].id]
+    # Hashes saved later are added to the loaded tree
+    photo = Photo()
+    photo.user_id = user_id
+    photo.file_name = ''
+    photo.upload_time = datetime.datetime.utcnow()
+    db.session.add(photo)
+    db.session.flush()
+    ph.save_hashes(user_id, [(photo.id, 3)])
+    db.session.commit()
+    assert sorted(p.id for p in dbutils.find_duplicate_photos(user_id, 1, 1)) == [photos[1].id, photo.id]
@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from fitnessapp.ml import registry
+
+class FakeModel:
+    """ Model predicting the mean brightness of each image. """
+    loaded = []
+    def __init__(self, config):
+        FakeModel.loaded.append(config['name'])
+        self.name = config['name']
+
+    def preprocess(self, img):
+        return np.array([np.asarray(img.convert('L'), dtype=np.float32).mean()])
+
+    def forward(self, batch):
+        return batch
+
+    def postprocess(self, outputs):
+        return [[(self.name, float(y[0]))] for y in outputs]
+
+    def predict(self, images):
+        return self.postprocess(self.forward(np.stack([self.preprocess(img) for img in images])))
+
+    def embed(self, batch):
+        return np.concatenate([batch, batch], axis=1)
+
+@pytest.fixture
+def models(monkeypatch):
+    FakeModel.loaded = []
+    monkeypatch.setitem(registry.LOADERS, 'fake', FakeModel)
+    return dict([(v, {'type': 'fake', 'name': v}) for v in ['a', 'b', 'c']])
+
+def gray(value):
+    return Image.new('L', (4, 4), value)
+
+def test_loads_once_and_evicts(models):
+    r = registry.ModelRegistry(models, 'a', max_models=2)
+    assert r.predict([gray(10), gray(20)]) == [[('a', 10.0)], [('a', 20.0)]]
+    assert r.get('a') is r.get()
+    r.get('b')
+    r.get('a')
+    r.get('c')
+    assert r.stats()['loaded'] == ['a', 'c']
+    assert FakeModel.loaded == ['a', 'b', 'c']
+    with pytest.raises(KeyError):
+        r.get('unknown')
+
+def test_concurrent_loads(models):
+    r = registry.ModelRegistry(models, 'a')
+    threads = [threading.Thread(target=r.get, args=('b',)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert FakeModel.loaded == ['b']
+
+def test_batching(models):
+    r = registry.ModelRegistry(models, 'a', max_models=1, batching={'max_batch_size': 4, 'max_wait': 0.01}, timeout=5)
+    assert r.predict([gray(1), gray(2)], 'b') == [[('b', 1.0)], [('b', 2.0)]]
+    assert r.stats()['batching']['b']['items'] == 2
+    # Evicting a model closes its scheduler
+    scheduler = r.schedulers['b']
+    r.get('c')
+    assert scheduler.closed
+    assert list(r.schedulers.keys()) == ['c']
+
+def test_embed(models):
+    r = registry.ModelRegistry(models, 'a')
+    assert r.embed([gray(3)]).tolist() == [[3.0, 3.0]]
+
+def test_warmup_ignores_failures(models, monkeypatch):
+    def broken(config):
+        raise IOError('Missing checkpoint')
+    monkeypatch.setitem(registry.LOADERS, 'broken', broken)
+    models['d'] = {'type': 'broken'}
+    r = registry.ModelRegistry(models, 'a')
+    r.warmup(['d', 'b'])
+    assert r.stats()['loaded'] == ['b']
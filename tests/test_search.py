@@ -0,0 +1,121 @@
+import pytest
+
+pytest.importorskip('tracker_database')
+
+from fitnessapp import search
+
+def test_escape_like():
+    assert search.escape_like('100%') == '100\\%'
+    assert search.escape_like('a_b') == 'a\\_b'
+    assert search.escape_like('a\\b') == 'a\\\\b'
+    assert search.escape_like('apple') == 'apple'
+
+def test_trigrams():
+    assert search.trigrams('Cat') == {'  c', ' ca', 'cat', 'at '}
+    assert search.trigrams('a b') == {'  a', ' a ', '  b', ' b '}
+    assert search.trigrams('') == set()
+
+def test_ngram_index_substring():
+    index = search.NgramIndex()
+    index.add(1, 'banana bread')
+    index.add(2, 'apple pie')
+    assert index.search('nana') == [(1, 1.0)]
+    assert index.search('pie') == [(2, 1.0)]
+    assert index.search('soup') == []
+    assert index.search('') == []
+
+def test_ngram_index_misspelling():
+    index = search.NgramIndex()
+    index.add(1, 'spaghetti')
+    index.add(2, 'spinach')
+    results = index.search('spagetti')
+    assert [k for k,_ in results] == [1]
+    assert 0.6 <= results[0][1] < 1.0
+
+def test_ngram_index_short_terms():
+    index = search.NgramIndex()
+    index.add(1, 'egg')
+    index.add(2, 'bagel')
+    assert sorted(k for k,_ in index.search('g')) == [1, 2]
+    assert index.search('ag') == [(2, 1.0)]
+
+def test_ngram_index_order():
+    index = search.NgramIndex()
+    index.add(1, 'milk chocolate')
+    index.add(2, 'chocolate')
+    index.add(3, 'chocolate milk')
+    assert [k for k,_ in index.search('chocolate')] == [2, 3, 1]
+
+def test_ngram_index_replace_and_discard():
+    index = search.NgramIndex()
+    index.add(1, 'rice')
+    index.add(1, 'noodles')
+    assert index.search('rice') == []
+    assert index.search('noodle') == [(1, 1.0)]
+    index.discard(1)
+    index.discard(2)
+    assert len(index) == 0
+    assert len(index.postings) == 0
+
+def add_foods(user_id, names):
+    from fitnessapp import dbutils
+    for name in names:
+        dbutils.update_food_from_dict({'date': '2020-01-01', 'name': name}, user_id)
+
+def test_search_food_fallback(app, make_user):
+    from fitnessapp import dbutils
+    app.config['FOOD_SEARCH_NGRAM_FALLBACK'] = True
+    user_id = make_user()
+    other_user_id = make_user('other@example.com')
+    add_foods(user_id, ['Spaghetti', 'Spinach salad', '100% juice'])
+    add_foods(other_user_id, ['Spaghetti squash'])
+
+    results = dbutils.search_food('spagetti', user_id)
+    assert [f['name'] for f in results['recent']] == ['Spaghetti']
+    results = dbutils.search_food('100%', user_id)
+    assert [f['name'] for f in results['recent']] == ['100% juice']
+
+    # The name index is rebuilt after changes
+    add_foods(user_id, ['Spaghetti carbonara'])
+    results = dbutils.search_food('spagetti', user_id)
+    assert sorted(f['name'] for f in results['recent']) == ['Spaghetti', 'Spaghetti carbonara']
+
+def test_search_food_contains(app, make_user):
+    from fitnessapp import dbutils
+    app.config['FOOD_SEARCH_NGRAM_FALLBACK'] = False
+    user_id = make_user()
+    add_foods(user_id, ['Spaghetti', '100% juice', '1000 island dressing'])
+    results = dbutils.search_food('spagh', user_id)
+    assert [f['name'] for f in results['recent']] == ['Spaghetti']
+    results = dbutils.search_food('100%', user_id)
+    assert [f['name'] for f in results['recent']] == ['100% juice']
+
+def test_search_cache():
+    cache = search.SearchCache(max_queries=3)
+    rows = [{'name': 'Apple pie'}, {'name': 'Apple'}, {'name': 'Pineapple'}]
+    assert cache.get(1, 'recent', 'app', 1, max_age=60) is None
+    cache.set(1, 'recent', 'App', rows, complete=True, version=1)
+    assert cache.get(1, 'recent', 'app', 1, max_age=60) == rows
+    # Entries are only valid for the version they were computed for, and for `max_age` seconds
+    assert cache.get(1, 'recent', 'app', 2, max_age=60) is None
+    assert cache.get(1, 'recent', 'app', 1, max_age=-1) is None
+    assert cache.get(1, 'frequent', 'app', 1, max_age=60) is None
+    assert cache.get(2, 'recent', 'app', 1, max_age=60) is None
+    # Longer queries are answered by filtering complete results
+    assert cache.get(1, 'recent', 'apple ', 1, max_age=60) == [{'name': 'Apple pie'}]
+    assert cache.get(1, 'recent', 'pine', 1, max_age=60) is None
+
+def test_search_cache_truncated_results():
+    cache = search.SearchCache()
+    cache.set(1, 'frequent', 'a', [{'name': 'apple'}], complete=False, version=1)
+    assert cache.get(1, 'frequent', 'a', 1, max_age=60) == [{'name': 'apple'}]
+    assert cache.get(1, 'frequent', 'ap', 1, max_age=60) is None
+
+def test_search_cache_limits():
+    cache = search.SearchCache(max_queries=2)
+    for query in ['a', 'b', 'c']:
+        cache.set(1, 'recent', query, [], complete=True, version=1)
+    assert cache.get(1, 'recent', 'a', 1, max_age=60) is None
+    assert cache.get(1, 'recent', 'c', 1, max_age=60) == []
+    cache.invalidate(1)
+    assert cache.get(1, 'recent', 'c', 1, max_age=60) is None
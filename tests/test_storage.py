@@ -0,0 +1,80 @@
+import datetime
+import os
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from fitnessapp import storage
+
+def test_local_storage(tmp_path):
+    s = storage.LocalStorage(str(tmp_path/'photos'))
+    s.put('a', b'first')
+    s.put('a', b'second')
+    s.put('b', b'other')
+    assert s.get('a') == b'second'
+    with pytest.raises(FileNotFoundError):
+        s.get('missing')
+    assert s.get_many(['a', 'b', 'missing']) == {'a': b'second', 'b': b'other'}
+    s.delete('a')
+    s.delete('a')
+    assert s.get_many(['a', 'b']) == {'b': b'other'}
+    s.delete_many(['b', 'missing'])
+    assert os.listdir(str(tmp_path/'photos')) == []
+
+def test_delete_photo_files(app, make_user):
+    pytest.importorskip('tracker_database')
+    from tracker_database import Photo
+    from fitnessapp import dbutils
+    from fitnessapp.extensions import db
+    user_id = make_user()
+    photos = []
+    for _ in range(3):
+        photo = Photo()
+        photo.user_id = user_id
+        photo.upload_time = datetime.datetime.utcnow()
+        db.session.add(photo)
+        db.session.flush()
+        photo.file_name = str(photo.id)
+        photos.append(photo)
+    db.session.commit()
+    s = storage.get_storage()
+    for photo in photos:
+        s.put(photo.file_name, b'data')
+    # Not processed yet
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], photos[2].file_name), 'wb') as f:
+        f.write(b'original')
+
+    dbutils.delete_photo(photos[0])
+    assert s.get_many([p.file_name for p in photos]).keys() == set([photos[1].file_name, photos[2].file_name])
+
+    file_names = [photos[1].file_name, photos[2].file_name]
+    for photo in photos[1:]:
+        dbutils.delete_photo(photo, commit=False)
+    assert len(s.get_many(file_names)) == 2
+    db.session.commit()
+    dbutils.delete_photo_files(file_names)
+    assert s.get_many(file_names) == {}
+    assert os.listdir(app.config['UPLOAD_FOLDER']) == []
+    assert db.session.query(Photo).count() == 0
+
+def test_signed_urls(tmp_path):
+    from flask import Blueprint, Flask
+    from itsdangerous import BadSignature, SignatureExpired
+    app = Flask(__name__)
+    app.secret_key = 'secret'
+    blueprint = Blueprint('photos', __name__)
+    blueprint.add_url_rule('/photos/signed/<token>', 'signedphotofile', lambda token: '')
+    app.register_blueprint(blueprint)
+    s = storage.LocalStorage(str(tmp_path/'photos'))
+    with app.test_request_context():
+        url = s.url('1/thumb', 60, content_type='image/webp')
+        token = url.rsplit('/', 1)[-1]
+        assert storage.load_signed_key(token) == ('1/thumb', 'image/webp')
+        with pytest.raises(BadSignature):
+            storage.load_signed_key(token[:-2]+'xx')
+        with pytest.raises(SignatureExpired):
+            storage.load_signed_key(s.url('1/thumb', -1).rsplit('/', 1)[-1])
+        app.secret_key = 'other'
+        with pytest.raises(BadSignature):
+            storage.load_signed_key(token)
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from fitnessapp.usercache import UserCache
+
+def test_builds_once():
+    built = []
+    def build(user_id):
+        built.append(user_id)
+        return {'user': user_id}
+    cache = UserCache(build)
+    assert cache.get(1) == {'user': '1'}
+    assert cache.get('1') is cache.get(1)
+    assert built == ['1']
+
+def test_evicts_least_recently_used():
+    cache = UserCache(lambda user_id: object(), max_users=2)
+    first = cache.get(1)
+    cache.get(2)
+    cache.get(1)
+    cache.get(3)
+    assert list(cache.values.keys()) == ['1', '3']
+    assert cache.get(1) is first
+
+def test_max_age():
+    cache = UserCache(lambda user_id: object(), max_age=0.05)
+    first = cache.get(1)
+    assert cache.get(1) is first
+    time.sleep(0.1)
+    assert cache.get(1) is not first
+
+def test_apply_and_update():
+    cache = UserCache(lambda user_id: [])
+    assert cache.apply(1, len) is None
+    cache.update(1, lambda v: v.append('lost'))
+    value = cache.get(1)
+    assert value == []
+    cache.update(1, lambda v: v.append('kept'))
+    assert cache.apply(1, list) == ['kept']
+
+def test_invalidated_while_building():
+    started = threading.Event()
+    finish = threading.Event()
+    def build(user_id):
+        started.set()
+        finish.wait()
+        return object()
+    cache = UserCache(build)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(cache.get(1)))
+    thread.start()
+    started.wait()
+    cache.invalidate(1)
+    finish.set()
+    thread.join()
+    # The stale value is returned to the caller that built it, but not kept
+    assert results[0] is not None
+    assert cache.apply(1, lambda v: v) is None
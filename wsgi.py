@@ -1,4 +1,4 @@
-from fitnessapp import app
+from fitnessapp.application import app
 
 if __name__ == "__main__":
     app.run()